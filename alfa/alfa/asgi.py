@@ -20,11 +20,14 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'alfa.settings')
 django_asgi_app = get_asgi_application()
 
 # Import routing after Django app is initialized
-# from .routing import websocket_urlpatterns  # Создадим позже
+from chat.middleware import JWTAuthMiddleware
+from .routing import websocket_urlpatterns
 
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
-    # "websocket": AllowedHostsOriginValidator(
-    #     URLRouter(websocket_urlpatterns)
-    # ),
+    "websocket": AllowedHostsOriginValidator(
+        JWTAuthMiddleware(
+            URLRouter(websocket_urlpatterns)
+        )
+    ),
 })
@@ -3,6 +3,7 @@
 """
 import os
 from celery import Celery
+from kombu import Queue
 
 # Устанавливаем переменную окружения Django
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'alfa.settings')
@@ -12,6 +13,44 @@ app = Celery('alfa')
 # Загружаем конфигурацию из настроек Django с префиксом CELERY_
 app.config_from_object('django.conf:settings', namespace='CELERY')
 
+# Очереди по приоритету: генерация ответов в чате (interactive) обслуживается
+# отдельными воркерами и не ждет фоновых задач (background - краткие содержания
+# диалогов) и тяжелых пакетных (bulk - агрегаты использования, импорт).
+# Воркер без -Q слушает все три очереди
+app.conf.task_queues = (
+    Queue('interactive'),
+    Queue('background'),
+    Queue('bulk'),
+)
+app.conf.task_default_queue = 'background'
+app.conf.task_routes = {
+    'chat.tasks.generate_ai_response': {'queue': 'interactive'},
+    'chat.tasks.update_conversation_summary': {'queue': 'background'},
+    'chat.tasks.reap_stale_messages': {'queue': 'background'},
+    'chat.tasks.rollup_usage': {'queue': 'bulk'},
+}
+
+
+def _patch_green_psycopg():
+    """
+    Кооперативный psycopg2 для воркера с пулом gevent (-P gevent)
+    
+    Celery применяет monkey patching gevent до импорта проекта, но драйвер
+    PostgreSQL - C расширение, и без psycogreen запрос к БД блокирует все
+    greenlet процесса.
+    """
+    try:
+        from gevent import monkey
+    except ImportError:
+        return
+    
+    if monkey.is_module_patched('socket'):
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
+
+_patch_green_psycopg()
+
 # Автоматически находим задачи во всех приложениях
 app.autodiscover_tasks()
 
@@ -103,6 +103,30 @@ CHANNEL_LAYERS = {
 }
 
 
+# Кэш (Redis): общее состояние между воркерами - здоровье моделей, блокировки,
+# лимиты, ключи идемпотентности, кэш статистики. Отдельная БД Redis, чтобы не
+# смешивать с брокером Celery. Этот Redis не должен вытеснять ключи
+# (maxmemory-policy noeviction)
+# 'llm' - кэш ответов LLM (точный и семантический) в отдельном экземпляре Redis
+# с вытеснением по LRU: политика вытеснения действует на весь экземпляр
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv(
+            'CACHE_REDIS_URL',
+            f"redis://{os.getenv('REDIS_HOST', 'localhost')}:6379/1"
+        ),
+    },
+    'llm': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv(
+            'LLM_CACHE_REDIS_URL',
+            f"redis://{os.getenv('LLM_CACHE_REDIS_HOST', os.getenv('REDIS_HOST', 'localhost'))}:6379/2"
+        ),
+    },
+}
+
+
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
@@ -153,6 +177,18 @@ USE_TZ = True
 OPENROUTER_API_KEY = os.getenv('OPENROUTER_API_KEY', '')
 OPENROUTER_SITE_URL = os.getenv('OPENROUTER_SITE_URL', 'http://localhost')
 OPENROUTER_SITE_NAME = os.getenv('OPENROUTER_SITE_NAME', 'Alfa')
+OPENROUTER_BASE_URL = os.getenv('OPENROUTER_BASE_URL', 'https://openrouter.ai/api/v1')
+
+# HTTP клиент OpenRouter: один пул keep-alive соединений на процесс
+OPENROUTER_HTTP2 = os.getenv('OPENROUTER_HTTP2', 'True') == 'True'
+OPENROUTER_POOL_MAX_CONNECTIONS = int(os.getenv('OPENROUTER_POOL_MAX_CONNECTIONS', '100'))
+OPENROUTER_POOL_MAX_KEEPALIVE = int(os.getenv('OPENROUTER_POOL_MAX_KEEPALIVE', '20'))
+OPENROUTER_POOL_KEEPALIVE_EXPIRY = float(os.getenv('OPENROUTER_POOL_KEEPALIVE_EXPIRY', '60'))
+OPENROUTER_TIMEOUT = float(os.getenv('OPENROUTER_TIMEOUT', '120'))
+# Повторы внутри SDK (429/5xx, в том числе ожидание Retry-After) идут до того,
+# как ошибку увидят fallback по моделям, circuit breaker и лимиты моделей,
+# и умножаются на длину цепочки и повторы задачи Celery: по умолчанию выключены
+OPENROUTER_MAX_RETRIES = int(os.getenv('OPENROUTER_MAX_RETRIES', '0'))
 
 # Список моделей с приоритетами (первая - основная, остальные - fallback)
 OPENROUTER_MODELS = [
@@ -171,6 +207,144 @@ OPENROUTER_MODELS = [
 # Основная модель (можно переопределить через .env)
 OPENROUTER_MODEL = os.getenv('OPENROUTER_MODEL', OPENROUTER_MODELS[0])
 
+# Бюджет токенов промпта (системный промпт + история диалога). История
+# набирается от новых сообщений к старым, пока помещается в бюджет.
+# Для отдельных моделей бюджет задается в LLM_CONTEXT_BUDGETS, например
+# {'google/gemma-3-4b-it:free': 4000}. Промпт строится по бюджету основной модели
+LLM_CONTEXT_BUDGET = int(os.getenv('LLM_CONTEXT_BUDGET', '6000'))
+LLM_CONTEXT_BUDGETS = {}
+# Меньше этого остатка бюджета старое сообщение не обрезается, а отбрасывается
+LLM_HISTORY_MIN_TRUNCATED_TOKENS = int(os.getenv('LLM_HISTORY_MIN_TRUNCATED_TOKENS', '200'))
+
+# Краткое содержание длинных диалогов (Conversation.metadata['summary']):
+# когда после сжатой части накапливается больше LLM_SUMMARY_TRIGGER_MESSAGES
+# сообщений, все, кроме последних LLM_SUMMARY_KEEP_RECENT, добавляются в содержание.
+# За один запуск сжимается не больше LLM_SUMMARY_MAX_INPUT_TOKENS токенов сообщений,
+# остальное - следующими запусками
+LLM_SUMMARY_ENABLED = os.getenv('LLM_SUMMARY_ENABLED', 'True') == 'True'
+LLM_SUMMARY_TRIGGER_MESSAGES = int(os.getenv('LLM_SUMMARY_TRIGGER_MESSAGES', '12'))
+LLM_SUMMARY_KEEP_RECENT = int(os.getenv('LLM_SUMMARY_KEEP_RECENT', '6'))
+LLM_SUMMARY_MAX_TOKENS = int(os.getenv('LLM_SUMMARY_MAX_TOKENS', '600'))
+LLM_SUMMARY_MAX_INPUT_TOKENS = int(os.getenv('LLM_SUMMARY_MAX_INPUT_TOKENS', '6000'))
+
+# Circuit breaker моделей: после N ошибок подряд модель пропускается
+# на LLM_CIRCUIT_COOLDOWN секунд, цепочка fallback упорядочивается по
+# успешности и p50 задержки последних LLM_HEALTH_WINDOW запросов
+LLM_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('LLM_CIRCUIT_FAILURE_THRESHOLD', '3'))
+LLM_CIRCUIT_COOLDOWN = int(os.getenv('LLM_CIRCUIT_COOLDOWN', '60'))
+LLM_HEALTH_WINDOW = int(os.getenv('LLM_HEALTH_WINDOW', '20'))
+# Каждый LLM_HEALTH_PROBE_EVERY-й запрос сначала идет к модели, опустившейся
+# в цепочке ниже менее приоритетной, чтобы обновить ее статистику (0 - никогда)
+LLM_HEALTH_PROBE_EVERY = int(os.getenv('LLM_HEALTH_PROBE_EVERY', '20'))
+
+# Лимиты запросов к моделям (общие для всех воркеров): бюджет запросов и
+# токенов в минуту, например {'google/gemma-3-4b-it:free': {'rpm': 20, 'tpm': 40000}};
+# для моделей без записи - LLM_DEFAULT_RPM/LLM_DEFAULT_TPM (0 - без лимита).
+# Без разрешения запрос ждет до LLM_RATE_LIMIT_MAX_WAIT секунд, затем идет
+# к следующей модели. Одновременные запросы к модели ограничены адаптивно (AIMD)
+# в пределах LLM_AIMD_MIN_CONCURRENCY..LLM_AIMD_MAX_CONCURRENCY; пауза из
+# Retry-After ответа 429 открывает circuit модели, но не дольше LLM_RETRY_AFTER_MAX
+LLM_RATE_LIMITS = {}
+LLM_DEFAULT_RPM = int(os.getenv('LLM_DEFAULT_RPM', '0'))
+LLM_DEFAULT_TPM = int(os.getenv('LLM_DEFAULT_TPM', '0'))
+LLM_RATE_LIMIT_MAX_WAIT = float(os.getenv('LLM_RATE_LIMIT_MAX_WAIT', '5'))
+LLM_AIMD_MIN_CONCURRENCY = int(os.getenv('LLM_AIMD_MIN_CONCURRENCY', '1'))
+LLM_AIMD_MAX_CONCURRENCY = int(os.getenv('LLM_AIMD_MAX_CONCURRENCY', '16'))
+LLM_RETRY_AFTER_MAX = int(os.getenv('LLM_RETRY_AFTER_MAX', '300'))
+
+# Hedging: если основная модель не выдала первый токен за LLM_HEDGE_AFTER
+# секунд (p95 времени до первого токена), параллельно запрашивается
+# следующая модель; побеждает первая ответившая. Не более LLM_HEDGE_MAX
+# дополнительных запросов на ответ
+LLM_HEDGING_ENABLED = os.getenv('LLM_HEDGING_ENABLED', 'False') == 'True'
+LLM_HEDGE_AFTER = float(os.getenv('LLM_HEDGE_AFTER', '4.0'))
+LLM_HEDGE_MAX = int(os.getenv('LLM_HEDGE_MAX', '1'))
+
+# Кэш ответов AI: одинаковая история сообщений (после нормализации), модель
+# и temperature отдаются из Redis без запроса к LLM. Хранится в кэше 'llm',
+# вытеснение - LRU средствами Redis (maxmemory-policy allkeys-lru)
+LLM_RESPONSE_CACHE_ENABLED = os.getenv('LLM_RESPONSE_CACHE_ENABLED', 'True') == 'True'
+LLM_RESPONSE_CACHE_TTL = int(os.getenv('LLM_RESPONSE_CACHE_TTL', '86400'))
+
+# Семантический кэш первых вопросов диалога: ответ на близкий по смыслу
+# вопрос той же категории и типа бизнеса (косинусная близость векторов
+# хэшированных n-грамм не ниже порога)
+LLM_SEMANTIC_CACHE_ENABLED = os.getenv('LLM_SEMANTIC_CACHE_ENABLED', 'False') == 'True'
+LLM_SEMANTIC_CACHE_THRESHOLD = float(os.getenv('LLM_SEMANTIC_CACHE_THRESHOLD', '0.85'))
+LLM_SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv('LLM_SEMANTIC_CACHE_MAX_ENTRIES', '500'))
+LLM_SEMANTIC_CACHE_TTL = int(os.getenv('LLM_SEMANTIC_CACHE_TTL', '604800'))
+
+# Потоковая передача ответа через WebSocket: как часто (в секундах)
+# отправлять накопленные фрагменты ответа в channel layer
+CHAT_STREAM_FLUSH_INTERVAL = float(os.getenv('CHAT_STREAM_FLUSH_INTERVAL', '0.05'))
+
+# Server-Sent Events статуса сообщения: максимальная длительность потока
+# и интервал keepalive комментариев (в секундах)
+CHAT_SSE_TIMEOUT = int(os.getenv('CHAT_SSE_TIMEOUT', '300'))
+CHAT_SSE_KEEPALIVE_INTERVAL = int(os.getenv('CHAT_SSE_KEEPALIVE_INTERVAL', '15'))
+
+# Кэш статистики диалогов пользователя (GET /api/chat/stats/), в секундах.
+# Сбрасывается сразу при записи диалога или сообщения
+CHAT_STATS_CACHE_TTL = int(os.getenv('CHAT_STATS_CACHE_TTL', '300'))
+
+# Агрегаты использования AI по пользователю, бизнесу и дню (UsageRollup):
+# задача rollup_usage раз в CHAT_USAGE_ROLLUP_INTERVAL секунд учитывает
+# сообщения, записанные (inserted_at) раньше CHAT_USAGE_ROLLUP_LAG секунд
+# назад, пачками по BATCH_SIZE. LAG должен превышать самую долгую транзакцию,
+# пишущую сообщения
+CHAT_USAGE_ROLLUP_INTERVAL = int(os.getenv('CHAT_USAGE_ROLLUP_INTERVAL', '60'))
+CHAT_USAGE_ROLLUP_LAG = int(os.getenv('CHAT_USAGE_ROLLUP_LAG', '30'))
+CHAT_USAGE_ROLLUP_BATCH_SIZE = int(os.getenv('CHAT_USAGE_ROLLUP_BATCH_SIZE', '5000'))
+
+# Идемпотентная отправка сообщений: сколько секунд ключ Idempotency-Key
+# отвечается из Redis (дальше - по уникальному индексу в БД)
+CHAT_IDEMPOTENCY_TTL = int(os.getenv('CHAT_IDEMPOTENCY_TTL', '86400'))
+
+# Склейка сообщений, отправленных подряд: пока предыдущее сообщение диалога
+# ждет генерации, новые присоединяются к нему и получают один общий ответ.
+# CHAT_COALESCE_DEBOUNCE - задержка старта генерации в секундах (0 - без задержки),
+# за которую пользователь успевает дослать уточнения
+CHAT_COALESCE_ENABLED = os.getenv('CHAT_COALESCE_ENABLED', 'True') == 'True'
+CHAT_COALESCE_DEBOUNCE = float(os.getenv('CHAT_COALESCE_DEBOUNCE', '0'))
+
+# Блокировка диалога на время генерации ответа: задачи одного диалога
+# выполняются по очереди. Блокировка истекает через CHAT_GENERATION_LOCK_TIMEOUT
+# секунд (больше самой долгой генерации с fallback), задача, заставшая
+# диалог занятым, повторяется через CHAT_GENERATION_LOCK_RETRY_DELAY секунд
+CHAT_GENERATION_LOCK_TIMEOUT = int(os.getenv('CHAT_GENERATION_LOCK_TIMEOUT', '600'))
+CHAT_GENERATION_LOCK_RETRY_DELAY = int(os.getenv('CHAT_GENERATION_LOCK_RETRY_DELAY', '2'))
+
+# Сколько раз повторять задачу генерации, если все модели временно недоступны
+# (rate limit, timeout), прежде чем сохранить ответ с извинением (0 - сразу)
+CHAT_GENERATION_MODEL_RETRIES = int(os.getenv('CHAT_GENERATION_MODEL_RETRIES', '1'))
+
+# Закрывать соединение с БД на время запроса к модели. Нужно воркеру с пулом
+# gevent: соединение открывается на каждый greenlet, и сотни ожидающих ответа
+# генераций иначе держат сотни соединений с PostgreSQL
+CHAT_GENERATION_RELEASE_DB = os.getenv('CHAT_GENERATION_RELEASE_DB', 'False') == 'True'
+
+# Максимум одновременных генераций ответа одного пользователя (0 - без лимита):
+# задачи сверх лимита откладываются, не занимая воркеры очереди interactive
+CHAT_USER_MAX_INFLIGHT = int(os.getenv('CHAT_USER_MAX_INFLIGHT', '2'))
+
+# Зависшие сообщения (воркер упал во время генерации): задача reap_stale_messages
+# раз в CHAT_STALE_REAPER_INTERVAL секунд ставит генерацию заново для сообщений,
+# статус которых не менялся дольше срока, а после CHAT_STALE_MAX_REQUEUES
+# повторов помечает их ошибкой. Диалоги с занятой блокировкой (живая генерация
+# продлевает ее) пропускаются. Срок "ожидает" считается от отправки или
+# постановки на повтор и больше самой долгой паузы перед повтором (240 секунд)
+# вместе с ожиданием слота пользователя (до CHAT_GENERATION_LOCK_TIMEOUT)
+CHAT_STALE_REAPER_INTERVAL = int(os.getenv('CHAT_STALE_REAPER_INTERVAL', '60'))
+CHAT_STALE_PENDING_AFTER = int(os.getenv('CHAT_STALE_PENDING_AFTER', '900'))
+CHAT_STALE_PROCESSING_AFTER = int(os.getenv('CHAT_STALE_PROCESSING_AFTER', '900'))
+CHAT_STALE_MAX_REQUEUES = int(os.getenv('CHAT_STALE_MAX_REQUEUES', '1'))
+CHAT_STALE_BATCH_SIZE = int(os.getenv('CHAT_STALE_BATCH_SIZE', '500'))
+
+# Импорт истории сообщений из JSONL: размер пачки bulk_create и максимум
+# сообщений за один импорт
+CHAT_IMPORT_BATCH_SIZE = int(os.getenv('CHAT_IMPORT_BATCH_SIZE', '1000'))
+CHAT_IMPORT_MAX_MESSAGES = int(os.getenv('CHAT_IMPORT_MAX_MESSAGES', '50000'))
+
 
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/5.2/howto/static-files/
@@ -231,3 +405,18 @@ CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'UTC'
 CELERY_TASK_TRACK_STARTED = True
 CELERY_TASK_TIME_LIMIT = 30 * 60  # 30 минут максимум на задачу
+# Воркер берет из очереди по одной задаче на процесс: долгие генерации
+# не копятся за занятым процессом, пока другие простаивают
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+
+# Периодические задачи (celery beat)
+CELERY_BEAT_SCHEDULE = {
+    'rollup-usage': {
+        'task': 'chat.tasks.rollup_usage',
+        'schedule': CHAT_USAGE_ROLLUP_INTERVAL,
+    },
+    'reap-stale-messages': {
+        'task': 'chat.tasks.reap_stale_messages',
+        'schedule': CHAT_STALE_REAPER_INTERVAL,
+    },
+}
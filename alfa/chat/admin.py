@@ -4,7 +4,8 @@ Django Admin для управления чатами и сообщениями
 from django.contrib import admin
 from django.utils.translation import gettext_lazy as _
 
-from chat.models import Conversation, Message
+from chat.models import Conversation, Message, UsageRollup
+from chat.services.stats import ConversationStats
 
 
 class MessageInline(admin.TabularInline):
@@ -29,7 +30,8 @@ class ConversationAdmin(admin.ModelAdmin):
                     'messages_count', 'last_message_at', 'created_at')
     list_filter = ('status', 'category', 'created_at', 'last_message_at')
     search_fields = ('title', 'user__email', 'business__name')
-    readonly_fields = ('created_at', 'updated_at', 'last_message_at', 'messages_count')
+    readonly_fields = ('created_at', 'updated_at', 'last_message_at', 'messages_count',
+                       'last_message_role', 'last_message_preview')
     
     fieldsets = (
         ('Основная информация', {
@@ -39,6 +41,10 @@ class ConversationAdmin(admin.ModelAdmin):
             'fields': ('created_at', 'updated_at', 'last_message_at'),
             'classes': ('collapse',)
         }),
+        ('Последнее сообщение', {
+            'fields': ('messages_count', 'last_message_role', 'last_message_preview'),
+            'classes': ('collapse',)
+        }),
         ('Дополнительно', {
             'fields': ('metadata',),
             'classes': ('collapse',)
@@ -47,16 +53,18 @@ class ConversationAdmin(admin.ModelAdmin):
     
     inlines = [MessageInline]
     
+    def save_model(self, request, obj, form, change):
+        """Сохраняем только измененные поля, чтобы не затереть счетчики новых сообщений"""
+        if change:
+            obj.save(update_fields=[*form.changed_data, 'updated_at'])
+        else:
+            super().save_model(request, obj, form, change)
+    
     def title_preview(self, obj):
         """Краткое превью заголовка"""
         title = obj.title or f'Диалог #{obj.id}'
         return title[:50] + '...' if len(title) > 50 else title
     title_preview.short_description = 'Заголовок'
-    
-    def messages_count(self, obj):
-        """Количество сообщений"""
-        return obj.get_messages_count()
-    messages_count.short_description = 'Сообщений'
 
 
 @admin.register(Message)
@@ -83,6 +91,19 @@ class MessageAdmin(admin.ModelAdmin):
         }),
     )
     
+    def delete_model(self, request, obj):
+        """Удаление сообщения со сбросом кэша статистики владельца"""
+        user_id = obj.conversation.user_id
+        super().delete_model(request, obj)
+        ConversationStats.invalidate(user_id)
+    
+    def delete_queryset(self, request, queryset):
+        """Массовое удаление: кэш статистики сбрасывается один раз на пользователя"""
+        user_ids = set(queryset.values_list('conversation__user_id', flat=True))
+        super().delete_queryset(request, queryset)
+        for user_id in user_ids:
+            ConversationStats.invalidate(user_id)
+    
     def conversation_link(self, obj):
         """Ссылка на диалог"""
         return obj.conversation.title or f'Диалог #{obj.conversation.id}'
@@ -92,3 +113,20 @@ class MessageAdmin(admin.ModelAdmin):
         """Краткое превью содержимого"""
         return obj.content[:100] + '...' if len(obj.content) > 100 else obj.content
     content_preview.short_description = 'Содержимое'
+
+
+@admin.register(UsageRollup)
+class UsageRollupAdmin(admin.ModelAdmin):
+    """Админ панель для агрегатов использования (только просмотр)"""
+    
+    list_display = ('date', 'user', 'business', 'messages_count', 'assistant_messages',
+                    'tokens_used', 'updated_at')
+    list_filter = ('date',)
+    search_fields = ('user__email', 'business__name')
+    date_hierarchy = 'date'
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
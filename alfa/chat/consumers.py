@@ -0,0 +1,117 @@
+"""
+WebSocket consumers для чата с AI ассистентом
+"""
+import logging
+
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+
+from chat.models import Conversation
+from chat.serializers import MessageCreateSerializer, MessageSerializer
+from chat.services.events import ChatEvents, conversation_group_name
+from chat.services.messages import submit_user_message
+from users.utils.api_response import format_serializer_errors
+
+logger = logging.getLogger(__name__)
+
+
+class ChatConsumer(AsyncJsonWebsocketConsumer):
+    """
+    WebSocket для диалога с потоковой передачей ответа AI
+
+    ws://host/ws/chat/{conversation_id}/?token=<access_token>
+
+    Клиент отправляет:
+        {"type": "message", "content": "Текст сообщения", "client_message_id": "..."}
+
+    client_message_id необязателен: повтор с тем же ключом не создает
+    второе сообщение, клиенту возвращается исходное (message.created с replayed).
+
+    Сервер отправляет события вида {"event": "...", "data": {...}}:
+        message.created   - сообщение пользователя сохранено
+        message.status    - изменился статус обработки сообщения
+        message.delta     - очередной фрагмент ответа ассистента
+        message.reset     - частичный ответ нужно сбросить (fallback на другую модель)
+        message.retrying  - генерация упала и будет повторена (статус снова pending)
+        message.completed - ответ ассистента сохранен
+        error             - ошибка обработки запроса клиента
+    """
+
+    # Коды закрытия соединения (диапазон 4000-4999 для приложения)
+    CLOSE_UNAUTHORIZED = 4401
+    CLOSE_NOT_FOUND = 4404
+
+    async def connect(self):
+        """Проверяем пользователя и доступ к диалогу, подписываемся на события"""
+        self.group_name = None
+        user = self.scope.get('user')
+
+        if user is None or not user.is_authenticated:
+            await self.close(code=self.CLOSE_UNAUTHORIZED)
+            return
+
+        self.conversation_id = self.scope['url_route']['kwargs']['conversation_id']
+        self.conversation = await self._get_conversation(user)
+
+        if self.conversation is None:
+            await self.close(code=self.CLOSE_NOT_FOUND)
+            return
+
+        self.group_name = conversation_group_name(self.conversation.id)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, code):
+        """Отписываемся от событий диалога"""
+        if self.group_name:
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    async def receive_json(self, content, **kwargs):
+        """Обработка сообщения от клиента"""
+        if not isinstance(content, dict) or content.get('type') != 'message':
+            await self._send_error({'type': 'Неизвестный тип сообщения'})
+            return
+
+        data = {'content': content.get('content')}
+        if content.get('client_message_id'):
+            data['client_message_id'] = content['client_message_id']
+
+        serializer = MessageCreateSerializer(data=data)
+        if not serializer.is_valid():
+            await self._send_error(format_serializer_errors(serializer.errors))
+            return
+
+        # Ответ придет через группу диалога: message.created, затем фрагменты ответа
+        user_message, task_id, created = await database_sync_to_async(submit_user_message)(
+            self.conversation,
+            serializer.validated_data['content'],
+            client_message_id=serializer.validated_data.get('client_message_id')
+        )
+
+        # Повтор с тем же ключом: событий в группе не будет, исходное сообщение
+        # отправляется только этому клиенту
+        if not created:
+            await self.send_json({
+                'event': ChatEvents.MESSAGE_CREATED,
+                'data': {'user_message': MessageSerializer(user_message).data, 'replayed': True},
+            })
+
+    async def chat_event(self, event):
+        """Пересылка события из channel layer клиенту"""
+        await self.send_json({
+            'event': event['event'],
+            'data': event['data'],
+        })
+
+    async def _send_error(self, errors):
+        await self.send_json({
+            'event': ChatEvents.ERROR,
+            'data': {'errors': errors},
+        })
+
+    @database_sync_to_async
+    def _get_conversation(self, user):
+        return Conversation.objects.filter(
+            id=self.conversation_id,
+            user=user
+        ).first()
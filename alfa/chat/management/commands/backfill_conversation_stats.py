@@ -0,0 +1,68 @@
+"""
+Заполнение денормализованных полей диалогов по сообщениям
+
+    python manage.py backfill_conversation_stats
+    python manage.py backfill_conversation_stats --batch-size 500
+"""
+from django.core.management.base import BaseCommand
+from django.db.models import Count, OuterRef, Subquery
+
+from chat.models import Conversation, Message
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает messages_count, last_message_role и last_message_preview диалогов'
+    
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Количество диалогов в одной пачке (по умолчанию 1000)'
+        )
+    
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        
+        # Последнее сообщение и количество сообщений считаются подзапросами,
+        # поэтому на пачку диалогов приходится один SELECT и один bulk UPDATE
+        last_message = Message.objects.filter(
+            conversation=OuterRef('pk')
+        ).order_by('-created_at', '-id')
+        messages_count = Message.objects.filter(
+            conversation=OuterRef('pk')
+        ).order_by().values('conversation').annotate(count=Count('id')).values('count')
+        
+        queryset = Conversation.objects.order_by('id').annotate(
+            actual_count=Subquery(messages_count),
+            actual_role=Subquery(last_message.values('role')[:1]),
+            actual_content=Subquery(last_message.values('content')[:1]),
+        ).only('id', 'messages_count', 'last_message_role', 'last_message_preview')
+        
+        updated = 0
+        last_id = 0
+        while True:
+            batch = list(queryset.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            last_id = batch[-1].id
+            
+            changed = []
+            for conversation in batch:
+                count = conversation.actual_count or 0
+                role = conversation.actual_role or ''
+                preview = Message.build_preview(conversation.actual_content) if conversation.actual_content else ''
+                
+                if (conversation.messages_count, conversation.last_message_role, conversation.last_message_preview) != (count, role, preview):
+                    conversation.messages_count = count
+                    conversation.last_message_role = role
+                    conversation.last_message_preview = preview
+                    changed.append(conversation)
+            
+            Conversation.objects.bulk_update(
+                changed,
+                ['messages_count', 'last_message_role', 'last_message_preview']
+            )
+            updated += len(changed)
+        
+        self.stdout.write(self.style.SUCCESS(f'Обновлено диалогов: {updated}'))
@@ -0,0 +1,44 @@
+"""
+Локальная замена OpenRouter API (см. chat/services/fake_openrouter.py)
+
+    python manage.py fake_openrouter
+    python manage.py fake_openrouter --port 8090 --config fake_models.json --seed 42
+
+Приложение и воркеры переключаются на нее через
+OPENROUTER_BASE_URL=http://localhost:8090/api/v1
+"""
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.services.fake_openrouter import FakeOpenRouterServer
+
+
+class Command(BaseCommand):
+    help = 'Запускает локальный OpenAI-совместимый сервер вместо OpenRouter'
+    requires_system_checks = []
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1', help='Адрес (по умолчанию 127.0.0.1)')
+        parser.add_argument('--port', type=int, default=8090, help='Порт (по умолчанию 8090)')
+        parser.add_argument('--config', default=None, help='JSON файл с поведением моделей')
+        parser.add_argument('--seed', type=int, default=None, help='Seed для воспроизводимых задержек и ошибок')
+    
+    def handle(self, *args, **options):
+        config = {}
+        if options['config']:
+            try:
+                with open(options['config'], encoding='utf-8') as config_file:
+                    config = json.load(config_file)
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Не удалось прочитать конфигурацию {options['config']}: {e}")
+        
+        server = FakeOpenRouterServer((options['host'], options['port']), config, seed=options['seed'])
+        self.stdout.write(self.style.SUCCESS(f'Fake OpenRouter слушает {server.base_url}'))
+        
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,61 @@
+"""
+Импорт истории сообщений в диалог из JSONL файла
+
+    python manage.py import_messages 42 history.jsonl
+    cat history.jsonl | python manage.py import_messages 42 -
+    python manage.py import_messages 42 history.jsonl --batch-size 5000
+"""
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.models import Conversation
+from chat.services.imports import MessageImporter
+
+
+class Command(BaseCommand):
+    help = 'Импортирует сообщения из JSONL файла (по сообщению в строке) в диалог'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('conversation_id', type=int, help='ID диалога')
+        parser.add_argument('path', help='Путь к JSONL файлу или "-" для stdin')
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=None,
+            help='Количество сообщений в одной пачке bulk_create (по умолчанию CHAT_IMPORT_BATCH_SIZE)'
+        )
+        parser.add_argument(
+            '--max-messages',
+            type=int,
+            default=None,
+            help='Максимум сообщений за импорт (по умолчанию CHAT_IMPORT_MAX_MESSAGES)'
+        )
+    
+    def handle(self, *args, **options):
+        try:
+            conversation = Conversation.objects.get(id=options['conversation_id'])
+        except Conversation.DoesNotExist:
+            raise CommandError(f"Диалог {options['conversation_id']} не найден")
+        
+        importer = MessageImporter(
+            conversation,
+            batch_size=options['batch_size'],
+            max_messages=options['max_messages']
+        )
+        
+        if options['path'] == '-':
+            result = importer.run(sys.stdin)
+        else:
+            try:
+                with open(options['path'], 'rb') as lines:
+                    result = importer.run(lines)
+            except OSError as e:
+                raise CommandError(f"Не удалось открыть файл: {e}")
+        
+        for error in result['errors']:
+            self.stderr.write(f"Строка {error['line']}: {error['errors']}")
+        
+        self.stdout.write(self.style.SUCCESS(
+            f"Импортировано сообщений: {result['imported']}, пропущено строк: {result['skipped']}"
+        ))
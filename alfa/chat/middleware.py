@@ -0,0 +1,64 @@
+"""
+JWT аутентификация для WebSocket соединений (Django Channels)
+"""
+import logging
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.contrib.auth.models import AnonymousUser
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from users.models import User
+
+logger = logging.getLogger(__name__)
+
+
+def get_user_from_token(raw_token):
+    """
+    Возвращает пользователя по access токену или AnonymousUser
+
+    Args:
+        raw_token: Строка JWT access токена
+
+    Returns:
+        User или AnonymousUser, если токен невалиден
+    """
+    if not raw_token:
+        return AnonymousUser()
+
+    try:
+        token = AccessToken(raw_token)
+        user_id = token[api_settings.USER_ID_CLAIM]
+    except (InvalidToken, TokenError, KeyError) as e:
+        logger.info(f"Невалидный JWT токен: {e}")
+        return AnonymousUser()
+
+    try:
+        user = User.objects.get(**{api_settings.USER_ID_FIELD: user_id})
+    except User.DoesNotExist:
+        return AnonymousUser()
+
+    if not user.is_active:
+        return AnonymousUser()
+
+    return user
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    """
+    Аутентифицирует WebSocket по JWT токену
+
+    Браузерный WebSocket API не позволяет передать заголовок Authorization,
+    поэтому токен передается в query string: ws://host/ws/chat/1/?token=<access_token>
+    """
+
+    async def __call__(self, scope, receive, send):
+        query = parse_qs(scope.get('query_string', b'').decode())
+        raw_token = query.get('token', [None])[0]
+
+        scope['user'] = await database_sync_to_async(get_user_from_token)(raw_token)
+
+        return await super().__call__(scope, receive, send)
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-17 06:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_message_processing_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='cache_responses',
+            field=models.BooleanField(default=True, help_text='Разрешить отвечать из кэша на повторяющиеся запросы', verbose_name='Кэшировать ответы'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.8 on 2026-10-17 06:21
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_conversation_cache_responses'),
+        ('users', '0002_alter_user_managers_remove_user_username_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_preview',
+            field=models.CharField(blank=True, max_length=110, verbose_name='Превью последнего сообщения'),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_role',
+            field=models.CharField(blank=True, max_length=20, verbose_name='Роль последнего сообщения'),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='messages_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Количество сообщений'),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['user', '-last_message_at'], name='chat_conver_user_id_539cc6_idx'),
+        ),
+    ]
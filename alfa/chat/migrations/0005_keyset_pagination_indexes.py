@@ -0,0 +1,32 @@
+# Generated by Django 5.2.8 on 2026-10-17 06:26
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_conversation_message_snapshot'),
+        ('users', '0002_alter_user_managers_remove_user_username_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='conversation',
+            name='chat_conver_user_id_539cc6_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='chat_messag_convers_3154fc_idx',
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['user', '-last_message_at', '-id'], name='chat_conver_user_id_4e2dd2_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'created_at', 'id'], name='chat_messag_convers_d98477_idx'),
+        ),
+    ]
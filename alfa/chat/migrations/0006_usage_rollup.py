@@ -0,0 +1,53 @@
+# Generated by Django 5.2.8 on 2026-10-17 06:31
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_keyset_pagination_indexes'),
+        ('users', '0002_alter_user_managers_remove_user_username_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True, verbose_name='Название')),
+                ('last_message_id', models.BigIntegerField(default=0, verbose_name='ID последнего сообщения')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Дата обновления')),
+            ],
+            options={
+                'verbose_name': 'Отметка агрегации',
+                'verbose_name_plural': 'Отметки агрегации',
+            },
+        ),
+        migrations.CreateModel(
+            name='UsageRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='День')),
+                ('messages_count', models.PositiveIntegerField(default=0, verbose_name='Сообщений')),
+                ('user_messages', models.PositiveIntegerField(default=0, verbose_name='Сообщений пользователя')),
+                ('assistant_messages', models.PositiveIntegerField(default=0, verbose_name='Ответов ассистента')),
+                ('tokens_used', models.BigIntegerField(default=0, verbose_name='Использовано токенов')),
+                ('response_time_sum', models.FloatField(default=0, verbose_name='Суммарное время ответа')),
+                ('responses_count', models.PositiveIntegerField(default=0, verbose_name='Ответов с временем')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Дата обновления')),
+                ('business', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='usage_rollups', to='users.business', verbose_name='Бизнес')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='usage_rollups', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Агрегат использования',
+                'verbose_name_plural': 'Агрегаты использования',
+                'ordering': ['-date'],
+                'indexes': [models.Index(fields=['business', 'date'], name='chat_usager_busines_6b18fd_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'business', 'date'), name='chat_usage_rollup_unique')],
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.8 on 2026-10-17 06:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_message_created_at_default'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='client_message_id',
+            field=models.CharField(blank=True, help_text='Ключ идемпотентности отправки, уникален в пределах диалога', max_length=64, null=True, verbose_name='Клиентский ID сообщения'),
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('conversation', 'client_message_id'), name='chat_message_client_id_unique'),
+        ),
+    ]
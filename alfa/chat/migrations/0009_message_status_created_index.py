@@ -0,0 +1,17 @@
+# Generated by Django 5.2.8 on 2026-10-17 06:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_message_client_message_id'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['processing_status', 'created_at'], name='chat_messag_process_408d31_idx'),
+        ),
+    ]
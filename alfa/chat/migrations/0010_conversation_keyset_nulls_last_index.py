@@ -0,0 +1,24 @@
+# Generated by Django 5.2.8 on 2026-10-17 07:55
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_message_status_created_index'),
+        ('users', '0002_alter_user_managers_remove_user_username_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='conversation',
+            name='chat_conver_user_id_4e2dd2_idx',
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(models.F('user'), models.OrderBy(models.F('last_message_at'), descending=True, nulls_last=True), models.OrderBy(models.F('id'), descending=True), name='chat_conv_user_keyset_idx'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.8 on 2026-10-17 08:10
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def backfill_inserted_at(apps, schema_editor):
+    # До импорта истории created_at всегда было временем записи
+    Message = apps.get_model('chat', 'Message')
+    Message.objects.filter(inserted_at__isnull=True).update(inserted_at=F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_conversation_keyset_nulls_last_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='inserted_at',
+            field=models.DateTimeField(null=True, verbose_name='Дата записи'),
+        ),
+        migrations.RunPython(backfill_inserted_at, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='message',
+            name='inserted_at',
+            field=models.DateTimeField(auto_now_add=True, verbose_name='Дата записи'),
+        ),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='chat_messag_convers_d98477_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='chat_messag_process_408d31_idx',
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'inserted_at', 'id'], name='chat_messag_convers_d9073d_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['processing_status', 'inserted_at'], name='chat_messag_process_664f50_idx'),
+        ),
+    ]
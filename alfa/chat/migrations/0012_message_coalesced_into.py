@@ -0,0 +1,37 @@
+# Generated by Django 5.2.8 on 2026-10-17 08:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def move_coalesced_into(apps, schema_editor):
+    # Ведущее сообщение пачки раньше хранилось в metadata['coalesced_into']
+    Message = apps.get_model('chat', 'Message')
+    for message in Message.objects.filter(metadata__has_key='coalesced_into').only('id', 'metadata').iterator():
+        leader_id = message.metadata.pop('coalesced_into')
+        if not Message.objects.filter(id=leader_id).exists():
+            leader_id = None
+        Message.objects.filter(id=message.id).update(coalesced_into_id=leader_id, metadata=message.metadata)
+
+
+def restore_coalesced_into(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+    for message in Message.objects.filter(coalesced_into__isnull=False).only('id', 'metadata', 'coalesced_into'):
+        metadata = {**message.metadata, 'coalesced_into': message.coalesced_into_id}
+        Message.objects.filter(id=message.id).update(metadata=metadata)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_message_inserted_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='coalesced_into',
+            field=models.ForeignKey(blank=True, help_text='Ведущее сообщение пачки, задача которого ответит и на это сообщение', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='coalesced_messages', to='chat.message', verbose_name='Присоединено к'),
+        ),
+        migrations.RunPython(move_coalesced_into, restore_coalesced_into),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.8 on 2026-10-17 08:34
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0012_message_coalesced_into'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='coalesced_into',
+            field=models.ForeignKey(blank=True, db_constraint=False, help_text='Ведущее сообщение пачки, задача которого ответит и на это сообщение', null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='coalesced_messages', to='chat.message', verbose_name='Присоединено к'),
+        ),
+    ]
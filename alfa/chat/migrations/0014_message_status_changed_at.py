@@ -0,0 +1,36 @@
+# Generated by Django 5.2.8 on 2026-10-17 08:44
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def copy_inserted_at(apps, schema_editor):
+    # Незавершенные сообщения сохраняют прежний срок (от времени записи)
+    Message = apps.get_model('chat', 'Message')
+    Message.objects.filter(processing_status__in=['pending', 'processing']).update(
+        status_changed_at=models.F('inserted_at')
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0013_message_coalesced_into_no_constraint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='status_changed_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='Смена статуса обработки'),
+        ),
+        migrations.RunPython(copy_inserted_at, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='chat_messag_process_664f50_idx',
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['processing_status', 'status_changed_at'], name='chat_messag_process_8a931b_idx'),
+        ),
+    ]
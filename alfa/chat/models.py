@@ -1,7 +1,10 @@
 """
 Модели для чата и сообщений с AI ассистентом
 """
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, F, Q, Value, When
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 from users.models import User, Business
@@ -76,6 +79,31 @@ class Conversation(models.Model):
         help_text='Время последнего сообщения в диалоге'
     )
     
+    # Денормализованные данные для списка диалогов (обновляются при создании сообщения)
+    messages_count = models.PositiveIntegerField(
+        _('Количество сообщений'),
+        default=0
+    )
+    
+    last_message_role = models.CharField(
+        _('Роль последнего сообщения'),
+        max_length=20,
+        blank=True
+    )
+    
+    last_message_preview = models.CharField(
+        _('Превью последнего сообщения'),
+        max_length=110,
+        blank=True
+    )
+    
+    # Кэширование ответов AI для одинаковых запросов
+    cache_responses = models.BooleanField(
+        _('Кэшировать ответы'),
+        default=True,
+        help_text='Разрешить отвечать из кэша на повторяющиеся запросы'
+    )
+    
     # Дополнительные данные
     metadata = models.JSONField(
         _('Метаданные'),
@@ -90,6 +118,12 @@ class Conversation(models.Model):
         ordering = ['-last_message_at', '-updated_at']
         indexes = [
             models.Index(fields=['-last_message_at']),
+            # Keyset пагинация списка диалогов по (last_message_at, id): порядок
+            # NULL тот же, что в сортировке списка (диалоги без сообщений в конце)
+            models.Index(
+                F('user'), F('last_message_at').desc(nulls_last=True), F('id').desc(),
+                name='chat_conv_user_keyset_idx'
+            ),
             models.Index(fields=['user', 'status']),
             models.Index(fields=['business', 'status']),
         ]
@@ -173,8 +207,41 @@ class Message(models.Model):
         help_text='Время генерации ответа в секундах'
     )
     
-    # Метаданные
-    created_at = models.DateTimeField(_('Дата создания'), auto_now_add=True)
+    # Ключ идемпотентности от клиента (заголовок Idempotency-Key или поле
+    # client_message_id): повторная отправка возвращает исходное сообщение
+    client_message_id = models.CharField(
+        _('Клиентский ID сообщения'),
+        max_length=64,
+        null=True,
+        blank=True,
+        help_text='Ключ идемпотентности отправки, уникален в пределах диалога'
+    )
+    
+    # Склейка сообщений: сообщение, с которым это генерируется одним ответом.
+    # Без ограничения в БД и без SET NULL: иначе сообщения диалога нельзя
+    # удалить одним DELETE (Django обходит каждое), а висящая ссылка на
+    # удаленное сообщение ничего не ломает
+    coalesced_into = models.ForeignKey(
+        'self',
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        null=True,
+        blank=True,
+        related_name='coalesced_messages',
+        verbose_name=_('Присоединено к'),
+        help_text='Ведущее сообщение пачки, задача которого ответит и на это сообщение'
+    )
+    
+    # Метаданные (default, а не auto_now_add: при импорте истории время сохраняется)
+    created_at = models.DateTimeField(_('Дата создания'), default=timezone.now)
+    
+    # Время записи в БД (всегда серверное, в отличие от created_at при импорте):
+    # по нему идут пагинация и агрегаты использования
+    inserted_at = models.DateTimeField(_('Дата записи'), auto_now_add=True)
+    
+    # Время последней смены статуса обработки (захват задачей, постановка на
+    # повтор): от него считаются сроки зависших сообщений
+    status_changed_at = models.DateTimeField(_('Смена статуса обработки'), default=timezone.now)
     
     # Дополнительные данные
     metadata = models.JSONField(
@@ -189,25 +256,176 @@ class Message(models.Model):
         verbose_name_plural = _('Сообщения')
         ordering = ['created_at']
         indexes = [
-            models.Index(fields=['conversation', 'created_at']),
+            # Keyset пагинация сообщений диалога по (inserted_at, id)
+            models.Index(fields=['conversation', 'inserted_at', 'id']),
             models.Index(fields=['role']),
+            # Поиск зависших сообщений (задача reap_stale_messages)
+            models.Index(fields=['processing_status', 'status_changed_at']),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['conversation', 'client_message_id'],
+                name='chat_message_client_id_unique'
+            ),
         ]
     
     def __str__(self):
         preview = self.content[:50] + '...' if len(self.content) > 50 else self.content
         return f"{self.get_role_display()}: {preview}"
     
+    # Длина превью последнего сообщения в списке диалогов
+    PREVIEW_LENGTH = 100
+    
+    @classmethod
+    def build_preview(cls, content: str) -> str:
+        """Превью текста сообщения для списка диалогов"""
+        return content[:cls.PREVIEW_LENGTH] + ('...' if len(content) > cls.PREVIEW_LENGTH else '')
+    
+    @staticmethod
+    def build_title(content: str) -> str:
+        """Заголовок диалога из первого сообщения пользователя (первые 50 символов)"""
+        return content[:50] + ('...' if len(content) > 50 else '')
+    
     def save(self, *args, **kwargs):
-        """Переопределяем save для обновления last_message_at в диалоге"""
-        super().save(*args, **kwargs)
+        """
+        Сохранение сообщения
+        
+        Диалог обновляется только при создании сообщения. Изменение
+        существующего сообщения (например, статуса обработки) диалог не
+        трогает - статус обработки меняется через
+        chat.services.messages.set_batch_status (один UPDATE).
+        """
+        if not self._state.adding:
+            super().save(*args, **kwargs)
+            return
+        
+        # Новое сообщение: сохранение и обновление диалога в одной транзакции
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            self._touch_conversation()
+    
+    @classmethod
+    def conversation_updates(cls, count: int, latest: 'Message', first_question: 'Message' = None) -> dict:
+        """
+        Выражения UPDATE диалога после добавления count сообщений
+        
+        Счетчик увеличивается на стороне БД (без гонок между воркерами),
+        last_message_at только растет (Greatest), поэтому сообщение с более
+        ранним created_at (например, при импорте) не откатывает время и
+        превью последнего сообщения. Пустой заголовок задается по
+        first_question - первому добавленному сообщению пользователя.
         
-        # Обновляем время последнего сообщения и заголовок в диалоге
-        if self.conversation:
-            self.conversation.last_message_at = self.created_at
-            
-            # Если это первое сообщение пользователя и нет заголовка
-            if not self.conversation.title and self.role == Message.Role.USER:
-                # Генерируем заголовок из первых 50 символов
-                self.conversation.title = self.content[:50] + ('...' if len(self.content) > 50 else '')
-            
-            self.conversation.save(update_fields=['last_message_at', 'title', 'updated_at'])
+        Args:
+            count: Сколько сообщений добавлено
+            latest: Самое позднее по created_at из добавленных сообщений
+            first_question: Самое раннее сообщение пользователя или None
+        """
+        # Сообщение не раньше текущего последнего (или первое в диалоге)
+        is_latest = Q(last_message_at__isnull=True) | Q(last_message_at__lte=latest.created_at)
+        updates = {
+            'messages_count': F('messages_count') + count,
+            'last_message_at': Greatest(
+                Coalesce(F('last_message_at'), Value(latest.created_at)), Value(latest.created_at)
+            ),
+            'last_message_role': Case(When(is_latest, then=Value(latest.role)), default=F('last_message_role')),
+            'last_message_preview': Case(
+                When(is_latest, then=Value(cls.build_preview(latest.content))), default=F('last_message_preview')
+            ),
+            'updated_at': timezone.now(),
+        }
+        if first_question:
+            title = cls.build_title(first_question.content)
+            updates['title'] = Case(When(title='', then=Value(title)), default=F('title'))
+        return updates
+    
+    def _touch_conversation(self):
+        """Обновляет диалог после создания сообщения одним UPDATE (см. conversation_updates)"""
+        is_question = self.role == Message.Role.USER
+        updates = self.conversation_updates(1, self, first_question=self if is_question else None)
+        Conversation.objects.filter(pk=self.conversation_id).update(**updates)
+        
+        # Поддерживаем актуальность загруженного объекта диалога
+        conversation = self.conversation
+        conversation.messages_count += 1
+        if conversation.last_message_at is None or conversation.last_message_at <= self.created_at:
+            conversation.last_message_at = self.created_at
+            conversation.last_message_role = self.role
+            conversation.last_message_preview = self.build_preview(self.content)
+        if is_question and not conversation.title:
+            conversation.title = self.build_title(self.content)
+        conversation.updated_at = updates['updated_at']
+
+
+class UsageRollup(models.Model):
+    """
+    Агрегаты использования AI по пользователю, бизнесу и дню
+    
+    Заполняется периодической задачей rollup_usage по сообщениям после
+    отметки RollupCheckpoint, поэтому статистика не сканирует всю таблицу
+    сообщений. Сообщения после отметки добавляются к агрегатам при чтении
+    (см. chat.services.usage).
+    """
+    
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='usage_rollups',
+        verbose_name=_('Пользователь')
+    )
+    business = models.ForeignKey(
+        Business,
+        on_delete=models.CASCADE,
+        related_name='usage_rollups',
+        null=True,
+        blank=True,
+        verbose_name=_('Бизнес')
+    )
+    date = models.DateField(_('День'))
+    
+    messages_count = models.PositiveIntegerField(_('Сообщений'), default=0)
+    user_messages = models.PositiveIntegerField(_('Сообщений пользователя'), default=0)
+    assistant_messages = models.PositiveIntegerField(_('Ответов ассистента'), default=0)
+    tokens_used = models.BigIntegerField(_('Использовано токенов'), default=0)
+    
+    # Для среднего времени ответа: сумма и количество ответов с измеренным временем
+    response_time_sum = models.FloatField(_('Суммарное время ответа'), default=0)
+    responses_count = models.PositiveIntegerField(_('Ответов с временем'), default=0)
+    
+    updated_at = models.DateTimeField(_('Дата обновления'), auto_now=True)
+    
+    class Meta:
+        verbose_name = _('Агрегат использования')
+        verbose_name_plural = _('Агрегаты использования')
+        ordering = ['-date']
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'business', 'date'], name='chat_usage_rollup_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['business', 'date']),
+        ]
+    
+    def __str__(self):
+        return f"{self.user_id}/{self.business_id or '-'} {self.date}: {self.tokens_used} токенов"
+
+
+class RollupCheckpoint(models.Model):
+    """
+    Отметка (high-water mark) периодической агрегации
+    
+    last_message_id - ID последнего сообщения, учтенного в агрегатах.
+    Обновляется в одной транзакции с агрегатами, поэтому каждое сообщение
+    учитывается ровно один раз.
+    """
+    
+    USAGE = 'usage'
+    
+    name = models.CharField(_('Название'), max_length=50, unique=True)
+    last_message_id = models.BigIntegerField(_('ID последнего сообщения'), default=0)
+    updated_at = models.DateTimeField(_('Дата обновления'), auto_now=True)
+    
+    class Meta:
+        verbose_name = _('Отметка агрегации')
+        verbose_name_plural = _('Отметки агрегации')
+    
+    def __str__(self):
+        return f"{self.name}: {self.last_message_id}"
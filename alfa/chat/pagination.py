@@ -0,0 +1,187 @@
+"""
+Keyset (cursor) пагинация для диалогов и сообщений
+
+В отличие от LIMIT/OFFSET страница выбирается условием по индексируемым
+полям (значение поля сортировки + id), поэтому время запроса и размер
+ответа не зависят от того, насколько далеко пролистан список.
+"""
+import json
+import base64
+import binascii
+from datetime import datetime
+
+from django.db.models import F, Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import ValidationError
+
+
+class KeysetPagination:
+    """
+    Пагинация по паре (field, id)
+    
+    Список упорядочен по field (по убыванию при descending=True), затем по id
+    в том же направлении; записи с field = NULL идут в конце списка.
+    
+    Параметры запроса:
+        limit  - размер страницы (не больше max_limit)
+        after  - курсор: записи после него в порядке списка
+        before - курсор: записи перед ним в порядке списка
+    
+    Без курсора возвращается начало списка, а при tail_first=True - его
+    конец (например, последние сообщения диалога).
+    """
+    
+    def __init__(self, field: str, descending: bool, default_limit: int = 20, max_limit: int = 100,
+                 tail_first: bool = False):
+        self.field = field
+        self.descending = descending
+        self.default_limit = default_limit
+        self.max_limit = max_limit
+        self.tail_first = tail_first
+    
+    # Курсоры
+    
+    def encode_cursor(self, obj) -> str:
+        value = getattr(obj, self.field)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        payload = json.dumps([value, obj.pk], separators=(',', ':'))
+        return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+    
+    def decode_cursor(self, cursor: str, param: str):
+        try:
+            padded = cursor + '=' * (-len(cursor) % 4)
+            value, pk = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+            if value is not None:
+                value = parse_datetime(value)
+                if value is None:
+                    raise ValueError
+            return value, int(pk)
+        except (ValueError, TypeError, binascii.Error, UnicodeDecodeError):
+            raise ValidationError({param: ['Некорректный курсор']})
+    
+    # Условия и сортировка
+    
+    def _lookup(self, forward: bool):
+        """Операторы сравнения для движения по списку вперед/назад"""
+        goes_down = self.descending == forward
+        return 'lt' if goes_down else 'gt'
+    
+    def _range(self, value, pk, lookup: str) -> Q:
+        """
+        (field, id) строго после (value, pk) по lookup
+        
+        Нестрогое условие по field - граница диапазона для индекса,
+        OR уточняет ее внутри записей с field = value.
+        """
+        return Q(**{f'{self.field}__{lookup}e': value}) & (
+            Q(**{f'{self.field}__{lookup}': value})
+            | Q(**{self.field: value, f'pk__{lookup}': pk})
+        )
+    
+    def _segments(self, cursor, forward: bool, nullable: bool):
+        """
+        Условия выборки в порядке движения по списку
+        
+        Записи с field = NULL идут отдельным хвостом списка, поэтому выборка
+        через границу значений и NULL делится на два запроса. Каждый - один
+        диапазон индекса без OR по isnull, второй выполняется, только если
+        первый не заполнил страницу.
+        """
+        if cursor is None:
+            return [Q()]
+        
+        value, pk = cursor
+        lookup = self._lookup(forward)
+        if value is None:
+            nulls = Q(**{f'{self.field}__isnull': True, f'pk__{lookup}': pk})
+            return [nulls] if forward else [nulls, Q(**{f'{self.field}__isnull': False})]
+        
+        if forward and nullable:
+            return [self._range(value, pk, lookup), Q(**{f'{self.field}__isnull': True})]
+        return [self._range(value, pk, lookup)]
+    
+    def _ordering(self, forward: bool, nullable: bool = True):
+        """
+        Сортировка в направлении выборки
+        
+        Совпадает с индексами: (user, last_message_at DESC NULLS LAST, id DESC)
+        у диалогов и (conversation, created_at, id) у сообщений - выборка
+        назад читает тот же индекс в обратную сторону. Для поля без NULL
+        NULLS FIRST/LAST не указываются, иначе порядок не совпадет с индексом.
+        """
+        goes_down = self.descending == forward
+        if not nullable:
+            if goes_down:
+                return [F(self.field).desc(), F('pk').desc()]
+            return [F(self.field).asc(), F('pk').asc()]
+        if goes_down:
+            return [F(self.field).desc(nulls_last=True), F('pk').desc()]
+        return [F(self.field).asc(nulls_first=True), F('pk').asc()]
+    
+    def _limit(self, request) -> int:
+        raw = request.query_params.get('limit')
+        if raw in (None, ''):
+            return self.default_limit
+        try:
+            limit = int(raw)
+        except ValueError:
+            raise ValidationError({'limit': ['Должно быть целым числом']})
+        if limit < 1:
+            raise ValidationError({'limit': ['Должно быть больше 0']})
+        return min(limit, self.max_limit)
+    
+    def paginate(self, queryset, request):
+        """
+        Возвращает страницу списка
+        
+        Returns:
+            (объекты страницы в порядке списка, данные пагинации):
+            {
+                'limit': int,
+                'before': курсор первого объекта страницы или None,
+                'after': курсор последнего объекта страницы или None,
+                'has_more_before': есть ли записи перед страницей,
+                'has_more_after': есть ли записи после страницы
+            }
+        """
+        limit = self._limit(request)
+        after = request.query_params.get('after')
+        before = request.query_params.get('before')
+        
+        if after and before:
+            raise ValidationError({'before': ['Нельзя передавать before и after одновременно']})
+        
+        if after:
+            cursor, forward = self.decode_cursor(after, 'after'), True
+        elif before:
+            cursor, forward = self.decode_cursor(before, 'before'), False
+        else:
+            cursor, forward = None, not self.tail_first
+        
+        nullable = queryset.model._meta.get_field(self.field).null
+        ordering = self._ordering(forward, nullable)
+        
+        # Лишняя запись показывает, есть ли продолжение в направлении выборки
+        items = []
+        for condition in self._segments(cursor, forward, nullable):
+            items += queryset.filter(condition).order_by(*ordering)[:limit + 1 - len(items)]
+            if len(items) > limit:
+                break
+        has_more = len(items) > limit
+        items = items[:limit]
+        if not forward:
+            items.reverse()
+        
+        if forward:
+            has_more_after, has_more_before = has_more, bool(after)
+        else:
+            has_more_after, has_more_before = bool(before), has_more
+        
+        return items, {
+            'limit': limit,
+            'before': self.encode_cursor(items[0]) if items else None,
+            'after': self.encode_cursor(items[-1]) if items else None,
+            'has_more_before': has_more_before,
+            'has_more_after': has_more_after,
+        }
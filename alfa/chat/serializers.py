@@ -1,6 +1,7 @@
 """
 Serializers для чата и сообщений
 """
+from django.utils import timezone
 from rest_framework import serializers
 from chat.models import Conversation, Message
 from users.serializers import BusinessSerializer
@@ -18,11 +19,12 @@ class MessageSerializer(serializers.ModelSerializer):
         fields = [
             'id', 'role', 'role_display', 'content', 
             'model', 'tokens_used', 'response_time', 'created_at',
-            'processing_status', 'processing_status_display'
+            'processing_status', 'processing_status_display', 'client_message_id'
         ]
         read_only_fields = [
             'id', 'role_display', 'model', 'tokens_used', 
-            'response_time', 'created_at', 'processing_status', 'processing_status_display'
+            'response_time', 'created_at', 'processing_status', 'processing_status_display',
+            'client_message_id'
         ]
 
 
@@ -30,10 +32,12 @@ class MessageCreateSerializer(serializers.ModelSerializer):
     """
     Serializer для создания сообщения пользователя
     """
+    # Ключ идемпотентности (также принимается из заголовка Idempotency-Key)
+    client_message_id = serializers.CharField(required=False, max_length=64)
     
     class Meta:
         model = Message
-        fields = ['content']
+        fields = ['content', 'client_message_id']
     
     def validate_content(self, value):
         """Валидация содержимого сообщения"""
@@ -44,6 +48,35 @@ class MessageCreateSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("Сообщение слишком длинное (максимум 4000 символов)")
         
         return value.strip()
+    
+    def validate(self, attrs):
+        """Ключ из заголовка Idempotency-Key (context) имеет приоритет над полем"""
+        idempotency_key = self.context.get('idempotency_key')
+        if idempotency_key:
+            try:
+                attrs['client_message_id'] = self.fields['client_message_id'].run_validation(idempotency_key)
+            except serializers.ValidationError as e:
+                raise serializers.ValidationError({'client_message_id': e.detail})
+        return attrs
+
+
+class MessageImportSerializer(serializers.Serializer):
+    """
+    Serializer одной строки JSONL при импорте истории сообщений
+    """
+    role = serializers.ChoiceField(choices=[Message.Role.USER, Message.Role.ASSISTANT])
+    content = serializers.CharField()
+    created_at = serializers.DateTimeField(required=False)
+    model = serializers.CharField(required=False, allow_blank=True, max_length=100, default='')
+    tokens_used = serializers.IntegerField(required=False, allow_null=True, min_value=0)
+    response_time = serializers.FloatField(required=False, allow_null=True, min_value=0)
+    metadata = serializers.DictField(required=False, default=dict)
+    
+    def validate_created_at(self, value):
+        """Время сообщения не может быть в будущем"""
+        if value > timezone.now():
+            raise serializers.ValidationError("Время сообщения не может быть в будущем")
+        return value
 
 
 class ConversationSerializer(serializers.ModelSerializer):
@@ -52,7 +85,6 @@ class ConversationSerializer(serializers.ModelSerializer):
     """
     category_display = serializers.CharField(source='get_category_display', read_only=True)
     status_display = serializers.CharField(source='get_status_display', read_only=True)
-    messages_count = serializers.IntegerField(source='get_messages_count', read_only=True)
     last_message = serializers.SerializerMethodField()
     business_name = serializers.CharField(source='business.name', read_only=True, allow_null=True)
     
@@ -71,13 +103,12 @@ class ConversationSerializer(serializers.ModelSerializer):
         ]
     
     def get_last_message(self, obj):
-        """Возвращает последнее сообщение в диалоге"""
-        last_msg = obj.get_last_message()
-        if last_msg:
+        """Возвращает последнее сообщение в диалоге (из денормализованных полей)"""
+        if obj.messages_count:
             return {
-                'role': last_msg.role,
-                'content': last_msg.content[:100] + ('...' if len(last_msg.content) > 100 else ''),
-                'created_at': last_msg.created_at
+                'role': obj.last_message_role,
+                'content': obj.last_message_preview,
+                'created_at': obj.last_message_at
             }
         return None
 
@@ -120,25 +151,26 @@ class ConversationCreateSerializer(serializers.ModelSerializer):
 
 class ConversationDetailSerializer(serializers.ModelSerializer):
     """
-    Детальный serializer для диалога с сообщениями
+    Детальный serializer для диалога
+    
+    Сообщения не включаются: длинный диалог отдается постранично
+    (GET /api/chat/conversations/{id}/messages/)
     """
-    messages = MessageSerializer(many=True, read_only=True)
     category_display = serializers.CharField(source='get_category_display', read_only=True)
     status_display = serializers.CharField(source='get_status_display', read_only=True)
     business_detail = BusinessSerializer(source='business', read_only=True)
-    messages_count = serializers.IntegerField(source='get_messages_count', read_only=True)
     
     class Meta:
         model = Conversation
         fields = [
             'id', 'title', 'category', 'category_display',
             'status', 'status_display', 'business', 'business_detail',
-            'messages_count', 'messages', 'last_message_at',
-            'created_at', 'updated_at', 'metadata'
+            'messages_count', 'last_message_at',
+            'cache_responses', 'created_at', 'updated_at', 'metadata'
         ]
         read_only_fields = [
             'id', 'title', 'category_display', 'status_display',
-            'messages_count', 'messages', 'last_message_at',
+            'messages_count', 'last_message_at',
             'created_at', 'updated_at'
         ]
 
@@ -150,5 +182,16 @@ class ConversationUpdateSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = Conversation
-        fields = ['title', 'category', 'status']
+        fields = ['title', 'category', 'status', 'cache_responses']
+    
+    def update(self, instance, validated_data):
+        """
+        Сохраняет только переданные поля: счетчик и последнее сообщение
+        обновляет создание сообщения, а полное сохранение перезаписало бы
+        их устаревшими значениями загруженного объекта
+        """
+        for field, value in validated_data.items():
+            setattr(instance, field, value)
+        instance.save(update_fields=[*validated_data, 'updated_at'])
+        return instance
 
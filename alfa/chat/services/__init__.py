@@ -3,6 +3,7 @@
 """
 from .llm_service import LLMService
 from .prompt_builder import PromptBuilder
+from .events import ChatEvents, DeltaPublisher, publish_event
+from .response_cache import ResponseCache
 
-__all__ = ['LLMService', 'PromptBuilder']
-
+__all__ = ['LLMService', 'PromptBuilder', 'ChatEvents', 'DeltaPublisher', 'publish_event', 'ResponseCache']
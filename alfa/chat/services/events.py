@@ -0,0 +1,120 @@
+"""
+Публикация событий чата через channel layer (Redis)
+
+События рассылаются в группу диалога и доставляются клиентам через
+WebSocket (ChatConsumer).
+"""
+import time
+import logging
+from typing import Dict, Optional
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class ChatEvents:
+    """
+    Типы событий, которые получает клиент
+    """
+    MESSAGE_CREATED = 'message.created'
+    MESSAGE_STATUS = 'message.status'
+    MESSAGE_DELTA = 'message.delta'
+    MESSAGE_RESET = 'message.reset'
+    MESSAGE_RETRYING = 'message.retrying'
+    MESSAGE_COMPLETED = 'message.completed'
+    ERROR = 'error'
+
+
+def conversation_group_name(conversation_id) -> str:
+    """Имя группы channel layer для диалога"""
+    return f'chat_{conversation_id}'
+
+
+def publish_event(conversation_id, event: str, data: Optional[Dict] = None) -> bool:
+    """
+    Отправляет событие всем подписчикам диалога
+
+    Ошибки channel layer не пробрасываются: генерация ответа не должна
+    падать из-за недоступности Redis, клиент всегда может получить
+    результат через REST API.
+
+    Returns:
+        True если событие отправлено
+    """
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return False
+
+    try:
+        async_to_sync(channel_layer.group_send)(
+            conversation_group_name(conversation_id),
+            {
+                'type': 'chat.event',
+                'event': event,
+                'data': data or {},
+            }
+        )
+    except Exception as e:
+        logger.warning(f"Не удалось отправить событие {event} для диалога {conversation_id}: {e}")
+        return False
+
+    return True
+
+
+class DeltaPublisher:
+    """
+    Буферизирует фрагменты ответа LLM и публикует их пачками
+
+    Отправка каждого токена отдельным сообщением через Redis слишком дорогая,
+    поэтому фрагменты копятся не дольше CHAT_STREAM_FLUSH_INTERVAL секунд.
+    Экземпляр передается в LLMService.generate_response как on_delta.
+    """
+
+    def __init__(self, conversation_id, message_id, flush_interval: Optional[float] = None):
+        self.conversation_id = conversation_id
+        self.message_id = message_id
+        self.flush_interval = (
+            settings.CHAT_STREAM_FLUSH_INTERVAL if flush_interval is None else flush_interval
+        )
+        self._buffer = []
+        self._last_flush = time.monotonic()
+        self._index = 0
+
+    def __call__(self, text: str):
+        """Принимает очередной фрагмент ответа"""
+        if not text:
+            return
+
+        self._buffer.append(text)
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Публикует накопленные фрагменты"""
+        self._last_flush = time.monotonic()
+        if not self._buffer:
+            return
+
+        delta = ''.join(self._buffer)
+        self._buffer = []
+
+        publish_event(self.conversation_id, ChatEvents.MESSAGE_DELTA, {
+            'message_id': self.message_id,
+            'index': self._index,
+            'delta': delta,
+        })
+        self._index += 1
+
+    def reset(self):
+        """
+        Сбрасывает частичный ответ (модель упала посреди стрима
+        и генерация продолжается на fallback модели)
+        """
+        self._buffer = []
+        self._index = 0
+        publish_event(self.conversation_id, ChatEvents.MESSAGE_RESET, {
+            'message_id': self.message_id,
+        })
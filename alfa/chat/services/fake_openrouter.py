@@ -0,0 +1,258 @@
+"""
+Локальная замена OpenRouter API для нагрузочного тестирования и работы без сети
+
+OpenAI-совместимый HTTP сервер (POST /chat/completions, GET /models):
+обычные и потоковые ответы с usage, задержки из заданного распределения
+и ошибки 429 / таймаут / 404 по моделям. LLMService переключается на
+него через OPENROUTER_BASE_URL, например http://localhost:8090/api/v1.
+
+Поведение моделей задается словарем (или JSON файлом команды fake_openrouter):
+
+    {
+        "default": {"latency": {"distribution": "lognormal", "median": 0.8, "sigma": 0.5}},
+        "models": {
+            "google/gemma-3-4b-it:free": {"rate_limit": 0.3, "retry_after": 10},
+            "meta-llama/llama-3.3-8b-instruct:free": {"timeout": 0.1},
+            "qwen/qwen3-4b:free": {"not_found": true}
+        }
+    }
+
+Параметры модели (дополняют "default"):
+    latency: Задержка до первого токена (для обычного ответа - до ответа):
+        число секунд или {"distribution": "fixed|uniform|normal|lognormal", ...}
+    token_delay: Пауза между фрагментами потокового ответа (так же)
+    completion_tokens: Длина ответа в токенах (не больше max_tokens запроса)
+    rate_limit: Вероятность ответа 429, retry_after - его заголовок Retry-After
+    timeout: Вероятность зависнуть на hang секунд без ответа
+    not_found: Отвечать 404 (модель недоступна)
+"""
+import json
+import logging
+import random
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .tokens import count_message_tokens
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BEHAVIOR = {
+    'latency': 0.5,
+    'token_delay': 0.02,
+    'completion_tokens': 120,
+    'rate_limit': 0.0,
+    'retry_after': 5,
+    'timeout': 0.0,
+    'hang': 600,
+    'not_found': False,
+}
+
+WORDS = (
+    'для', 'бизнеса', 'важно', 'понимать', 'клиентов', 'рынок', 'и', 'расходы',
+    'начните', 'с', 'простого', 'плана', 'продаж', 'затем', 'проверьте', 'гипотезы',
+)
+
+
+class ModelBehavior:
+    """Поведение одной модели: задержки, длина ответа и вероятности ошибок"""
+    
+    def __init__(self, options: Dict, rng: random.Random):
+        self.options = {**DEFAULT_BEHAVIOR, **options}
+        self.rng = rng
+    
+    def __getitem__(self, name):
+        return self.options[name]
+    
+    def sample(self, name: str) -> float:
+        """Значение задержки из ее распределения (секунды, не меньше 0)"""
+        spec = self.options[name]
+        if not isinstance(spec, dict):
+            return max(float(spec), 0.0)
+        
+        distribution = spec.get('distribution', 'fixed')
+        if distribution == 'fixed':
+            value = spec['value']
+        elif distribution == 'uniform':
+            value = self.rng.uniform(spec['min'], spec['max'])
+        elif distribution == 'normal':
+            value = self.rng.gauss(spec['mean'], spec['stddev'])
+        elif distribution == 'lognormal':
+            value = spec['median'] * self.rng.lognormvariate(0, spec['sigma'])
+        else:
+            raise ValueError(f'Неизвестное распределение задержки: {distribution}')
+        return max(value, 0.0)
+    
+    def outcome(self) -> Optional[str]:
+        """Ошибка, которую надо вернуть на этот запрос (или None)"""
+        if self.options['not_found']:
+            return 'not_found'
+        roll = self.rng.random()
+        if roll < self.options['rate_limit']:
+            return 'rate_limit'
+        if roll < self.options['rate_limit'] + self.options['timeout']:
+            return 'timeout'
+        return None
+
+
+class FakeOpenRouterServer(ThreadingHTTPServer):
+    """
+    HTTP сервер, каждый запрос обрабатывается в своем потоке
+    
+    Args:
+        address: (host, port); порт 0 - любой свободный
+        config: {'default': {...}, 'models': {'модель': {...}}}
+        seed: Seed генератора случайных чисел (для воспроизводимых прогонов)
+    """
+    
+    daemon_threads = True
+    
+    def __init__(self, address: Tuple[str, int], config: Optional[Dict] = None, seed: Optional[int] = None):
+        super().__init__(address, FakeOpenRouterHandler)
+        config = config or {}
+        self.default = config.get('default', {})
+        self.models = config.get('models', {})
+        self.rng = random.Random(seed)
+    
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/api/v1'
+    
+    def behavior(self, model: str) -> ModelBehavior:
+        return ModelBehavior({**self.default, **self.models.get(model, {})}, self.rng)
+
+
+class FakeOpenRouterHandler(BaseHTTPRequestHandler):
+    """Обработчик OpenAI-совместимых запросов"""
+    
+    protocol_version = 'HTTP/1.1'
+    server: FakeOpenRouterServer
+    
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+    
+    def do_GET(self):
+        if not self.path.rstrip('/').endswith('/models'):
+            return self._send_error(404, f'Unknown path {self.path}')
+        models = [{'id': model, 'object': 'model'} for model in self.server.models]
+        self._send_json(200, {'object': 'list', 'data': models})
+    
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            payload = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            return self._send_error(400, 'Invalid JSON body')
+        
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            return self._send_error(404, f'Unknown path {self.path}')
+        
+        model = payload.get('model', '')
+        behavior = self.server.behavior(model)
+        outcome = behavior.outcome()
+        
+        if outcome == 'not_found':
+            return self._send_error(404, f'No endpoints found for {model}.')
+        
+        if outcome == 'rate_limit':
+            retry_after = behavior['retry_after']
+            return self._send_error(429, f'Rate limit exceeded: {model}', headers={
+                'Retry-After': str(retry_after),
+                'X-RateLimit-Reset': str(int((time.time() + retry_after) * 1000)),
+            })
+        
+        if outcome == 'timeout':
+            # Клиент должен отвалиться по своему таймауту
+            time.sleep(behavior['hang'])
+            self.close_connection = True
+            return
+        
+        prompt_tokens = sum(count_message_tokens(message) for message in payload.get('messages', []))
+        completion_tokens = behavior['completion_tokens']
+        finish_reason = 'stop'
+        if payload.get('max_tokens') and completion_tokens > payload['max_tokens']:
+            completion_tokens = payload['max_tokens']
+            finish_reason = 'length'
+        words = [WORDS[i % len(WORDS)] for i in range(completion_tokens)]
+        usage = {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
+        }
+        completion_id = f'gen-{uuid.uuid4().hex}'
+        
+        time.sleep(behavior.sample('latency'))
+        
+        if payload.get('stream'):
+            include_usage = (payload.get('stream_options') or {}).get('include_usage', False)
+            chunks = self._stream_chunks(
+                completion_id, model, words, finish_reason, usage if include_usage else None, behavior
+            )
+            return self._send_stream(chunks)
+        
+        self._send_json(200, {
+            'id': completion_id,
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': model,
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': ' '.join(words)},
+                'finish_reason': finish_reason,
+            }],
+            'usage': usage,
+        })
+    
+    def _stream_chunks(self, completion_id: str, model: str, words: List[str], finish_reason: str,
+                       usage: Optional[Dict], behavior: ModelBehavior) -> Iterator[Dict]:
+        base = {'id': completion_id, 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model}
+        
+        for index, word in enumerate(words):
+            if index:
+                time.sleep(behavior.sample('token_delay'))
+            content = word if index == 0 else f' {word}'
+            yield {**base, 'choices': [{'index': 0, 'delta': {'content': content}, 'finish_reason': None}]}
+        
+        yield {**base, 'choices': [{'index': 0, 'delta': {}, 'finish_reason': finish_reason}]}
+        
+        # Как у OpenAI: usage приходит последним чанком с пустым choices
+        if usage:
+            yield {**base, 'choices': [], 'usage': usage}
+    
+    def _send_stream(self, chunks: Iterator[Dict]):
+        """Server-sent events в chunked ответе (соединение остается keep-alive)"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        
+        try:
+            for chunk in chunks:
+                self._write_chunk(f'data: {json.dumps(chunk, ensure_ascii=False)}\n\n')
+            self._write_chunk('data: [DONE]\n\n')
+            self.wfile.write(b'0\r\n\r\n')
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # Клиент закрыл поток (например, проигравшая hedged попытка)
+            self.close_connection = True
+    
+    def _write_chunk(self, text: str):
+        data = text.encode('utf-8')
+        self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+        self.wfile.flush()
+    
+    def _send_json(self, status: int, body: Dict, headers: Optional[Dict[str, str]] = None):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+    
+    def _send_error(self, status: int, message: str, headers: Optional[Dict[str, str]] = None):
+        self._send_json(status, {'error': {'message': message, 'code': status}}, headers=headers)
@@ -0,0 +1,208 @@
+"""
+Конвейер генерации ответа ассистента: промпт -> модель -> сохранение
+
+Результат каждой дорогой стадии сохраняется в metadata['generation']
+первого сообщения пачки, поэтому повтор задачи после сбоя продолжает с
+упавшей стадии: ответ модели не запрашивается второй раз, а сообщение
+ассистента не создается дважды.
+"""
+import logging
+from typing import Callable, Dict, List, Optional
+
+from django.conf import settings
+from django.db import InterfaceError, OperationalError, connection, transaction
+
+from chat.models import Message
+from .llm_service import LLMService
+from .messages import set_batch_status
+
+logger = logging.getLogger(__name__)
+
+
+class GenerationStage:
+    """Стадии конвейера генерации"""
+    PROMPT = 'prompt'
+    MODEL = 'model'
+    PERSIST = 'persist'
+
+
+# Ошибки всей цепочки моделей, после которых есть смысл повторить задачу позже
+RETRYABLE_MODEL_ERRORS = ('rate_limit', 'timeout')
+
+
+class GenerationError(Exception):
+    """
+    Ошибка стадии конвейера генерации
+    
+    Attributes:
+        stage: Стадия, на которой произошла ошибка (GenerationStage)
+        error_type: Тип ошибки (rate_limit, timeout, database, ...)
+        retryable: Имеет ли смысл повторить задачу
+        fallback: Ответ с извинением от LLMService, который сохраняется,
+            если повторов больше не будет (только для стадии модели)
+    """
+    
+    def __init__(self, stage: str, error_type: str, retryable: bool, fallback: Optional[Dict] = None):
+        super().__init__(f'{stage}: {error_type}')
+        self.stage = stage
+        self.error_type = error_type
+        self.retryable = retryable
+        self.fallback = fallback
+    
+    def as_dict(self) -> Dict:
+        return {'stage': self.stage, 'error_type': self.error_type, 'retryable': self.retryable}
+
+
+def _database_error(stage: str, error: Exception) -> GenerationError:
+    """Сбой соединения с БД повторяем, ошибки данных - нет"""
+    retryable = isinstance(error, (OperationalError, InterfaceError))
+    return GenerationError(stage, 'database' if retryable else type(error).__name__, retryable)
+
+
+class GenerationPipeline:
+    """
+    Генерация одного ответа на пачку сообщений пользователя
+    
+    Чекпоинт metadata['generation'] первого сообщения пачки:
+        {'stage': 'model', 'response': {...}}        - ответ модели получен
+        {'stage': 'persist', 'assistant_message_id'} - ответ сохранен
+    
+    keepalive вызывается перед запросом к модели и перед сохранением
+    ответа (задача продлевает блокировки диалога и пользователя).
+    """
+    
+    CHECKPOINT_KEY = 'generation'
+    
+    def __init__(self, batch: List[Message], llm_service: LLMService,
+                 on_delta: Optional[Callable[[str], None]] = None,
+                 keepalive: Optional[Callable[[], None]] = None):
+        self.batch = batch
+        self.leader = batch[0]
+        self.conversation = self.leader.conversation
+        self.user_message = batch[-1]
+        self.llm_service = llm_service
+        self.on_delta = on_delta
+        self.keepalive = keepalive
+    
+    @property
+    def checkpoint(self) -> Dict:
+        return (self.leader.metadata or {}).get(self.CHECKPOINT_KEY) or {}
+    
+    def run(self) -> Message:
+        """
+        Выполняет стадии, начиная с первой незавершенной
+        
+        Returns:
+            Сообщение ассистента
+        
+        Raises:
+            GenerationError: Стадия не выполнена
+        """
+        checkpoint = self.checkpoint
+        
+        if checkpoint.get('stage') == GenerationStage.PERSIST:
+            assistant_message = Message.objects.filter(id=checkpoint['assistant_message_id']).first()
+            if assistant_message:
+                logger.info(f"Ответ для сообщения {self.leader.id} уже сохранен, генерация пропущена")
+                set_batch_status(self.batch, Message.ProcessingStatus.COMPLETED)
+                return assistant_message
+        
+        if checkpoint.get('stage') == GenerationStage.MODEL:
+            logger.info(f"Ответ модели для сообщения {self.leader.id} взят из чекпоинта")
+            response = checkpoint['response']
+        else:
+            messages = self._build_prompt()
+            self._release_connection()
+            self._keep_alive()
+            response = self._call_model(messages)
+        
+        return self.persist(response)
+    
+    def _build_prompt(self) -> List[Dict[str, str]]:
+        try:
+            return self.llm_service.build_prompt(self.conversation)
+        except Exception as e:
+            raise _database_error(GenerationStage.PROMPT, e) from e
+    
+    def _keep_alive(self):
+        if self.keepalive:
+            self.keepalive()
+    
+    def _release_connection(self):
+        """
+        Закрывает соединение с БД на время ожидания модели
+        
+        Следующий запрос к БД (сохранение ответа) откроет соединение заново.
+        Внутри транзакции соединение не закрывается.
+        """
+        if settings.CHAT_GENERATION_RELEASE_DB and not connection.in_atomic_block:
+            connection.close()
+    
+    def _call_model(self, messages: List[Dict[str, str]]) -> Dict:
+        """
+        Запрос к цепочке моделей
+        
+        LLMService сам перебирает модели и при общей неудаче возвращает
+        ответ с извинением: при временной ошибке (rate limit, timeout)
+        это GenerationError с fallback, при остальных - обычный ответ.
+        """
+        try:
+            response = self.llm_service.generate_response(
+                conversation=self.conversation,
+                user_message=self.user_message,
+                on_delta=self.on_delta,
+                messages=messages
+            )
+        except Exception as e:
+            raise GenerationError(GenerationStage.MODEL, LLMService.classify_error(e), retryable=True) from e
+        
+        metadata = response.get('metadata') or {}
+        if metadata.get('error') and metadata.get('error_type') in RETRYABLE_MODEL_ERRORS:
+            raise GenerationError(GenerationStage.MODEL, metadata['error_type'], retryable=True, fallback=response)
+        
+        try:
+            self._save_checkpoint({'stage': GenerationStage.MODEL, 'response': response})
+        except Exception as e:
+            # Без чекпоинта повтор запросит модель снова, но ответ еще можно сохранить
+            logger.warning(f"Не удалось сохранить чекпоинт ответа для сообщения {self.leader.id}: {e}")
+        
+        return response
+    
+    def persist(self, response: Dict) -> Message:
+        """
+        Сохраняет сообщение ассистента и завершает пачку в одной транзакции
+        
+        Raises:
+            GenerationError: Ошибка БД (ответ модели остается в чекпоинте)
+        """
+        self._keep_alive()
+        metadata = self.leader.metadata
+        try:
+            with transaction.atomic():
+                assistant_message = LLMService.create_assistant_message(
+                    conversation=self.conversation,
+                    response_data=response
+                )
+                self._save_checkpoint({
+                    'stage': GenerationStage.PERSIST,
+                    'assistant_message_id': assistant_message.id,
+                })
+                set_batch_status(self.batch, Message.ProcessingStatus.COMPLETED)
+        except Exception as e:
+            # Транзакция откачена: в памяти тоже остается прежний чекпоинт
+            self.leader.metadata = metadata
+            raise _database_error(GenerationStage.PERSIST, e) from e
+        
+        return assistant_message
+    
+    def record_error(self, error: GenerationError):
+        """Сохраняет ошибку в чекпоинт (ответ модели, если был, сохраняется)"""
+        try:
+            self._save_checkpoint({**self.checkpoint, 'error': error.as_dict()})
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить ошибку генерации для сообщения {self.leader.id}: {e}")
+    
+    def _save_checkpoint(self, checkpoint: Dict):
+        metadata = {**(self.leader.metadata or {}), self.CHECKPOINT_KEY: checkpoint}
+        Message.objects.filter(pk=self.leader.pk).update(metadata=metadata)
+        self.leader.metadata = metadata
@@ -0,0 +1,226 @@
+"""
+Hedged запросы к нескольким моделям с отменой проигравших
+
+Если основная модель не выдала первый токен за LLM_HEDGE_AFTER секунд,
+параллельно запускается следующая модель из цепочки. Побеждает модель,
+первой выдавшая токен, остальные запросы закрываются.
+"""
+import time
+import queue
+import logging
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .rate_limits import ModelRateLimited
+
+logger = logging.getLogger(__name__)
+
+
+class HedgeCancelled(Exception):
+    """Попытка отменена: другая модель ответила раньше"""
+
+
+class HedgeAttempt:
+    """
+    Одна попытка в hedged запросе
+
+    Передается в LLMService._consume_stream вместо on_delta: фрагменты
+    пересылаются клиенту только если эта попытка стала победителем.
+    """
+
+    def __init__(self, request: 'HedgedRequest', model: str, index: int):
+        self.request = request
+        self.model = model
+        self.index = index
+        self.stream = None
+        self.started_at = time.time()
+        self.cancelled = threading.Event()
+
+    def __call__(self, text: str):
+        if not self.request.claim(self):
+            raise HedgeCancelled()
+        if self.request.on_delta is not None:
+            self.request.on_delta(text)
+
+    def reset(self):
+        if self.request.winner is self and hasattr(self.request.on_delta, 'reset'):
+            self.request.on_delta.reset()
+
+    def flush(self):
+        if self.request.winner is self and hasattr(self.request.on_delta, 'flush'):
+            self.request.on_delta.flush()
+
+    def cancel(self):
+        """Отменяет попытку, закрывая HTTP соединение потока"""
+        self.cancelled.set()
+        stream = self.stream
+        if stream is not None:
+            try:
+                stream.close()
+            except Exception:
+                # Поток может закрываться одновременно из рабочего потока
+                pass
+
+
+class HedgedRequest:
+    """
+    Выполняет потоковый запрос с hedging по цепочке моделей
+
+    Args:
+        service: LLMService (используются _open_stream, _consume_stream, health)
+        models: Упорядоченная цепочка моделей
+        messages: История сообщений
+        temperature: Параметр креативности
+        max_tokens: Максимум токенов ответа
+        on_delta: Callback фрагментов ответа победителя (может быть None)
+        hedge_after: Через сколько секунд без первого токена запускать следующую модель
+        max_hedges: Максимум дополнительных параллельных запросов
+    """
+
+    def __init__(
+        self,
+        service,
+        models: List[str],
+        messages: List[Dict[str, str]],
+        temperature: float,
+        max_tokens: int,
+        on_delta: Optional[Callable[[str], None]],
+        hedge_after: float,
+        max_hedges: int
+    ):
+        self.service = service
+        self.models = models
+        self.messages = messages
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.on_delta = on_delta
+        self.hedge_after = hedge_after
+        self.max_hedges = max_hedges
+
+        self.winner = None
+        self.launched = 0
+        self.hedges_issued = 0
+        self.last_error = None
+
+        self._lock = threading.Lock()
+        self._events = queue.Queue()
+        self._active = []
+
+    def claim(self, attempt: HedgeAttempt) -> bool:
+        """Пытается сделать попытку победителем; True если она победитель"""
+        with self._lock:
+            if self.winner is None:
+                self.winner = attempt
+                self._events.put(('won', attempt, None))
+            return self.winner is attempt
+
+    def run(self) -> Tuple[Optional[Dict], Optional[HedgeAttempt]]:
+        """
+        Выполняет запрос
+
+        Returns:
+            (ответ модели, попытка-победитель) или (None, None) если все модели не ответили
+        """
+        stop_launching = False
+        self._launch()
+
+        while True:
+            can_hedge = (
+                self.winner is None
+                and not stop_launching
+                and self.hedges_issued < self.max_hedges
+                and self.launched < len(self.models)
+            )
+
+            try:
+                kind, attempt, payload = self._events.get(
+                    timeout=self.hedge_after if can_hedge else None
+                )
+            except queue.Empty:
+                logger.info(
+                    f"Нет первого токена за {self.hedge_after}с, hedge запрос к модели "
+                    f"{self.models[self.launched]}"
+                )
+                self.hedges_issued += 1
+                self._launch()
+                continue
+
+            if kind == 'won':
+                self._cancel_others(attempt)
+                continue
+
+            if kind == 'done':
+                self._cancel_others(attempt)
+                self.service.record_success(attempt.model, time.time() - attempt.started_at)
+                return payload, attempt
+
+            self._active.remove(attempt)
+
+            if kind == 'error':
+                logger.warning(f"✗ Ошибка hedged попытки модели {attempt.model}: {payload}")
+                error_type = self.service.record_failure(
+                    attempt.model, payload, time.time() - attempt.started_at
+                )
+                self.last_error = (error_type, payload)
+                if getattr(payload, 'status_code', None) == 404:
+                    stop_launching = True
+                with self._lock:
+                    if self.winner is attempt:
+                        # Победитель упал посреди ответа - продолжаем со следующей модели
+                        self.winner = None
+
+            if not self._active:
+                if stop_launching or self.launched >= len(self.models):
+                    return None, None
+                # Все запущенные попытки завершились ошибкой - обычный fallback
+                self._launch()
+
+    def _launch(self):
+        attempt = HedgeAttempt(self, self.models[self.launched], self.launched)
+        self.launched += 1
+        self._active.append(attempt)
+
+        thread = threading.Thread(target=self._worker, args=(attempt,), daemon=True)
+        thread.start()
+
+    def _cancel_others(self, winner: HedgeAttempt):
+        for attempt in self._active:
+            if attempt is not winner:
+                attempt.cancel()
+
+    def _worker(self, attempt: HedgeAttempt):
+        permit = self.service.rate_limiter.acquire(
+            attempt.model, self.service.estimate_tokens(self.messages)
+        )
+        if permit is None:
+            self._events.put(('error', attempt, ModelRateLimited(attempt.model)))
+            return
+
+        try:
+            attempt.stream = self.service._open_stream(
+                attempt.model, self.messages, self.temperature, self.max_tokens
+            )
+            if attempt.cancelled.is_set():
+                attempt.cancel()
+                raise HedgeCancelled()
+
+            response = self.service._consume_stream(
+                attempt.stream, attempt.model, attempt, attempt.started_at
+            )
+
+            # Ответ без единого фрагмента: побеждает первый завершившийся
+            if not self.claim(attempt):
+                raise HedgeCancelled()
+
+            permit.release(response['tokens_used'])
+            self._events.put(('done', attempt, response))
+        except HedgeCancelled:
+            self._events.put(('cancelled', attempt, None))
+        except Exception as e:
+            if attempt.cancelled.is_set():
+                # Ошибка чтения вызвана закрытием соединения при отмене
+                self._events.put(('cancelled', attempt, None))
+            else:
+                self._events.put(('error', attempt, e))
+        finally:
+            permit.release()
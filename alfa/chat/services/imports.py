@@ -0,0 +1,152 @@
+"""
+Импорт истории сообщений из JSONL
+
+Каждая строка - JSON объект сообщения:
+    {"role": "user", "content": "...", "created_at": "2025-01-10T09:00:00Z"}
+    {"role": "assistant", "content": "...", "model": "...", "tokens_used": 120}
+
+Сообщения пишутся bulk_create пачками без Message.save (без обновления
+диалога на каждую строку и без задач генерации ответа). Каждая пачка - своя
+короткая транзакция: вместе с ней одним UPDATE обновляются денормализованные
+поля диалога, поэтому ни транзакция, ни блокировка строки диалога не
+держатся на весь импорт.
+
+Если импортированные сообщения старше границы краткого содержания диалога
+(см. ConversationSummarizer), содержание сбрасывается и при следующей
+генерации собирается заново уже с ними.
+"""
+import json
+import logging
+from typing import Dict, Iterable, Union
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+
+from chat.models import Conversation, Message
+from chat.serializers import MessageImportSerializer
+from .stats import ConversationStats
+
+logger = logging.getLogger(__name__)
+
+
+class MessageImporter:
+    """
+    Потоковый импорт сообщений в диалог
+    
+    Некорректные строки пропускаются, в результат попадают первые
+    MAX_ERRORS ошибок с номерами строк. Пачки фиксируются по отдельности:
+    при сбое БД уже записанные пачки остаются, а счетчики диалога
+    соответствуют им.
+    """
+    
+    MAX_ERRORS = 20
+    
+    def __init__(self, conversation: Conversation, batch_size: int = None, max_messages: int = None):
+        self.conversation = conversation
+        self.batch_size = batch_size or settings.CHAT_IMPORT_BATCH_SIZE
+        self.max_messages = max_messages or settings.CHAT_IMPORT_MAX_MESSAGES
+    
+    def run(self, lines: Iterable[Union[str, bytes]]) -> Dict:
+        """
+        Импортирует строки JSONL
+        
+        Returns:
+            {'imported': int, 'skipped': int, 'errors': [{'line': int, 'errors': ...}]}
+        """
+        result = {'imported': 0, 'skipped': 0, 'errors': []}
+        
+        batch = []
+        earliest = None
+        for line_number, line in enumerate(lines, start=1):
+            message = self._parse(line_number, line, result)
+            if message is None:
+                continue
+            
+            if result['imported'] + len(batch) >= self.max_messages:
+                self._error(result, line_number, f'Превышен лимит импорта ({self.max_messages} сообщений)')
+                break
+            
+            batch.append(message)
+            if earliest is None or message.created_at < earliest:
+                earliest = message.created_at
+            if len(batch) >= self.batch_size:
+                result['imported'] += self._flush(batch)
+                batch = []
+        
+        if batch:
+            result['imported'] += self._flush(batch)
+        
+        if result['imported']:
+            self._reset_summary(earliest)
+            ConversationStats.invalidate(self.conversation.user_id)
+        
+        logger.info(
+            f"✓ Импорт в диалог {self.conversation.id}: {result['imported']} сообщений, "
+            f"пропущено строк: {result['skipped']}"
+        )
+        return result
+    
+    def _parse(self, line_number: int, line: Union[str, bytes], result: Dict):
+        """Сообщение из строки JSONL или None (пустая или некорректная строка)"""
+        try:
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+            line = line.strip()
+            if not line:
+                return None
+            data = json.loads(line)
+        except (UnicodeDecodeError, ValueError):
+            self._error(result, line_number, 'Строка не является корректным JSON')
+            return None
+        
+        if not isinstance(data, dict):
+            self._error(result, line_number, 'Ожидается JSON объект')
+            return None
+        
+        serializer = MessageImportSerializer(data=data)
+        if not serializer.is_valid():
+            self._error(result, line_number, serializer.errors)
+            return None
+        
+        return Message(
+            conversation_id=self.conversation.id,
+            processing_status=Message.ProcessingStatus.COMPLETED,
+            **serializer.validated_data
+        )
+    
+    def _error(self, result: Dict, line_number: int, errors):
+        result['skipped'] += 1
+        if len(result['errors']) < self.MAX_ERRORS:
+            result['errors'].append({'line': line_number, 'errors': errors})
+    
+    def _flush(self, batch) -> int:
+        """Записывает пачку и обновляет диалог в одной короткой транзакции"""
+        latest = max(batch, key=lambda message: message.created_at)
+        questions = [message for message in batch if message.role == Message.Role.USER]
+        first_question = min(questions, key=lambda message: message.created_at) if questions else None
+        
+        with transaction.atomic():
+            Message.objects.bulk_create(batch)
+            Conversation.objects.filter(pk=self.conversation.id).update(
+                **Message.conversation_updates(len(batch), latest, first_question)
+            )
+        return len(batch)
+    
+    def _reset_summary(self, earliest):
+        """Сбрасывает краткое содержание, если импорт попал в уже сжатую часть диалога"""
+        with transaction.atomic():
+            conversation = Conversation.objects.select_for_update().only('id', 'metadata').get(pk=self.conversation.id)
+            metadata = conversation.metadata or {}
+            summary = metadata.get('summary')
+            if not summary:
+                return
+            # У импортированных сообщений id больше границы, поэтому после нее
+            # они только если не старше ее по времени
+            until_created_at = summary.get('until_created_at')
+            if until_created_at and parse_datetime(until_created_at) <= earliest:
+                return
+            del metadata['summary']
+            Conversation.objects.filter(pk=conversation.id).update(metadata=metadata)
+        
+        logger.info(f"✓ Краткое содержание диалога {self.conversation.id} сброшено после импорта")
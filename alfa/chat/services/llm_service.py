@@ -3,12 +3,19 @@
 """
 import time
 import logging
-from typing import Dict, Optional
+from typing import Callable, Dict, List, Optional
 from django.conf import settings
-from openai import OpenAI, APIError, RateLimitError, APITimeoutError
+from openai import AsyncOpenAI, APIError, RateLimitError, APITimeoutError
 
 from chat.models import Conversation, Message
+from .hedging import HedgedRequest
+from .model_health import ModelHealth
+from .openrouter import get_async_client, get_client
 from .prompt_builder import PromptBuilder
+from .rate_limits import ModelRateLimited, ModelRateLimiter
+from .response_cache import ResponseCache
+from .semantic_cache import SemanticCache
+from .tokens import count_message_tokens
 
 logger = logging.getLogger(__name__)
 
@@ -20,22 +27,31 @@ class LLMService:
     """
     
     def __init__(self):
-        """Инициализация клиента OpenAI с OpenRouter"""
-        self.client = OpenAI(
-            base_url="https://openrouter.ai/api/v1",
-            api_key=settings.OPENROUTER_API_KEY,
-        )
+        """Инициализация сервиса с общим для процесса клиентом OpenRouter"""
+        self.client = get_client()
         self.models = settings.OPENROUTER_MODELS
         self.primary_model = settings.OPENROUTER_MODEL
         self.site_url = settings.OPENROUTER_SITE_URL
         self.site_name = settings.OPENROUTER_SITE_NAME
+        self.health = ModelHealth()
+        self.rate_limiter = ModelRateLimiter()
+        self.response_cache = ResponseCache()
+        self.semantic_cache = SemanticCache()
+    
+    @property
+    def async_client(self) -> AsyncOpenAI:
+        """Общий асинхронный клиент для текущего event loop (consumers, async views)"""
+        return get_async_client()
     
     def generate_response(
         self,
         conversation: Conversation,
         user_message: Message,
         temperature: float = 0.7,
-        max_tokens: int = 4000
+        max_tokens: int = 4000,
+        on_delta: Optional[Callable[[str], None]] = None,
+        hedge: Optional[bool] = None,
+        messages: Optional[List[Dict[str, str]]] = None
     ) -> Dict[str, any]:
         """
         Генерирует ответ от LLM с автоматическим fallback на другие модели
@@ -45,6 +61,18 @@ class LLMService:
             user_message: Сообщение пользователя
             temperature: Параметр креативности (0.0-1.0)
             max_tokens: Максимальное количество токенов в ответе
+            on_delta: Callback для потоковой передачи фрагментов ответа.
+                Если передан, запрос выполняется со stream=True. Если у callback
+                есть метод reset(), он вызывается при fallback после частичного ответа
+            hedge: Включить hedging (параллельный запрос к следующей модели, если
+                первый токен не пришел за LLM_HEDGE_AFTER секунд). По умолчанию
+                берется из настройки LLM_HEDGING_ENABLED
+            messages: Готовая история сообщений (build_prompt). По умолчанию
+                строится из диалога
+        
+        Ответы на повторяющиеся запросы берутся из кэша (если он не отключен
+        для диалога), в metadata такого ответа cache_hit=True. Первый вопрос
+        диалога дополнительно ищется в семантическом кэше (перефразировки).
         
         Returns:
             Dict с содержимым ответа и метаданными:
@@ -59,13 +87,133 @@ class LLMService:
         start_time = time.time()
         
         # Строим историю сообщений с контекстом
-        messages = PromptBuilder.build_messages_history(conversation)
+        if messages is None:
+            messages = self.build_prompt(conversation)
+        
+        # Повторяющийся запрос отдаем из кэша без обращения к LLM
+        cache_key = None
+        if self.response_cache.enabled and conversation.cache_responses:
+            cache_key = self.response_cache.make_key(messages, self.primary_model, temperature)
+            cached = self.response_cache.get(cache_key)
+            if cached:
+                return self._cached_result(
+                    conversation, cached, start_time, temperature, max_tokens, on_delta,
+                    cache_type='exact'
+                )
+        
+        # Первый вопрос диалога ищем среди близких по смыслу уже отвеченных вопросов
+        use_semantic_cache = (
+            self.semantic_cache.enabled
+            and conversation.cache_responses
+            and self.semantic_cache.is_first_turn(messages)
+        )
+        if use_semantic_cache:
+            match = self.semantic_cache.lookup(conversation, messages, user_message.content)
+            if match:
+                entry, similarity = match
+                return self._cached_result(
+                    conversation, entry, start_time, temperature, max_tokens, on_delta,
+                    cache_type='semantic',
+                    extra_metadata={
+                        'similarity': round(similarity, 3),
+                        'cached_question': entry['question']
+                    }
+                )
+        
+        result = self._generate_with_fallback(
+            conversation, messages, temperature, max_tokens, on_delta, hedge, start_time
+        )
+        
+        if self.response_cache.is_cacheable(result):
+            if cache_key:
+                self.response_cache.set(cache_key, result)
+            if use_semantic_cache:
+                self.semantic_cache.add(conversation, messages, user_message.content, result)
+        
+        return result
+    
+    def build_prompt(self, conversation: Conversation) -> List[Dict[str, str]]:
+        """История сообщений с системным промптом в бюджете токенов основной модели"""
+        return PromptBuilder.build_messages_history(conversation, model=self.primary_model)
+    
+    def complete(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: float = 0.3,
+        max_tokens: int = 1000
+    ) -> Optional[Dict[str, any]]:
+        """
+        Служебный запрос к LLM (без кэша и потоковой передачи) с fallback по моделям
+        
+        Используется фоновыми задачами (краткое содержание диалога и т.п.)
+        
+        Returns:
+            Dict с полями content, model, tokens_used, finish_reason или None,
+            если ни одна модель не ответила
+        """
+        chain = [self.primary_model] + [m for m in self.models if m != self.primary_model]
+        models_to_try, _ = self.health.order_models(chain)
+        
+        prompt_tokens = self.estimate_tokens(messages)
+        for model in models_to_try:
+            permit = self.rate_limiter.acquire(model, prompt_tokens)
+            if permit is None:
+                continue
+            
+            attempt_start = time.time()
+            try:
+                response = self._create_completion(model, messages, temperature, max_tokens)
+            except Exception as e:
+                permit.release()
+                logger.warning(f"✗ Ошибка служебного запроса к модели {model}: {str(e)}")
+                self.record_failure(model, e, time.time() - attempt_start)
+                if getattr(e, 'status_code', None) == 404:
+                    break
+                continue
+            
+            permit.release(response['tokens_used'])
+            self.record_success(model, time.time() - attempt_start)
+            return response
+        
+        return None
+    
+    def _generate_with_fallback(
+        self,
+        conversation: Conversation,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        max_tokens: int,
+        on_delta: Optional[Callable[[str], None]],
+        hedge: Optional[bool],
+        start_time: float
+    ) -> Dict[str, any]:
+        """Запрос к моделям по цепочке fallback (с hedging, если включен)"""
+        # Пробуем основную модель, затем fallback модели.
+        # Модели с открытым circuit пропускаем, остальные упорядочиваем по здоровью
+        chain = [self.primary_model] + [m for m in self.models if m != self.primary_model]
+        models_to_try, skipped_models = self.health.order_models(chain)
         
-        # Пробуем основную модель, затем fallback модели
-        models_to_try = [self.primary_model] + [m for m in self.models if m != self.primary_model]
+        if skipped_models:
+            logger.info(f"Пропущены модели с открытым circuit: {', '.join(skipped_models)}")
+        
+        use_hedging = settings.LLM_HEDGING_ENABLED if hedge is None else hedge
+        if use_hedging and len(models_to_try) > 1:
+            return self._generate_hedged(
+                conversation, messages, models_to_try, skipped_models,
+                temperature, max_tokens, on_delta, start_time
+            )
         
         last_error = None
+        prompt_tokens = self.estimate_tokens(messages)
         for model_index, model in enumerate(models_to_try):
+            # Бюджет RPM/TPM и конкурентность модели: без разрешения модель
+            # пропускается без записи ошибки в ее здоровье
+            permit = self.rate_limiter.acquire(model, prompt_tokens)
+            if permit is None:
+                last_error = ('rate_limit', ModelRateLimited(model))
+                continue
+            
+            attempt_start = time.time()
             try:
                 # Логируем попытку
                 if model_index == 0:
@@ -74,41 +222,27 @@ class LLMService:
                     logger.warning(f"Fallback на модель {model} для диалога {conversation.id}")
                 
                 # Делаем запрос к OpenRouter
-                completion = self.client.chat.completions.create(
-                    extra_headers={
-                        "HTTP-Referer": self.site_url,
-                        "X-Title": self.site_name,
-                    },
-                    model=model,
-                    messages=messages,
-                    temperature=temperature,
-                    max_tokens=max_tokens,
-                )
-                
-                response_time = time.time() - start_time
-                
-                # Извлекаем данные из ответа
-                content = completion.choices[0].message.content
-                model_used = completion.model
+                if on_delta is not None:
+                    response = self._stream_completion(
+                        model, messages, temperature, max_tokens, on_delta
+                    )
+                else:
+                    response = self._create_completion(
+                        model, messages, temperature, max_tokens
+                    )
                 
-                # Подсчет токенов
-                tokens_used = None
-                if hasattr(completion, 'usage'):
-                    tokens_used = completion.usage.total_tokens
+                permit.release(response['tokens_used'])
+                self.record_success(model, time.time() - attempt_start)
                 
-                result = {
-                    'content': content,
-                    'model': model_used,
-                    'tokens_used': tokens_used,
-                    'response_time': round(response_time, 2),
-                    'metadata': {
-                        'temperature': temperature,
-                        'max_tokens': max_tokens,
-                        'finish_reason': completion.choices[0].finish_reason if completion.choices else None,
-                        'attempted_models': model_index + 1,
-                        'fallback_used': model_index > 0
-                    }
-                }
+                result = self._build_result(
+                    response, start_time, temperature, max_tokens,
+                    attempted_models=model_index + 1,
+                    skipped_models=len(skipped_models),
+                    streamed=on_delta is not None
+                )
+                response_time = time.time() - start_time
+                model_used = result['model']
+                tokens_used = result['tokens_used']
                 
                 logger.info(
                     f"✓ Успешно сгенерирован ответ для диалога {conversation.id}. "
@@ -121,16 +255,19 @@ class LLMService:
             except RateLimitError as e:
                 last_error = ('rate_limit', e)
                 logger.warning(f"✗ Rate limit для модели {model}: {str(e)}")
+                self.record_failure(model, e, time.time() - attempt_start)
                 continue
             
             except APITimeoutError as e:
                 last_error = ('timeout', e)
                 logger.warning(f"✗ Timeout для модели {model}: {str(e)}")
+                self.record_failure(model, e, time.time() - attempt_start)
                 continue
             
             except APIError as e:
                 last_error = ('api_error', e)
                 logger.warning(f"✗ API ошибка для модели {model}: {str(e)}")
+                self.record_failure(model, e, time.time() - attempt_start)
                 # Для 404 ошибок не пробуем другие модели, сразу возвращаем ошибку
                 if hasattr(e, 'status_code') and e.status_code == 404:
                     break
@@ -139,7 +276,11 @@ class LLMService:
             except Exception as e:
                 last_error = ('default', e)
                 logger.warning(f"✗ Ошибка для модели {model}: {str(e)}")
+                self.record_failure(model, e, time.time() - attempt_start)
                 continue
+            
+            finally:
+                permit.release()
         
         # Все модели не сработали - возвращаем ошибку
         response_time = time.time() - start_time
@@ -152,6 +293,321 @@ class LLMService:
         
         return self._handle_error(error_type, error, response_time)
     
+    def _generate_hedged(
+        self,
+        conversation: Conversation,
+        messages: List[Dict[str, str]],
+        models_to_try: List[str],
+        skipped_models: List[str],
+        temperature: float,
+        max_tokens: int,
+        on_delta: Optional[Callable[[str], None]],
+        start_time: float
+    ) -> Dict[str, any]:
+        """
+        Генерация с hedging: при медленном первом токене параллельно
+        запрашивается следующая модель, побеждает первая ответившая
+        """
+        request = HedgedRequest(
+            service=self,
+            models=models_to_try,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            on_delta=on_delta,
+            hedge_after=settings.LLM_HEDGE_AFTER,
+            max_hedges=settings.LLM_HEDGE_MAX
+        )
+        response, winner = request.run()
+        
+        if response is None:
+            response_time = time.time() - start_time
+            error_type, error = request.last_error or ('default', Exception('Unknown error'))
+            logger.error(
+                f"✗✗✗ Hedged запрос ({request.launched} моделей) не смог сгенерировать ответ "
+                f"для диалога {conversation.id}. Последняя ошибка: {error_type}"
+            )
+            result = self._handle_error(error_type, error, response_time)
+            result['metadata']['hedges_issued'] = request.hedges_issued
+            return result
+        
+        result = self._build_result(
+            response, start_time, temperature, max_tokens,
+            attempted_models=request.launched,
+            skipped_models=len(skipped_models),
+            streamed=on_delta is not None
+        )
+        result['metadata']['fallback_used'] = winner.index > 0
+        result['metadata'].update({
+            'hedged': True,
+            'hedges_issued': request.hedges_issued,
+            'winner_model': winner.model,
+        })
+        
+        logger.info(
+            f"✓ Успешно сгенерирован ответ для диалога {conversation.id} (hedging). "
+            f"Победитель: {winner.model}, Hedge запросов: {request.hedges_issued}, "
+            f"Время: {result['response_time']}с"
+        )
+        
+        return result
+    
+    def _cached_result(
+        self,
+        conversation: Conversation,
+        cached: Dict[str, any],
+        start_time: float,
+        temperature: float,
+        max_tokens: int,
+        on_delta: Optional[Callable[[str], None]],
+        cache_type: str,
+        extra_metadata: Optional[Dict[str, any]] = None
+    ) -> Dict[str, any]:
+        """Формирует результат generate_response из закэшированного ответа"""
+        # Подписчики получают ответ одним фрагментом
+        if on_delta is not None:
+            on_delta(cached['content'])
+            if hasattr(on_delta, 'flush'):
+                on_delta.flush()
+        
+        logger.info(
+            f"✓ Ответ для диалога {conversation.id} взят из кэша ({cache_type}, модель {cached['model']})"
+        )
+        
+        result = {
+            'content': cached['content'],
+            'model': cached['model'],
+            # Токены на этот ответ не тратились
+            'tokens_used': 0,
+            'response_time': round(time.time() - start_time, 2),
+            'metadata': {
+                'temperature': temperature,
+                'max_tokens': max_tokens,
+                'finish_reason': cached['finish_reason'],
+                'attempted_models': 0,
+                'fallback_used': False,
+                'streamed': on_delta is not None,
+                'cache_hit': True,
+                'cache_type': cache_type,
+                'cached_tokens_used': cached['tokens_used']
+            }
+        }
+        
+        if extra_metadata:
+            result['metadata'].update(extra_metadata)
+        
+        return result
+    
+    @staticmethod
+    def _build_result(
+        response: Dict[str, any],
+        start_time: float,
+        temperature: float,
+        max_tokens: int,
+        attempted_models: int,
+        skipped_models: int,
+        streamed: bool
+    ) -> Dict[str, any]:
+        """Формирует результат generate_response из ответа модели"""
+        result = {
+            'content': response['content'],
+            'model': response['model'],
+            'tokens_used': response['tokens_used'],
+            'response_time': round(time.time() - start_time, 2),
+            'metadata': {
+                'temperature': temperature,
+                'max_tokens': max_tokens,
+                'finish_reason': response['finish_reason'],
+                'attempted_models': attempted_models,
+                'fallback_used': attempted_models > 1,
+                'skipped_models': skipped_models,
+                'streamed': streamed
+            }
+        }
+        
+        if response.get('first_token_time') is not None:
+            result['metadata']['first_token_time'] = response['first_token_time']
+        
+        return result
+    
+    @staticmethod
+    def classify_error(error: Exception) -> str:
+        """Тип ошибки модели для метаданных и текста ответа пользователю"""
+        if isinstance(error, (RateLimitError, ModelRateLimited)):
+            return 'rate_limit'
+        if isinstance(error, APITimeoutError):
+            return 'timeout'
+        if isinstance(error, APIError):
+            return 'api_error'
+        return 'default'
+    
+    @staticmethod
+    def estimate_tokens(messages: List[Dict[str, str]]) -> int:
+        """Оценка токенов промпта для бюджета TPM модели"""
+        return sum(count_message_tokens(message) for message in messages)
+    
+    def record_success(self, model: str, latency: float):
+        """Успешный ответ модели: здоровье и лимит конкурентности"""
+        self.health.record_success(model, latency)
+        self.rate_limiter.record_success(model)
+    
+    def record_failure(self, model: str, error: Exception, latency: float) -> str:
+        """
+        Ошибка модели: здоровье, а для 429 еще и лимит конкурентности
+        
+        Пауза из Retry-After ответа 429 открывает circuit модели ровно на
+        указанное провайдером время.
+        
+        Returns:
+            Тип ошибки (classify_error)
+        """
+        error_type = self.classify_error(error)
+        if isinstance(error, ModelRateLimited):
+            # Запрос не отправлялся - модель не виновата
+            return error_type
+        
+        cooldown = None
+        if error_type == 'rate_limit':
+            cooldown = self.rate_limiter.record_rate_limit(model, error)
+        self.health.record_failure(model, error_type, latency, cooldown=cooldown)
+        return error_type
+    
+    def _create_completion(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        max_tokens: int
+    ) -> Dict[str, any]:
+        """
+        Обычный (не потоковый) запрос к OpenRouter
+        
+        Returns:
+            Dict с полями content, model, tokens_used, finish_reason
+        """
+        completion = self.client.chat.completions.create(
+            extra_headers=self._extra_headers(),
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+        )
+        
+        # Подсчет токенов
+        tokens_used = None
+        if hasattr(completion, 'usage'):
+            tokens_used = completion.usage.total_tokens
+        
+        return {
+            'content': completion.choices[0].message.content,
+            'model': completion.model,
+            'tokens_used': tokens_used,
+            'finish_reason': completion.choices[0].finish_reason if completion.choices else None,
+        }
+    
+    def _stream_completion(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        max_tokens: int,
+        on_delta: Callable[[str], None]
+    ) -> Dict[str, any]:
+        """
+        Потоковый запрос к OpenRouter: фрагменты ответа передаются в on_delta
+        по мере генерации, итоговый результат собирается целиком
+        
+        Returns:
+            Dict с полями content, model, tokens_used, finish_reason, first_token_time
+        """
+        request_start = time.time()
+        stream = self._open_stream(model, messages, temperature, max_tokens)
+        return self._consume_stream(stream, model, on_delta, request_start)
+    
+    def _open_stream(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        max_tokens: int
+    ):
+        """Открывает потоковый запрос (возвращается после получения заголовков ответа)"""
+        return self.client.chat.completions.create(
+            extra_headers=self._extra_headers(),
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=True,
+            stream_options={'include_usage': True},
+        )
+    
+    def _consume_stream(
+        self,
+        stream,
+        model: str,
+        on_delta: Callable[[str], None],
+        request_start: float
+    ) -> Dict[str, any]:
+        """Читает потоковый ответ до конца, передавая фрагменты в on_delta"""
+        parts = []
+        model_used = model
+        tokens_used = None
+        finish_reason = None
+        first_token_time = None
+        
+        try:
+            for chunk in stream:
+                if getattr(chunk, 'model', None):
+                    model_used = chunk.model
+                
+                # Последний чанк содержит usage и пустой choices
+                usage = getattr(chunk, 'usage', None)
+                if usage:
+                    tokens_used = usage.total_tokens
+                
+                if not chunk.choices:
+                    continue
+                
+                choice = chunk.choices[0]
+                delta = choice.delta.content if choice.delta else None
+                if delta:
+                    if not parts:
+                        first_token_time = round(time.time() - request_start, 2)
+                        logger.info(f"Первый токен от модели {model} через {first_token_time}с")
+                    parts.append(delta)
+                    on_delta(delta)
+                
+                if choice.finish_reason:
+                    finish_reason = choice.finish_reason
+        except Exception:
+            # Модель упала посреди ответа - клиент должен сбросить частичный текст
+            if parts and hasattr(on_delta, 'reset'):
+                on_delta.reset()
+            raise
+        finally:
+            close = getattr(stream, 'close', None)
+            if close:
+                close()
+        
+        if hasattr(on_delta, 'flush'):
+            on_delta.flush()
+        
+        return {
+            'content': ''.join(parts),
+            'model': model_used,
+            'tokens_used': tokens_used,
+            'finish_reason': finish_reason,
+            'first_token_time': first_token_time,
+        }
+    
+    def _extra_headers(self) -> Dict[str, str]:
+        """Заголовки атрибуции приложения для OpenRouter"""
+        return {
+            "HTTP-Referer": self.site_url,
+            "X-Title": self.site_name,
+        }
+    
     def _handle_error(self, error_type: str, error: Exception, response_time: float) -> Dict[str, any]:
         """
         Обработка ошибок при генерации ответа
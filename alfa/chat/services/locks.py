@@ -0,0 +1,173 @@
+"""
+Распределенные блокировки генерации ответа (диалог, лимит пользователя)
+"""
+import logging
+import uuid
+from typing import Optional
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .redis_client import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+# Сравнение владельца и действие над ключом одной командой Redis: между
+# проверкой и удалением блокировка может истечь и достаться другой задаче
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+EXTEND_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class CacheLock:
+    """
+    Блокировка в Redis (кэш Django) с владельцем
+    
+    Захватывается атомарным SET NX со случайным токеном, продлевается
+    (extend) и снимается только владельцем - скриптами Lua со сравнением
+    токена. Если воркер упал, истекает через timeout секунд. При
+    недоступном Redis считается захваченной - генерация не должна
+    останавливаться из-за кэша. На других бэкендах кэша (locmem в тестах)
+    используются обычные операции кэша.
+    """
+    
+    def __init__(self, key: str, timeout: int = None):
+        self.key = key
+        self.timeout = timeout or settings.CHAT_GENERATION_LOCK_TIMEOUT
+        self.token = uuid.uuid4().hex
+        self.acquired = False
+    
+    def acquire(self) -> bool:
+        """Пытается захватить блокировку без ожидания"""
+        try:
+            redis = get_redis_client(caches['default'], self.key)
+            if redis:
+                client, key = redis
+                self.acquired = bool(client.set(key, self.token, nx=True, ex=self.timeout))
+            else:
+                self.acquired = caches['default'].add(self.key, self.token, timeout=self.timeout)
+        except Exception as e:
+            logger.warning(f"Блокировка {self.key} недоступна, генерация без нее: {e}")
+            self.acquired = True
+        return self.acquired
+    
+    def extend(self) -> bool:
+        """
+        Продлевает блокировку еще на timeout секунд
+        
+        Returns:
+            False, если блокировка истекла и, возможно, занята другой задачей
+        """
+        if not self.acquired:
+            return False
+        
+        try:
+            redis = get_redis_client(caches['default'], self.key)
+            if redis:
+                client, key = redis
+                extended = bool(client.eval(EXTEND_SCRIPT, 1, key, self.token, self.timeout))
+            else:
+                backend = caches['default']
+                extended = backend.get(self.key) == self.token and backend.touch(self.key, self.timeout)
+        except Exception as e:
+            logger.warning(f"Не удалось продлить блокировку {self.key}: {e}")
+            return True
+        
+        if not extended:
+            logger.warning(f"Блокировка {self.key} истекла до конца генерации")
+        return extended
+    
+    def is_held(self) -> bool:
+        """Занята ли блокировка (любым владельцем), без захвата"""
+        try:
+            redis = get_redis_client(caches['default'], self.key)
+            if redis:
+                client, key = redis
+                return bool(client.exists(key))
+            return caches['default'].get(self.key) is not None
+        except Exception as e:
+            logger.warning(f"Не удалось проверить блокировку {self.key}: {e}")
+            return False
+    
+    def release(self):
+        """Снимает блокировку, если она все еще принадлежит этому владельцу"""
+        if not self.acquired:
+            return
+        
+        self.acquired = False
+        try:
+            redis = get_redis_client(caches['default'], self.key)
+            if redis:
+                client, key = redis
+                client.eval(RELEASE_SCRIPT, 1, key, self.token)
+            elif caches['default'].get(self.key) == self.token:
+                caches['default'].delete(self.key)
+        except Exception as e:
+            logger.warning(f"Не удалось снять блокировку {self.key}: {e}")
+
+
+class ConversationLock(CacheLock):
+    """
+    Блокировка диалога на время генерации ответа
+    
+    Задачи generate_ai_response одного диалога выполняются по очереди:
+    следующая строит историю уже с ответом на предыдущее сообщение. Разные
+    диалоги генерируются параллельно.
+    """
+    
+    KEY_PREFIX = 'chat:generation:lock:'
+    
+    def __init__(self, conversation_id: int, timeout: int = None):
+        super().__init__(f'{self.KEY_PREFIX}{conversation_id}', timeout)
+
+
+class UserGenerationSlots:
+    """
+    Ограничение одновременных генераций одного пользователя
+    
+    Семафор из CHAT_USER_MAX_INFLIGHT слотов - отдельных блокировок, поэтому
+    слот упавшего воркера освобождается по таймауту независимо от остальных.
+    Задачи сверх лимита откладываются на CHAT_GENERATION_LOCK_RETRY_DELAY
+    секунд, так что активный пользователь не занимает все воркеры очереди
+    interactive.
+    """
+    
+    KEY_PREFIX = 'chat:generation:user:'
+    
+    def __init__(self, user_id: int, limit: int = None, timeout: int = None):
+        self.user_id = user_id
+        self.limit = settings.CHAT_USER_MAX_INFLIGHT if limit is None else limit
+        self.timeout = timeout
+        self.slot: Optional[CacheLock] = None
+    
+    def acquire(self) -> bool:
+        """Занимает свободный слот (без лимита - всегда успешно)"""
+        if self.limit <= 0:
+            return True
+        
+        for index in range(self.limit):
+            slot = CacheLock(f'{self.KEY_PREFIX}{self.user_id}:{index}', self.timeout)
+            if slot.acquire():
+                self.slot = slot
+                return True
+        return False
+    
+    def extend(self) -> bool:
+        """Продлевает занятый слот (см. CacheLock.extend)"""
+        return self.slot.extend() if self.slot else True
+    
+    def release(self):
+        """Освобождает занятый слот"""
+        if self.slot:
+            self.slot.release()
+            self.slot = None
@@ -0,0 +1,221 @@
+"""
+Отправка сообщений пользователя и запуск генерации ответа
+"""
+import logging
+import uuid
+from typing import List, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from chat.models import Conversation, Message
+from .events import ChatEvents, publish_event
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_KEY_PREFIX = 'chat:idempotency:'
+
+
+def submit_user_message(
+    conversation: Conversation,
+    content: str,
+    client_message_id: Optional[str] = None
+) -> Tuple[Message, str, bool]:
+    """
+    Создает сообщение пользователя и ставит задачу генерации ответа AI
+
+    Общая точка входа для REST API и WebSocket.
+
+    Повторная отправка с тем же client_message_id (ключ идемпотентности)
+    не создает сообщение и задачу, а возвращает исходные. Ключ ищется
+    сначала в Redis, затем в БД; гонку параллельных повторов разрешает
+    уникальное ограничение (диалог, client_message_id).
+
+    Склейка сообщений (CHAT_COALESCE_ENABLED): если в диалоге уже есть
+    сообщение, ожидающее генерации (не повтора после ошибки), новое
+    присоединяется к нему (coalesced_into) и получает ID его задачи - одна
+    генерация ответит на все вопросы пачки. Отправка и захват пачки задачей
+    (claim_coalesced_batch) выполняются под блокировкой строки диалога.
+
+    Args:
+        conversation: Диалог
+        content: Провалидированный текст сообщения
+        client_message_id: Ключ идемпотентности от клиента
+
+    Returns:
+        Кортеж (сообщение пользователя, ID задачи Celery, создано ли сообщение)
+    """
+    from chat.serializers import MessageSerializer
+    from chat.tasks import generate_ai_response
+
+    if client_message_id:
+        submitted = _find_submitted(conversation, client_message_id)
+        if submitted:
+            return submitted + (False,)
+
+    # ID задачи известен заранее и сохраняется вместе с сообщением,
+    # чтобы повтор мог вернуть его без дополнительной записи
+    metadata = {'task_id': str(uuid.uuid4())}
+
+    # Создаем сообщение пользователя с статусом "ожидает обработки"
+    try:
+        with transaction.atomic():
+            leader = _lock_pending_leader(conversation) if settings.CHAT_COALESCE_ENABLED else None
+            if leader:
+                metadata = {'task_id': leader.metadata.get('task_id')}
+
+            user_message = Message.objects.create(
+                conversation=conversation,
+                role=Message.Role.USER,
+                content=content,
+                processing_status=Message.ProcessingStatus.PENDING,
+                client_message_id=client_message_id or None,
+                coalesced_into=leader,
+                metadata=metadata
+            )
+    except IntegrityError:
+        if not client_message_id:
+            raise
+        # Параллельный повтор с тем же ключом успел создать сообщение
+        user_message = Message.objects.get(conversation=conversation, client_message_id=client_message_id)
+        return user_message, user_message.metadata.get('task_id'), False
+
+    task_id = metadata['task_id']
+    if client_message_id:
+        _remember_submitted(conversation.id, client_message_id, user_message.id, task_id)
+
+    # Уведомляем подписчиков диалога до старта генерации,
+    # чтобы событие гарантированно пришло раньше фрагментов ответа
+    publish_event(conversation.id, ChatEvents.MESSAGE_CREATED, {
+        'user_message': MessageSerializer(user_message).data,
+    })
+
+    # Запускаем асинхронную задачу для генерации ответа. Задержка
+    # CHAT_COALESCE_DEBOUNCE оставляет время дослать уточнения в ту же пачку
+    if not leader:
+        generate_ai_response.apply_async(
+            args=[user_message.id],
+            task_id=task_id,
+            countdown=settings.CHAT_COALESCE_DEBOUNCE or None
+        )
+    else:
+        logger.info(f"Сообщение {user_message.id} присоединено к генерации ответа на {leader.id}")
+
+    return user_message, task_id, True
+
+
+def claim_coalesced_batch(message_id: int) -> List[Message]:
+    """
+    Захватывает для генерации сообщение и присоединенные к нему
+
+    Пачка переводится в статус "обрабатывается" под блокировкой строки
+    диалога, поэтому сообщение, отправленное позже, уже не присоединится
+    к ней, а получит собственную задачу. Повтор задачи после ошибки
+    забирает пачку заново (статус "ожидает" или "ошибка").
+
+    Args:
+        message_id: ID сообщения, для которого запущена задача
+
+    Returns:
+        Сообщения пачки по порядку (первое - с диалогом, бизнесом и профилем)
+        или пустой список, если сообщение уже обрабатывается или обработано
+
+    Raises:
+        Message.DoesNotExist: Сообщение не найдено
+    """
+    conversation_id = Message.objects.values_list('conversation_id', flat=True).get(id=message_id)
+
+    with transaction.atomic():
+        Conversation.objects.select_for_update().only('id').get(id=conversation_id)
+
+        message = Message.objects.select_related('conversation__business__profile').get(id=message_id)
+        if message.processing_status in (Message.ProcessingStatus.PROCESSING, Message.ProcessingStatus.COMPLETED):
+            return []
+
+        followers = list(coalesced_batch(conversation_id, message_id).exclude(id=message_id).exclude(
+            processing_status=Message.ProcessingStatus.COMPLETED
+        ))
+        batch = [message] + followers
+        set_batch_status(batch, Message.ProcessingStatus.PROCESSING)
+
+    return batch
+
+
+def coalesced_batch(conversation_id: int, message_id: int):
+    """QuerySet сообщения и присоединенных к нему сообщений диалога по порядку"""
+    return Message.objects.filter(
+        Q(id=message_id) | Q(coalesced_into_id=message_id),
+        conversation_id=conversation_id,
+        role=Message.Role.USER
+    ).order_by('id')
+
+
+def set_batch_status(messages: List[Message], status: str):
+    """Статус обработки для пачки сообщений одним UPDATE (в БД и в памяти)"""
+    now = timezone.now()
+    Message.objects.filter(id__in=[message.id for message in messages]).update(
+        processing_status=status, status_changed_at=now
+    )
+    for message in messages:
+        message.processing_status = status
+        message.status_changed_at = now
+
+
+def _lock_pending_leader(conversation: Conversation) -> Optional[Message]:
+    """
+    Блокирует строку диалога и возвращает сообщение, ожидающее генерации
+
+    Вызывается внутри транзакции. Присоединенные сообщения своей задачи
+    не имеют, поэтому ведущим считается только сообщение без coalesced_into.
+    Сообщение, ожидающее повтора после ошибки (есть чекпоинт
+    metadata['generation']), ведущим не считается: повтор может сохранить
+    уже полученный ответ модели, в котором нет нового сообщения.
+    """
+    Conversation.objects.select_for_update().only('id').get(id=conversation.id)
+
+    return conversation.messages.filter(
+        role=Message.Role.USER,
+        processing_status=Message.ProcessingStatus.PENDING,
+        coalesced_into__isnull=True
+    ).exclude(metadata__has_key='generation').order_by('id').only('id', 'metadata').first()
+
+
+def _idempotency_cache_key(conversation_id: int, client_message_id: str) -> str:
+    return f'{IDEMPOTENCY_KEY_PREFIX}{conversation_id}:{client_message_id}'
+
+
+def _find_submitted(conversation: Conversation, client_message_id: str) -> Optional[Tuple[Message, str]]:
+    """Ранее отправленное сообщение с тем же ключом и ID его задачи"""
+    try:
+        cached = cache.get(_idempotency_cache_key(conversation.id, client_message_id))
+    except Exception as e:
+        # Недоступность кэша не должна ломать отправку: ключ проверит БД
+        logger.warning(f"Не удалось прочитать ключ идемпотентности: {e}")
+        cached = None
+
+    if cached:
+        message = Message.objects.filter(id=cached['message_id'], conversation=conversation).first()
+        if message:
+            return message, cached['task_id']
+
+    message = Message.objects.filter(conversation=conversation, client_message_id=client_message_id).first()
+    if message:
+        task_id = message.metadata.get('task_id')
+        _remember_submitted(conversation.id, client_message_id, message.id, task_id)
+        return message, task_id
+
+    return None
+
+
+def _remember_submitted(conversation_id: int, client_message_id: str, message_id: int, task_id: str):
+    try:
+        cache.set(
+            _idempotency_cache_key(conversation_id, client_message_id),
+            {'message_id': message_id, 'task_id': task_id},
+            timeout=settings.CHAT_IDEMPOTENCY_TTL
+        )
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить ключ идемпотентности: {e}")
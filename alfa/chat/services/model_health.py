@@ -0,0 +1,231 @@
+"""
+Circuit breaker и статистика здоровья LLM моделей
+
+Состояние хранится в общем кэше (Redis), поэтому все воркеры видят,
+какие модели сейчас упираются в rate limit или таймауты, и не тратят
+на них лишний round trip.
+"""
+import time
+import logging
+from statistics import median
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+
+class ModelHealth:
+    """
+    Circuit breaker по моделям с учетом успешности и задержки
+
+    Для каждой модели хранится:
+        failures     - количество ошибок подряд
+        opened_until - до какого времени (unix time) circuit открыт
+        outcomes     - последние исходы запросов [успех (1/0), задержка в секундах]
+
+    После LLM_CIRCUIT_FAILURE_THRESHOLD ошибок подряд circuit открывается на
+    LLM_CIRCUIT_COOLDOWN секунд. По истечении пропускается один пробный запрос
+    (half-open): модель получает только воркер, взявший токен пробы (cache.add),
+    остальные пропускают ее, пока проба не завершится или токен не истечет.
+    При ошибке пробы circuit сразу открывается снова, при успехе закрывается.
+
+    Состояние обновляется чтением и записью без блокировки, поэтому при
+    параллельных запросах счетчик ошибок и исходы приблизительны.
+
+    Модель, опустившуюся в цепочке ниже менее приоритетной, пробуют первой
+    на каждом LLM_HEALTH_PROBE_EVERY-м запросе: иначе ее статистика не
+    обновляется и она не возвращается на свое место после восстановления.
+    """
+
+    KEY_PREFIX = 'llm:health:'
+    PROBE_COUNTER_KEY = 'llm:health:probe'
+    HALF_OPEN_KEY_PREFIX = 'llm:health:half_open:'
+
+    def __init__(self, cache_backend=None):
+        self.cache = cache_backend or cache
+        self.failure_threshold = settings.LLM_CIRCUIT_FAILURE_THRESHOLD
+        self.cooldown = settings.LLM_CIRCUIT_COOLDOWN
+        self.window = settings.LLM_HEALTH_WINDOW
+        self.probe_every = settings.LLM_HEALTH_PROBE_EVERY
+
+    def _key(self, model: str) -> str:
+        return f'{self.KEY_PREFIX}{model}'
+
+    @staticmethod
+    def _empty_state() -> Dict:
+        return {'failures': 0, 'opened_until': 0, 'outcomes': []}
+
+    def get_state(self, model: str) -> Dict:
+        """Текущее состояние модели"""
+        try:
+            return self.cache.get(self._key(model)) or self._empty_state()
+        except Exception as e:
+            # Недоступность кэша не должна ломать генерацию ответа
+            logger.warning(f"Не удалось прочитать состояние модели {model}: {e}")
+            return self._empty_state()
+
+    def _save_state(self, model: str, state: Dict):
+        try:
+            # Состояние живет не дольше окна наблюдения без новых запросов
+            self.cache.set(self._key(model), state, timeout=max(self.cooldown * 10, 600))
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить состояние модели {model}: {e}")
+
+    def record_success(self, model: str, latency: float):
+        """Фиксирует успешный ответ модели"""
+        state = self.get_state(model)
+        self._release_probe(model, state)
+        state['failures'] = 0
+        state['opened_until'] = 0
+        state['outcomes'] = (state['outcomes'] + [[1, round(latency, 3)]])[-self.window:]
+        self._save_state(model, state)
+
+    def record_failure(self, model: str, error_type: str, latency: float, cooldown: Optional[float] = None):
+        """
+        Фиксирует ошибку модели и при необходимости открывает circuit
+
+        Args:
+            model: Модель
+            error_type: Тип ошибки (rate_limit, timeout, api_error, default)
+            latency: Сколько длилась неудачная попытка
+            cooldown: Явное время блокировки в секундах (например, из Retry-After)
+        """
+        state = self.get_state(model)
+        self._release_probe(model, state)
+        state['failures'] += 1
+        state['outcomes'] = (state['outcomes'] + [[0, round(latency, 3)]])[-self.window:]
+
+        if cooldown is not None or state['failures'] >= self.failure_threshold:
+            state['opened_until'] = time.time() + (cooldown if cooldown is not None else self.cooldown)
+            logger.warning(
+                f"Circuit открыт для модели {model} ({error_type}, ошибок подряд: {state['failures']})"
+            )
+
+        self._save_state(model, state)
+
+    def _take_probe(self, model: str) -> bool:
+        """Токен пробного запроса half-open модели (один на все воркеры)"""
+        try:
+            return self.cache.add(f'{self.HALF_OPEN_KEY_PREFIX}{model}', 1, timeout=self.cooldown)
+        except Exception as e:
+            logger.warning(f"Не удалось взять токен пробы модели {model}: {e}")
+            return True
+
+    def _release_probe(self, model: str, state: Dict):
+        """Снимает токен пробы, когда ее исход записан"""
+        if not state['opened_until']:
+            return
+        try:
+            self.cache.delete(f'{self.HALF_OPEN_KEY_PREFIX}{model}')
+        except Exception as e:
+            logger.warning(f"Не удалось снять токен пробы модели {model}: {e}")
+
+    def is_open(self, model: str, state: Optional[Dict] = None) -> bool:
+        """Открыт ли circuit модели (запросы к ней пропускаются)"""
+        state = state if state is not None else self.get_state(model)
+        return state['opened_until'] > time.time()
+
+    @staticmethod
+    def stats(state: Dict) -> Tuple[float, Optional[float]]:
+        """
+        Успешность и медианная задержка по последним исходам
+
+        Returns:
+            (доля успешных запросов, p50 задержки успешных запросов или None)
+        """
+        outcomes = state['outcomes']
+        if not outcomes:
+            return 1.0, None
+
+        success_rate = sum(ok for ok, _ in outcomes) / len(outcomes)
+        latencies = [latency for ok, latency in outcomes if ok]
+        return success_rate, (median(latencies) if latencies else None)
+
+    def order_models(self, models: List[str]) -> Tuple[List[str], List[str]]:
+        """
+        Упорядочивает цепочку моделей по здоровью
+
+        Модели с открытым circuit (и half-open модели, пробу которых уже
+        делает другой воркер) пропускаются, остальные сортируются по
+        успешности (с шагом 10%), затем по p50 задержки, при равенстве -
+        в исходном порядке. Модель без статистики считается полностью
+        успешной, но без измеренной задержки: она идет после измеренных
+        моделей со 100% успешностью и перед менее успешными. Пониженная
+        модель периодически ставится первой (см. _probe_demoted).
+
+        Returns:
+            (модели для попыток, пропущенные модели с открытым circuit)
+        """
+        try:
+            states = self.cache.get_many([self._key(model) for model in models])
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать состояние моделей: {e}")
+            states = {}
+
+        available = []
+        skipped = []
+        for position, model in enumerate(models):
+            state = states.get(self._key(model)) or self._empty_state()
+            if self.is_open(model, state):
+                skipped.append(model)
+                continue
+
+            # Half-open: cooldown истек, модель пробует только один воркер
+            if state['opened_until'] and not self._take_probe(model):
+                skipped.append(model)
+                continue
+
+            success_rate, p50 = self.stats(state)
+            sort_key = (
+                -round(success_rate, 1),
+                p50 if p50 is not None else float('inf'),
+                position,
+            )
+            available.append((sort_key, model))
+
+        ordered = self._probe_demoted([model for _, model in sorted(available)], models)
+
+        # Все circuit открыты: делаем одну пробную попытку с моделью,
+        # которая разблокируется раньше остальных
+        if not ordered and skipped:
+            probe = min(skipped, key=lambda m: (states.get(self._key(m)) or self._empty_state())['opened_until'])
+            ordered = [probe]
+            skipped = [m for m in skipped if m != probe]
+
+        return ordered, skipped
+
+    def _probe_demoted(self, ordered: List[str], models: List[str]) -> List[str]:
+        """
+        Ставит первой пониженную модель на каждом probe_every-м запросе
+
+        Пониженная - модель, перед которой в упорядоченной цепочке стоит
+        модель, идущая позже нее в исходной цепочке. Из таких пробуется
+        самая приоритетная. Счетчик запросов общий для всех воркеров и
+        увеличивается, только когда пониженные модели есть.
+        """
+        if not self.probe_every:
+            return ordered
+
+        position = {model: index for index, model in enumerate(models)}
+        demoted = [
+            model for index, model in enumerate(ordered)
+            if any(position[other] > position[model] for other in ordered[:index])
+        ]
+        if not demoted:
+            return ordered
+
+        try:
+            self.cache.add(self.PROBE_COUNTER_KEY, 0, timeout=None)
+            count = self.cache.incr(self.PROBE_COUNTER_KEY)
+        except Exception as e:
+            logger.warning(f"Не удалось обновить счетчик пробных запросов: {e}")
+            return ordered
+
+        if count % self.probe_every:
+            return ordered
+
+        probe = min(demoted, key=position.get)
+        logger.info(f"Пробный запрос к пониженной модели {probe}")
+        return [probe] + [model for model in ordered if model != probe]
@@ -0,0 +1,98 @@
+"""
+Общие клиенты OpenRouter API на процесс
+
+Клиент OpenAI держит пул keep-alive соединений httpx. Создание клиента на
+каждый запрос означает новый пул и TLS handshake на каждый ответ, поэтому
+клиенты создаются лениво один раз на процесс (воркер Celery, ASGI сервер)
+и переиспользуются.
+"""
+import asyncio
+import threading
+import weakref
+
+import httpx
+from django.conf import settings
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
+
+_client = None
+_client_lock = threading.Lock()
+
+# AsyncClient httpx привязан к event loop, в котором открыты соединения,
+# поэтому асинхронный клиент создается отдельно для каждого loop
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def _http_options():
+    """Общие параметры httpx клиента: пул соединений, HTTP/2, таймауты"""
+    return {
+        'http2': settings.OPENROUTER_HTTP2,
+        'limits': httpx.Limits(
+            max_connections=settings.OPENROUTER_POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.OPENROUTER_POOL_MAX_KEEPALIVE,
+            keepalive_expiry=settings.OPENROUTER_POOL_KEEPALIVE_EXPIRY,
+        ),
+        'timeout': httpx.Timeout(settings.OPENROUTER_TIMEOUT, connect=10.0),
+    }
+
+
+def _client_options():
+    """Общие параметры клиента OpenAI"""
+    return {
+        'base_url': settings.OPENROUTER_BASE_URL,
+        'api_key': settings.OPENROUTER_API_KEY,
+        'max_retries': settings.OPENROUTER_MAX_RETRIES,
+    }
+
+
+def get_client() -> OpenAI:
+    """
+    Возвращает общий синхронный клиент OpenRouter (создается при первом вызове)
+    """
+    global _client
+
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = OpenAI(
+                    http_client=DefaultHttpxClient(**_http_options()),
+                    **_client_options()
+                )
+
+    return _client
+
+
+def get_async_client() -> AsyncOpenAI:
+    """
+    Возвращает общий асинхронный клиент OpenRouter для текущего event loop
+
+    Должен вызываться из корутины (consumers, async views).
+    """
+    loop = asyncio.get_running_loop()
+
+    client = _async_clients.get(loop)
+    if client is None:
+        client = AsyncOpenAI(
+            http_client=DefaultAsyncHttpxClient(**_http_options()),
+            **_client_options()
+        )
+        _async_clients[loop] = client
+
+    return client
+
+
+def reset_clients():
+    """
+    Закрывает и сбрасывает общие клиенты
+
+    Используется после изменения настроек (тесты) и после fork процесса,
+    чтобы дочерний процесс не делил сокеты с родительским.
+    """
+    global _client
+
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = None
+
+    # Асинхронные клиенты закрываются вместе со своим event loop
+    _async_clients.clear()
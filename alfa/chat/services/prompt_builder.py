@@ -2,8 +2,13 @@
 Построение промптов для AI ассистента с учетом контекста бизнеса
 """
 from typing import List, Dict, Optional
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
 from chat.models import Conversation, Message
-from users.models import Business
+from users.models import Business, BusinessProfile
+from .tokens import MESSAGE_OVERHEAD, count_message_tokens, truncate_to_tokens
 
 
 class PromptBuilder:
@@ -11,6 +16,15 @@ class PromptBuilder:
     Класс для построения промптов с контекстом
     """
     
+    # Пометка обрезанного сообщения в истории
+    TRUNCATED_MARKER = ' …[сообщение сокращено]'
+    
+    # Промпт для сжатия старой части диалога в краткое содержание
+    SUMMARY_PROMPT = """Ты ведешь краткое содержание диалога владельца бизнеса с AI-консультантом.
+Обнови краткое содержание с учетом новых сообщений. Сохрани факты о бизнесе,
+цифры, принятые решения, договоренности и открытые вопросы. Пиши кратко,
+от третьего лица, не более 1500 символов. Ответь только текстом содержания."""
+    
     # Системные промпты по категориям
     SYSTEM_PROMPTS = {
         'general': """Ты - опытный бизнес-консультант, помогающий владельцам малого и среднего бизнеса. 
@@ -41,6 +55,10 @@ class PromptBuilder:
     def build_system_prompt(cls, conversation: Conversation) -> str:
         """
         Построение системного промпта с учетом категории и бизнеса
+        
+        Промпт собирается из уже загруженных объектов и не кэшируется: для
+        промпта без лишних запросов диалог стоит загружать с
+        select_related('business__profile').
         """
         # Базовый промпт по категории
         base_prompt = cls.SYSTEM_PROMPTS.get(
@@ -64,6 +82,14 @@ class PromptBuilder:
         
         return base_prompt
     
+    @staticmethod
+    def _get_profile(business: Business):
+        """Профиль бизнеса или None, если он не создан"""
+        try:
+            return business.profile
+        except BusinessProfile.DoesNotExist:
+            return None
+    
     @classmethod
     def _build_business_context(cls, business: Business) -> str:
         """
@@ -82,9 +108,8 @@ class PromptBuilder:
             context_parts.append(f"Описание: {business.description}")
         
         # Информация из профиля
-        if hasattr(business, 'profile'):
-            profile = business.profile
-            
+        profile = cls._get_profile(business)
+        if profile:
             if profile.employees_count:
                 context_parts.append(f"Количество сотрудников: {profile.employees_count}")
             
@@ -107,41 +132,139 @@ class PromptBuilder:
         return "\n".join(context_parts)
     
     @classmethod
-    def build_messages_history(cls, conversation: Conversation, limit: int = 10) -> List[Dict[str, str]]:
+    def build_messages_history(
+        cls,
+        conversation: Conversation,
+        limit: int = 50,
+        model: Optional[str] = None,
+        token_budget: Optional[int] = None
+    ) -> List[Dict[str, str]]:
         """
         Построение истории сообщений для контекста
         
+        Если для диалога есть краткое содержание (metadata['summary']), оно
+        добавляется вторым системным сообщением, а из истории берутся только
+        более новые сообщения.
+        
+        История набирается от новых сообщений к старым, пока помещается в
+        бюджет токенов модели (вместе с системным промптом). Сообщение, не
+        помещающееся целиком, обрезается, если для него осталось хотя бы
+        LLM_HISTORY_MIN_TRUNCATED_TOKENS токенов, иначе более старые сообщения
+        отбрасываются. Последнее сообщение включается всегда (при необходимости
+        обрезанным).
+        
         Args:
             conversation: Диалог
-            limit: Максимальное количество последних сообщений (по умолчанию 10)
+            limit: Максимальное количество последних сообщений (по умолчанию 50)
+            model: Модель, для которой строится промпт (бюджет из LLM_CONTEXT_BUDGETS)
+            token_budget: Явный бюджет токенов (переопределяет бюджет модели)
         
         Returns:
             Список сообщений в формате OpenAI
         """
-        messages = []
+        if token_budget is None:
+            token_budget = settings.LLM_CONTEXT_BUDGETS.get(model, settings.LLM_CONTEXT_BUDGET)
         
-        # Добавляем системный промпт
-        system_prompt = cls.build_system_prompt(conversation)
-        messages.append({
+        # Системный промпт
+        system_message = {
             "role": "system",
-            "content": system_prompt
-        })
+            "content": cls.build_system_prompt(conversation)
+        }
+        remaining = token_budget - count_message_tokens(system_message)
+        prefix = [system_message]
+        
+        history = conversation.messages.exclude(role=Message.Role.SYSTEM)
         
-        # Добавляем историю сообщений (последние N)
-        history = conversation.messages.order_by('-created_at')[:limit]
-        history = reversed(list(history))  # От старых к новым
+        # Старая часть диалога передается кратким содержанием (см. ConversationSummarizer),
+        # сырые сообщения - только после нее
+        summary = (conversation.metadata or {}).get('summary')
+        if summary and summary.get('text'):
+            summary_message = {
+                "role": "system",
+                "content": f"Краткое содержание предыдущей части диалога:\n{summary['text']}"
+            }
+            prefix.append(summary_message)
+            remaining -= count_message_tokens(summary_message)
+            history = cls.after_summary(history, summary)
         
+        # Последние N сообщений от новых к старым (системные пропускаем)
+        history = history.order_by('-created_at', '-id').only('role', 'content')[:limit]
+        
+        selected = []
         for msg in history:
-            # Пропускаем системные сообщения
-            if msg.role == Message.Role.SYSTEM:
-                continue
-            
-            messages.append({
+            message = {
                 "role": msg.role,
                 "content": msg.content
-            })
+            }
+            cost = count_message_tokens(message)
+            
+            if cost <= remaining:
+                selected.append(message)
+                remaining -= cost
+                continue
+            
+            # Не помещается целиком: обрезаем, если остается достаточно места
+            available = remaining - MESSAGE_OVERHEAD
+            if not selected or available >= settings.LLM_HISTORY_MIN_TRUNCATED_TOKENS:
+                message['content'] = truncate_to_tokens(
+                    msg.content, max(available, 0), marker=cls.TRUNCATED_MARKER
+                )
+                selected.append(message)
+            break
+        
+        # От старых к новым
+        return prefix + selected[::-1]
+    
+    @staticmethod
+    def after_summary(messages, summary: Dict):
+        """
+        Сообщения после сжатой части диалога
+        
+        Граница сравнивается парой (created_at, id) - в том же порядке, в
+        котором история сжимается: у импортированных сообщений id больше,
+        чем у более поздних по времени живых сообщений. Содержание в старом
+        формате (без until_created_at) ограничивается только по id.
+        """
+        until_created_at = summary.get('until_created_at')
+        if not until_created_at:
+            return messages.filter(id__gt=summary['until_message_id'])
+        until_created_at = parse_datetime(until_created_at)
+        return messages.filter(
+            Q(created_at__gt=until_created_at) |
+            Q(created_at=until_created_at, id__gt=summary['until_message_id'])
+        )
+    
+    @classmethod
+    def build_summary_request(
+        cls,
+        previous_summary: str,
+        messages: List[Message],
+        message_tokens: int = 500
+    ) -> List[Dict[str, str]]:
+        """
+        Построение запроса на обновление краткого содержания диалога
+        
+        Args:
+            previous_summary: Текущее краткое содержание (может быть пустым)
+            messages: Сообщения, выпадающие из окна истории (от старых к новым)
+            message_tokens: Максимум токенов на одно сообщение
+        
+        Returns:
+            Список сообщений в формате OpenAI
+        """
+        roles = {Message.Role.USER: 'Владелец бизнеса', Message.Role.ASSISTANT: 'Консультант'}
+        dialog = "\n\n".join(
+            f"{roles.get(msg.role, msg.role)}: {truncate_to_tokens(msg.content, message_tokens, marker=cls.TRUNCATED_MARKER)}"
+            for msg in messages
+        )
         
-        return messages
+        return [
+            {"role": "system", "content": cls.SUMMARY_PROMPT},
+            {
+                "role": "user",
+                "content": f"ТЕКУЩЕЕ СОДЕРЖАНИЕ:\n{previous_summary or '(пусто)'}\n\nНОВЫЕ СООБЩЕНИЯ:\n{dialog}"
+            },
+        ]
     
     @classmethod
     def format_error_response(cls, error_type: str) -> str:
@@ -0,0 +1,272 @@
+"""
+Лимиты запросов к LLM моделям: бюджет RPM/TPM и адаптивная конкурентность
+
+Бесплатные модели OpenRouter имеют жесткие лимиты запросов и токенов в
+минуту. Вместо того чтобы отправлять запросы до RateLimitError и терять
+round trip, LLMService перед запросом получает у ModelRateLimiter
+разрешение: если бюджет минуты исчерпан или у модели уже максимум
+одновременных запросов, запрос немного ждет (до LLM_RATE_LIMIT_MAX_WAIT
+секунд), а затем переходит к следующей модели цепочки.
+
+Состояние хранится в общем кэше (Redis), счетчики изменяются атомарными
+incr/decr, поэтому лимит общий для всех воркеров.
+"""
+import logging
+import math
+import time
+from datetime import datetime, timezone as dt_timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+
+class ModelRateLimited(Exception):
+    """Модель не получила разрешение на запрос: исчерпан лимит или конкурентность"""
+
+
+class ModelPermit:
+    """
+    Разрешение на один запрос к модели
+    
+    Занимает слот конкурентности до release(); release() также поправляет
+    бюджет токенов минуты на фактический расход ответа.
+    """
+    
+    def __init__(self, limiter: 'ModelRateLimiter', model: str, window: Optional[int], tokens: int,
+                 holds_slot: bool):
+        self.limiter = limiter
+        self.model = model
+        self.window = window
+        self.tokens = tokens
+        self.holds_slot = holds_slot
+        self.released = False
+    
+    def release(self, tokens_used: Optional[int] = None):
+        """Освобождает слот (повторный вызов ничего не делает)"""
+        if self.released:
+            return
+        self.released = True
+        
+        limiter = self.limiter
+        try:
+            if self.window is not None and tokens_used is not None and tokens_used != self.tokens:
+                limiter._adjust(limiter._tokens_key(self.model, self.window), tokens_used - self.tokens)
+            if self.holds_slot:
+                inflight_key = limiter._inflight_key(self.model)
+                inflight = limiter._adjust(inflight_key, -1)
+                if inflight < 0:
+                    # Счетчик истек и создан заново, пока запрос выполнялся
+                    limiter._adjust(inflight_key, -inflight)
+        except Exception as e:
+            logger.warning(f"Не удалось освободить разрешение модели {self.model}: {e}")
+
+
+class ModelRateLimiter:
+    """
+    Бюджет запросов/токенов в минуту и AIMD конкурентность по моделям
+    
+    Бюджет минуты - счетчики запросов и токенов в окне текущей минуты
+    (ведро пополняется в начале каждой минуты). Лимиты модели задаются в
+    LLM_RATE_LIMITS ({'модель': {'rpm': 20, 'tpm': 40000}}), для остальных
+    действуют LLM_DEFAULT_RPM и LLM_DEFAULT_TPM (0 - без лимита).
+    
+    Конкурентность - AIMD: каждый успешный ответ увеличивает лимит
+    одновременных запросов модели на 1/лимит (примерно +1 за "поколение"
+    запросов), ответ 429 уменьшает его вдвое, но не ниже LLM_AIMD_MIN_CONCURRENCY.
+    """
+    
+    KEY_PREFIX = 'llm:rate:'
+    WINDOW = 60
+    POLL_INTERVAL = 0.1
+    
+    def __init__(self, cache_backend=None):
+        self.cache = cache_backend or cache
+        self.limits = settings.LLM_RATE_LIMITS
+        self.default_rpm = settings.LLM_DEFAULT_RPM
+        self.default_tpm = settings.LLM_DEFAULT_TPM
+        self.max_wait = settings.LLM_RATE_LIMIT_MAX_WAIT
+        self.min_concurrency = settings.LLM_AIMD_MIN_CONCURRENCY
+        self.max_concurrency = settings.LLM_AIMD_MAX_CONCURRENCY
+        self.max_retry_after = settings.LLM_RETRY_AFTER_MAX
+    
+    def _requests_key(self, model: str, window: int) -> str:
+        return f'{self.KEY_PREFIX}{model}:requests:{window}'
+    
+    def _tokens_key(self, model: str, window: int) -> str:
+        return f'{self.KEY_PREFIX}{model}:tokens:{window}'
+    
+    def _inflight_key(self, model: str) -> str:
+        return f'{self.KEY_PREFIX}{model}:inflight'
+    
+    def _concurrency_key(self, model: str) -> str:
+        return f'{self.KEY_PREFIX}{model}:concurrency'
+    
+    def model_limits(self, model: str) -> Dict[str, int]:
+        """Лимиты модели в минуту (0 - без лимита)"""
+        limits = self.limits.get(model, {})
+        return {
+            'rpm': limits.get('rpm', self.default_rpm),
+            'tpm': limits.get('tpm', self.default_tpm),
+        }
+    
+    def concurrency(self, model: str) -> float:
+        """Текущий лимит одновременных запросов модели"""
+        try:
+            value = self.cache.get(self._concurrency_key(model))
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать лимит конкурентности модели {model}: {e}")
+            value = None
+        return self.max_concurrency if value is None else value
+    
+    def acquire(self, model: str, tokens: int = 0, max_wait: Optional[float] = None) -> Optional[ModelPermit]:
+        """
+        Получает разрешение на запрос, при необходимости ожидая
+        
+        Args:
+            model: Модель
+            tokens: Оценка токенов запроса (промпт)
+            max_wait: Сколько секунд можно ждать (по умолчанию LLM_RATE_LIMIT_MAX_WAIT)
+        
+        Returns:
+            ModelPermit или None, если разрешение не получено за max_wait
+        """
+        deadline = time.time() + (self.max_wait if max_wait is None else max_wait)
+        
+        while True:
+            try:
+                permit, wait = self._try_acquire(model, tokens)
+            except Exception as e:
+                # Недоступность кэша не должна останавливать генерацию
+                logger.warning(f"Лимиты модели {model} недоступны, запрос без ограничений: {e}")
+                return ModelPermit(self, model, None, tokens, holds_slot=False)
+            
+            if permit:
+                return permit
+            
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                logger.warning(f"✗ Модель {model} не получила разрешение на запрос за отведенное время")
+                return None
+            time.sleep(min(wait, remaining))
+    
+    def _try_acquire(self, model: str, tokens: int):
+        """
+        Одна попытка получить разрешение
+        
+        Returns:
+            (ModelPermit, 0) или (None, сколько секунд подождать до следующей попытки)
+        """
+        now = time.time()
+        window = int(now // self.WINDOW)
+        until_next_window = (window + 1) * self.WINDOW - now
+        limits = self.model_limits(model)
+        
+        # Слот конкурентности
+        inflight_key = self._inflight_key(model)
+        inflight = self._adjust(inflight_key, 1, timeout=settings.OPENROUTER_TIMEOUT * 2)
+        if inflight > math.floor(self.concurrency(model)):
+            self._adjust(inflight_key, -1)
+            return None, self.POLL_INTERVAL
+        
+        # Бюджет запросов минуты
+        if limits['rpm']:
+            requests_key = self._requests_key(model, window)
+            if self._adjust(requests_key, 1, timeout=self.WINDOW * 2) > limits['rpm']:
+                self._adjust(requests_key, -1)
+                self._adjust(inflight_key, -1)
+                return None, until_next_window
+        
+        # Бюджет токенов минуты. Запрос крупнее всего бюджета пропускается
+        # в пустом окне, иначе он не выполнился бы никогда
+        if limits['tpm'] and tokens:
+            tokens_key = self._tokens_key(model, window)
+            used = self._adjust(tokens_key, tokens, timeout=self.WINDOW * 2)
+            if used > limits['tpm'] and used != tokens:
+                self._adjust(tokens_key, -tokens)
+                if limits['rpm']:
+                    self._adjust(self._requests_key(model, window), -1)
+                self._adjust(inflight_key, -1)
+                return None, until_next_window
+        
+        return ModelPermit(self, model, window, tokens, holds_slot=True), 0
+    
+    def _adjust(self, key: str, delta: int, timeout: Optional[int] = None) -> int:
+        """Атомарно изменяет счетчик (создавая его при необходимости)"""
+        if timeout is not None:
+            self.cache.add(key, 0, timeout=timeout)
+        try:
+            return self.cache.incr(key, delta)
+        except ValueError:
+            # Счетчик истек между add и incr
+            self.cache.add(key, max(delta, 0), timeout=timeout or self.WINDOW * 2)
+            return max(delta, 0)
+    
+    def record_success(self, model: str):
+        """Аддитивное увеличение лимита конкурентности после успешного ответа"""
+        current = self.concurrency(model)
+        if current >= self.max_concurrency:
+            return
+        self._set_concurrency(model, min(self.max_concurrency, current + 1 / current))
+    
+    def record_rate_limit(self, model: str, error: Exception = None) -> Optional[float]:
+        """
+        Мультипликативное уменьшение лимита конкурентности после ответа 429
+        
+        Returns:
+            Сколько секунд не обращаться к модели по заголовкам ответа
+            (Retry-After, X-RateLimit-Reset) или None
+        """
+        current = self.concurrency(model)
+        self._set_concurrency(model, max(self.min_concurrency, current / 2))
+        
+        retry_after = self.retry_after(error) if error is not None else None
+        logger.warning(
+            f"Лимит конкурентности модели {model} снижен до {max(self.min_concurrency, current / 2):.1f}"
+            + (f", Retry-After {retry_after:.0f}с" if retry_after is not None else '')
+        )
+        return retry_after
+    
+    def _set_concurrency(self, model: str, value: float):
+        try:
+            self.cache.set(self._concurrency_key(model), value, timeout=None)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить лимит конкурентности модели {model}: {e}")
+    
+    def retry_after(self, error: Exception) -> Optional[float]:
+        """
+        Пауза из заголовков ответа 429 в секундах (не больше LLM_RETRY_AFTER_MAX)
+        
+        Поддерживаются retry-after-ms, Retry-After (секунды или HTTP дата) и
+        X-RateLimit-Reset (unix time в секундах или миллисекундах, как у OpenRouter).
+        """
+        response = getattr(error, 'response', None)
+        headers = getattr(response, 'headers', None)
+        if not headers:
+            return None
+        
+        seconds = None
+        try:
+            if headers.get('retry-after-ms'):
+                seconds = float(headers['retry-after-ms']) / 1000
+            elif headers.get('retry-after'):
+                value = headers['retry-after']
+                try:
+                    seconds = float(value)
+                except ValueError:
+                    seconds = (parsedate_to_datetime(value) - datetime.now(dt_timezone.utc)).total_seconds()
+            elif headers.get('x-ratelimit-reset'):
+                reset = float(headers['x-ratelimit-reset'])
+                if reset > 1e11:
+                    reset /= 1000
+                seconds = reset - time.time()
+        except (TypeError, ValueError) as e:
+            logger.warning(f"Не удалось разобрать заголовки rate limit: {e}")
+            return None
+        
+        if seconds is None:
+            return None
+        return min(max(seconds, 0.0), self.max_retry_after)
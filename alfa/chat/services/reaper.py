@@ -0,0 +1,150 @@
+"""
+Обработка зависших сообщений пользователя
+
+Если воркер Celery упал во время генерации (или задачу убил
+CELERY_TASK_TIME_LIMIT), сообщение навсегда остается в статусе
+"обрабатывается", а клиент ждет ответа бесконечно. Периодическая задача
+reap_stale_messages находит сообщения, зависшие в статусах "ожидает" и
+"обрабатывается" дольше своего срока, и ставит генерацию заново, а после
+CHAT_STALE_MAX_REQUEUES повторных постановок помечает их ошибкой. Диалоги,
+блокировка которых занята (идет генерация, см. ConversationLock), не
+трогаются.
+"""
+import logging
+from datetime import timedelta
+from typing import Dict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from chat.models import Message
+from .events import ChatEvents, publish_event
+from .locks import ConversationLock
+
+logger = logging.getLogger(__name__)
+
+
+class StaleMessageReaper:
+    """
+    Повторная постановка или завершение ошибкой зависших сообщений
+    
+    Срок считается от последней смены статуса - status_changed_at (индекс
+    processing_status, status_changed_at): "обрабатывается" - от захвата
+    пачки задачей, "ожидает" - от отправки или постановки на повтор.
+    Повторная генерация безопасна, даже если исходная задача еще жива:
+    она ждет блокировку диалога, а уже обработанное сообщение пропускает.
+    Счетчики результатов копятся в Redis (см. metrics).
+    """
+    
+    METRICS_KEY_PREFIX = 'chat:reaper:'
+    METRICS = ('requeued', 'failed')
+    
+    def __init__(self, pending_after: int = None, processing_after: int = None,
+                 max_requeues: int = None, batch_size: int = None):
+        self.deadlines = {
+            Message.ProcessingStatus.PENDING: pending_after or settings.CHAT_STALE_PENDING_AFTER,
+            Message.ProcessingStatus.PROCESSING: processing_after or settings.CHAT_STALE_PROCESSING_AFTER,
+        }
+        self.max_requeues = settings.CHAT_STALE_MAX_REQUEUES if max_requeues is None else max_requeues
+        self.batch_size = batch_size or settings.CHAT_STALE_BATCH_SIZE
+    
+    def run(self) -> Dict[str, int]:
+        """
+        Обрабатывает зависшие сообщения
+        
+        Returns:
+            {'requeued': int, 'failed': int}
+        """
+        from chat.tasks import generate_ai_response
+        
+        result = {'requeued': 0, 'failed': 0}
+        stale = self._stale_messages()
+        requeued_ids = set()
+        # Живая генерация продлевает блокировку диалога между стадиями
+        busy = {
+            conversation_id for conversation_id in {message.conversation_id for message in stale}
+            if ConversationLock(conversation_id).is_held()
+        }
+        
+        for message in stale:
+            if message.conversation_id in busy:
+                continue
+            
+            requeues = message.metadata.get('requeues', 0)
+            if requeues >= self.max_requeues:
+                message.processing_status = Message.ProcessingStatus.FAILED
+                message.status_changed_at = timezone.now()
+                message.save(update_fields=['processing_status', 'status_changed_at'])
+                self._publish_status(message)
+                result['failed'] += 1
+                continue
+            
+            message.processing_status = Message.ProcessingStatus.PENDING
+            message.status_changed_at = timezone.now()
+            message.metadata = {**message.metadata, 'requeues': requeues + 1}
+            message.save(update_fields=['processing_status', 'status_changed_at', 'metadata'])
+            self._publish_status(message)
+            result['requeued'] += 1
+            requeued_ids.add(message.id)
+            
+            # Присоединенное сообщение генерируется задачей своей пачки, если
+            # ведущее поставлено заново (сообщения идут по возрастанию id)
+            if message.coalesced_into_id in requeued_ids:
+                continue
+            
+            generate_ai_response.apply_async(args=[message.id], task_id=message.metadata.get('task_id'))
+        
+        if stale:
+            logger.warning(
+                f"✗ Зависшие сообщения: поставлено заново {result['requeued']}, "
+                f"помечено ошибкой {result['failed']}"
+            )
+            self._record(result)
+        
+        return result
+    
+    def _stale_messages(self):
+        """Сообщения пользователя, зависшие дольше срока своего статуса"""
+        now = timezone.now()
+        stale = []
+        for status, deadline in self.deadlines.items():
+            stale.extend(
+                Message.objects.filter(
+                    processing_status=status,
+                    status_changed_at__lt=now - timedelta(seconds=deadline),
+                    role=Message.Role.USER
+                ).order_by('status_changed_at')[:self.batch_size]
+            )
+        return sorted(stale, key=lambda message: message.id)
+    
+    @staticmethod
+    def _publish_status(message: Message):
+        publish_event(message.conversation_id, ChatEvents.MESSAGE_STATUS, {
+            'message_id': message.id,
+            'processing_status': message.processing_status,
+            'processing_status_display': message.get_processing_status_display(),
+        })
+    
+    @classmethod
+    def _record(cls, result: Dict[str, int]):
+        """Накопительные счетчики в Redis (без TTL)"""
+        for name in cls.METRICS:
+            if not result[name]:
+                continue
+            key = f'{cls.METRICS_KEY_PREFIX}{name}'
+            try:
+                cache.add(key, 0, timeout=None)
+                cache.incr(key, result[name])
+            except Exception as e:
+                logger.warning(f"Не удалось обновить счетчик {key}: {e}")
+    
+    @classmethod
+    def metrics(cls) -> Dict[str, int]:
+        """Сколько сообщений всего поставлено заново и помечено ошибкой"""
+        try:
+            values = cache.get_many([f'{cls.METRICS_KEY_PREFIX}{name}' for name in cls.METRICS])
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать счетчики: {e}")
+            values = {}
+        return {name: values.get(f'{cls.METRICS_KEY_PREFIX}{name}', 0) for name in cls.METRICS}
@@ -0,0 +1,29 @@
+"""
+Прямой доступ к Redis за кэшем Django
+
+Кэш Django не умеет атомарных операций сложнее add/incr (скрипты Lua,
+списки с обрезкой). Для кэша на RedisCache отдаем клиент redis-py и полный
+ключ с префиксом и версией; для других бэкендов (locmem в тестах) - None,
+вызывающий код откатывается на обычные операции кэша.
+"""
+from typing import Optional, Tuple
+
+from django.core.cache.backends.redis import RedisCache
+
+
+def get_redis_client(cache_backend, key: str) -> Optional[Tuple[object, str]]:
+    """
+    Клиент redis-py для записи и полный ключ в Redis
+    
+    Args:
+        cache_backend: Бэкенд кэша (caches['alias'], не прокси django.core.cache.cache)
+        key: Ключ кэша без префикса
+    
+    Returns:
+        (redis.Redis, ключ) или None, если кэш не на Redis
+    """
+    if not isinstance(cache_backend, RedisCache):
+        return None
+    
+    full_key = cache_backend.make_and_validate_key(key)
+    return cache_backend._cache.get_client(full_key, write=True), full_key
@@ -0,0 +1,93 @@
+"""
+Кэш ответов LLM для повторяющихся запросов
+
+Владельцы похожих бизнесов часто задают одни и те же вопросы в одной
+категории. Ключ кэша - хэш нормализованной истории сообщений (системный
+промпт с контекстом бизнеса + диалог), модели и temperature, поэтому
+ответ переиспользуется только при полностью совпадающем контексте.
+"""
+import json
+import hashlib
+import logging
+import unicodedata
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """
+    Кэш ответов LLM в Redis
+    
+    Записи хранятся LLM_RESPONSE_CACHE_TTL секунд в кэше 'llm' - отдельном
+    экземпляре Redis, который при нехватке памяти вытесняет их по LRU
+    (maxmemory-policy allkeys-lru), не трогая очереди Celery и блокировки.
+    """
+    
+    KEY_PREFIX = 'llm:response:'
+    
+    def __init__(self, cache_backend=None):
+        self.cache = cache_backend or caches['llm']
+        self.enabled = settings.LLM_RESPONSE_CACHE_ENABLED
+        self.ttl = settings.LLM_RESPONSE_CACHE_TTL
+    
+    @staticmethod
+    def normalize(messages: List[Dict[str, str]]) -> List[List[str]]:
+        """
+        Нормализует историю сообщений для ключа кэша
+        
+        Unicode приводится к NFKC, пробелы схлопываются, сообщения
+        пользователя сравниваются без учета регистра.
+        """
+        normalized = []
+        for message in messages:
+            content = unicodedata.normalize('NFKC', message['content'] or '')
+            content = ' '.join(content.split())
+            if message['role'] == 'user':
+                content = content.casefold()
+            normalized.append([message['role'], content])
+        return normalized
+    
+    def make_key(self, messages: List[Dict[str, str]], model: str, temperature: float) -> str:
+        """Ключ кэша для истории сообщений, модели и temperature"""
+        payload = json.dumps(
+            [self.normalize(messages), model, round(temperature, 2)],
+            ensure_ascii=False,
+            separators=(',', ':')
+        )
+        return self.KEY_PREFIX + hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    
+    def get(self, key: str) -> Optional[Dict]:
+        """Закэшированный ответ или None"""
+        try:
+            return self.cache.get(key)
+        except Exception as e:
+            # Недоступность кэша не должна ломать генерацию ответа
+            logger.warning(f"Не удалось прочитать кэш ответов: {e}")
+            return None
+    
+    def set(self, key: str, response: Dict[str, any]):
+        """Сохраняет успешный ответ модели"""
+        entry = {
+            'content': response['content'],
+            'model': response['model'],
+            'tokens_used': response['tokens_used'],
+            'finish_reason': response['metadata'].get('finish_reason'),
+        }
+        try:
+            self.cache.set(key, entry, timeout=self.ttl)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить ответ в кэш: {e}")
+    
+    @staticmethod
+    def is_cacheable(response: Dict[str, any]) -> bool:
+        """Кэшируются только полные ответы без ошибок"""
+        metadata = response['metadata']
+        return (
+            not metadata.get('error')
+            and bool(response['content'])
+            and metadata.get('finish_reason') != 'length'
+        )
@@ -0,0 +1,308 @@
+"""
+Семантический кэш ответов на первые вопросы диалога
+
+Точный кэш не находит перефразированные вопросы ("как открыть ИП" и
+"как зарегистрировать ИП"). Здесь вопрос превращается в вектор хэшированных
+n-грамм (без внешних моделей, только CPU) и сравнивается по косинусной
+близости с уже отвеченными вопросами с тем же системным промптом.
+"""
+import re
+import json
+import math
+import hashlib
+import time
+import uuid
+import zlib
+import logging
+import unicodedata
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+
+from chat.models import Conversation
+from users.models import Business
+from .prompt_builder import PromptBuilder
+from .redis_client import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+
+class HashingVectorizer:
+    """
+    Векторизация текста хэшированием n-грамм
+    
+    Признаки: слова и символьные n-граммы слов (3-5 символов). Индекс
+    признака - crc32 (стабилен между процессами в отличие от hash()), знак
+    берется из старшего бита, чтобы коллизии в среднем гасили друг друга.
+    Вектор разреженный (dict индекс -> вес) и нормирован по L2.
+    """
+    
+    WORD_RE = re.compile(r'\w+')
+    
+    def __init__(self, n_features: int = 2 ** 20, ngram_range: Tuple[int, int] = (3, 5)):
+        self.n_features = n_features
+        self.ngram_range = ngram_range
+    
+    def _features(self, text: str):
+        """Пары (признак, вес) текста"""
+        text = unicodedata.normalize('NFKC', text).casefold().replace('ё', 'е')
+        for word in self.WORD_RE.findall(text):
+            yield 'w:' + word, 1.0
+            
+            # N-граммы дают устойчивость к словоформам. Их суммарный вес
+            # нормируется на слово, иначе длинные слова ("зарегистрировать")
+            # заглушают короткие, но важные ("ИП" / "ООО")
+            padded = f' {word} '
+            ngrams = [
+                padded[i:i + n]
+                for n in range(self.ngram_range[0], self.ngram_range[1] + 1)
+                for i in range(len(padded) - n + 1)
+            ]
+            weight = 1.0 / math.sqrt(len(ngrams)) if ngrams else 0.0
+            for ngram in ngrams:
+                yield ngram, weight
+    
+    def transform(self, text: str) -> Dict[int, float]:
+        """Разреженный L2-нормированный вектор текста"""
+        vector = {}
+        for feature, weight in self._features(text):
+            h = zlib.crc32(feature.encode('utf-8'))
+            index = h % self.n_features
+            vector[index] = vector.get(index, 0.0) + (weight if h & 0x80000000 else -weight)
+        
+        norm = math.sqrt(sum(value * value for value in vector.values()))
+        if not norm:
+            return {}
+        return {index: value / norm for index, value in vector.items() if value}
+    
+    @staticmethod
+    def similarity(a: Dict[int, float], b: Dict[int, float]) -> float:
+        """Косинусная близость нормированных векторов"""
+        if len(a) > len(b):
+            a, b = b, a
+        return sum(value * b.get(index, 0.0) for index, value in a.items())
+
+
+class SemanticCache:
+    """
+    Семантический кэш ответов в Redis
+    
+    Индекс хранится отдельно для каждого системного промпта (категория, тип
+    бизнеса и хэш промпта): в промпт входят название, город, описание и
+    контекст бизнеса, поэтому персонализированный ответ одного бизнеса не
+    достается другому. Индекс - список Redis из компактных записей
+    [id, created_at, vector], новые в начале.
+    Поиск - полный перебор по индексу (не более LLM_SEMANTIC_CACHE_MAX_ENTRIES
+    записей), при переполнении самые старые отрезаются LTRIM. Вопрос и ответ
+    лежат под отдельным ключом записи и читаются только для лучшего совпадения.
+    
+    Используется только для первого вопроса диалога: дальше ответ зависит
+    от предыдущих сообщений. Метрики считаются по паре (категория, тип
+    бизнеса) без хэша промпта.
+    """
+    
+    KEY_PREFIX = 'llm:semantic:index:'
+    ENTRY_KEY_PREFIX = 'llm:semantic:entry:'
+    STATS_KEY_PREFIX = 'llm:semantic:stats:'
+    
+    # Границы гистограммы лучшей близости (для подбора порога)
+    SIMILARITY_BUCKETS = (0.5, 0.7, 0.8, 0.9, 0.95)
+    
+    def __init__(self, cache_backend=None):
+        self.cache = cache_backend or caches['llm']
+        self.enabled = settings.LLM_SEMANTIC_CACHE_ENABLED
+        self.threshold = settings.LLM_SEMANTIC_CACHE_THRESHOLD
+        self.max_entries = settings.LLM_SEMANTIC_CACHE_MAX_ENTRIES
+        self.ttl = settings.LLM_SEMANTIC_CACHE_TTL
+        self.vectorizer = HashingVectorizer()
+    
+    @staticmethod
+    def index_name(conversation: Conversation) -> str:
+        """Имя группы индексов для метрик: категория промпта и тип бизнеса диалога"""
+        category = conversation.category if conversation.category in PromptBuilder.SYSTEM_PROMPTS else 'general'
+        business_type = conversation.business.business_type if conversation.business_id else 'none'
+        return f'{category}:{business_type}'
+    
+    @classmethod
+    def index_key(cls, conversation: Conversation, messages: List[Dict[str, str]]) -> str:
+        """Имя индекса: группа и хэш системных сообщений промпта"""
+        system_prompt = '\n'.join(m['content'] for m in messages if m['role'] == 'system')
+        digest = hashlib.sha256(system_prompt.encode('utf-8')).hexdigest()[:16]
+        return f'{cls.index_name(conversation)}:{digest}'
+    
+    @staticmethod
+    def is_first_turn(messages) -> bool:
+        """Первый вопрос диалога: в истории только одно сообщение пользователя"""
+        dialog = [m for m in messages if m['role'] != 'system']
+        return len(dialog) == 1 and dialog[0]['role'] == 'user'
+    
+    def _load(self, index_name: str) -> List[List]:
+        """Записи индекса [id, created_at, vector], новые первыми"""
+        key = self.KEY_PREFIX + index_name
+        try:
+            redis = get_redis_client(self.cache, key)
+            if redis is None:
+                return self.cache.get(key) or []
+            client, full_key = redis
+            # JSON не хранит целые ключи словаря, поэтому вектор - список пар
+            return [
+                [entry_id, created_at, dict(vector)]
+                for entry_id, created_at, vector in map(json.loads, client.lrange(full_key, 0, self.max_entries - 1))
+            ]
+        except Exception as e:
+            # Недоступность кэша не должна ломать генерацию ответа
+            logger.warning(f"Не удалось прочитать семантический кэш {index_name}: {e}")
+            return []
+    
+    def _push(self, index_name: str, entry_id: str, created_at: float, vector: Dict[int, float]):
+        """Добавляет запись в начало индекса и обрезает его до max_entries"""
+        key = self.KEY_PREFIX + index_name
+        redis = get_redis_client(self.cache, key)
+        if redis is None:
+            # Без Redis: get-modify-set, одновременная запись из двух воркеров
+            # может потерять одну запись - для кэша это допустимо
+            entries = [[entry_id, created_at, vector]] + self._load(index_name)
+            self.cache.set(key, entries[:self.max_entries], timeout=self.ttl)
+            return
+        
+        client, full_key = redis
+        pipe = client.pipeline()
+        pipe.lpush(full_key, json.dumps([entry_id, created_at, list(vector.items())]))
+        pipe.ltrim(full_key, 0, self.max_entries - 1)
+        pipe.expire(full_key, self.ttl)
+        pipe.execute()
+    
+    def lookup(self, conversation: Conversation, messages: List[Dict[str, str]],
+               question: str) -> Optional[Tuple[Dict, float]]:
+        """
+        Ищет ответ на близкий вопрос
+        
+        Args:
+            conversation: Диалог
+            messages: Промпт запроса (системные сообщения выбирают индекс)
+            question: Вопрос пользователя
+        
+        Returns:
+            (запись индекса, близость) или None
+        """
+        index_name = self.index_name(conversation)
+        vector = self.vectorizer.transform(question)
+        if not vector:
+            return None
+        
+        expired_before = time.time() - self.ttl
+        best_id, best_similarity = None, 0.0
+        for entry_id, created_at, entry_vector in self._load(self.index_key(conversation, messages)):
+            if created_at < expired_before:
+                continue
+            similarity = self.vectorizer.similarity(vector, entry_vector)
+            if similarity > best_similarity:
+                best_id, best_similarity = entry_id, similarity
+        
+        best = None
+        if best_id is not None and best_similarity >= self.threshold:
+            try:
+                best = self.cache.get(self.ENTRY_KEY_PREFIX + best_id)
+            except Exception as e:
+                logger.warning(f"Не удалось прочитать запись семантического кэша {best_id}: {e}")
+        
+        # Запись могла истечь или быть вытесненной раньше индекса - это промах
+        hit = best is not None
+        self._record_lookup(index_name, best_similarity, hit)
+        
+        if hit:
+            logger.info(
+                f"✓ Семантический кэш {index_name}: близость {best_similarity:.3f} "
+                f"с вопросом \"{best['question'][:50]}\""
+            )
+            return best, best_similarity
+        return None
+    
+    def add(self, conversation: Conversation, messages: List[Dict[str, str]],
+            question: str, response: Dict[str, any]):
+        """Добавляет ответ на первый вопрос диалога в индекс его системного промпта"""
+        vector = self.vectorizer.transform(question)
+        if not vector:
+            return
+        
+        index_name = self.index_key(conversation, messages)
+        entry_id = uuid.uuid4().hex
+        created_at = time.time()
+        entry = {
+            'question': question,
+            'content': response['content'],
+            'model': response['model'],
+            'tokens_used': response['tokens_used'],
+            'finish_reason': response['metadata'].get('finish_reason'),
+            'created_at': created_at,
+        }
+        
+        try:
+            self.cache.set(self.ENTRY_KEY_PREFIX + entry_id, entry, timeout=self.ttl)
+            self._push(index_name, entry_id, created_at, vector)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить семантический кэш {index_name}: {e}")
+    
+    def _bucket(self, similarity: float) -> str:
+        for bound in self.SIMILARITY_BUCKETS:
+            if similarity < bound:
+                return f'lt_{bound}'
+        return f'gte_{self.SIMILARITY_BUCKETS[-1]}'
+    
+    def _incr(self, key: str, delta=1):
+        try:
+            self.cache.add(key, 0, timeout=None)
+            self.cache.incr(key, delta)
+        except Exception as e:
+            logger.warning(f"Не удалось обновить метрику {key}: {e}")
+    
+    def _record_lookup(self, index_name: str, similarity: float, hit: bool):
+        prefix = self.STATS_KEY_PREFIX + index_name
+        self._incr(f'{prefix}:lookups')
+        self._incr(f'{prefix}:bucket:{self._bucket(similarity)}')
+        if hit:
+            self._incr(f'{prefix}:hits')
+            # Сумма близостей попаданий в тысячных долях (incr работает с целыми)
+            self._incr(f'{prefix}:hit_similarity', int(round(similarity * 1000)))
+    
+    def stats(self) -> Dict[str, Dict]:
+        """
+        Метрики по индексам: запросы, попадания, доля попаданий,
+        средняя близость попаданий и гистограмма лучшей близости
+        """
+        buckets = [f'lt_{bound}' for bound in self.SIMILARITY_BUCKETS]
+        buckets.append(f'gte_{self.SIMILARITY_BUCKETS[-1]}')
+        business_types = ['none'] + list(Business.BusinessType.values)
+        
+        keys = {}
+        for category in PromptBuilder.SYSTEM_PROMPTS:
+            for business_type in business_types:
+                prefix = f'{self.STATS_KEY_PREFIX}{category}:{business_type}'
+                names = ['lookups', 'hits', 'hit_similarity'] + [f'bucket:{b}' for b in buckets]
+                for name in names:
+                    keys[f'{prefix}:{name}'] = (f'{category}:{business_type}', name)
+        
+        try:
+            values = self.cache.get_many(list(keys))
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать метрики семантического кэша: {e}")
+            values = {}
+        
+        raw = {}
+        for key, value in values.items():
+            index_name, name = keys[key]
+            raw.setdefault(index_name, {})[name] = value
+        
+        result = {}
+        for index_name, counters in raw.items():
+            lookups = counters.get('lookups', 0)
+            hits = counters.get('hits', 0)
+            result[index_name] = {
+                'lookups': lookups,
+                'hits': hits,
+                'hit_rate': round(hits / lookups, 3) if lookups else 0.0,
+                'avg_hit_similarity': round(counters.get('hit_similarity', 0) / hits / 1000, 3) if hits else None,
+                'best_similarity_histogram': {b: counters.get(f'bucket:{b}', 0) for b in buckets},
+            }
+        return result
@@ -0,0 +1,131 @@
+"""
+Статистика диалогов пользователя
+
+Счетчики диалогов считаются одним запросом с условной агрегацией, счетчики
+сообщений берутся из агрегатов по дням (chat.services.usage). Результат
+кэшируется в Redis по пользователю. Кэш сбрасывается увеличением версии
+пользователя при записи диалога или сообщения (chat/signals.py): старые
+ключи просто перестают читаться и истекают по TTL.
+"""
+import logging
+from typing import Dict, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Max, Q
+
+from chat.models import Conversation
+from users.models import Business
+from .usage import UsageRollupService
+
+logger = logging.getLogger(__name__)
+
+
+class ConversationStats:
+    """
+    Статистика по диалогам пользователя (общая или по бизнесу)
+    """
+    
+    CACHE_PREFIX = 'chat:stats:'
+    VERSION_PREFIX = 'chat:stats:version:'
+    
+    @classmethod
+    def get(cls, user, business_id: Optional[str] = None) -> Dict:
+        """Статистика из кэша, при промахе - расчет и сохранение"""
+        cache_key = None
+        try:
+            version = cache.get(f'{cls.VERSION_PREFIX}{user.id}', 0)
+            cache_key = f"{cls.CACHE_PREFIX}{user.id}:{version}:{business_id or 'all'}"
+            stats = cache.get(cache_key)
+            if stats is not None:
+                return stats
+        except Exception as e:
+            # Недоступность кэша не должна ломать статистику
+            logger.warning(f"Не удалось прочитать кэш статистики пользователя {user.id}: {e}")
+        
+        stats = cls.compute(user, business_id)
+        
+        if cache_key:
+            try:
+                cache.set(cache_key, stats, timeout=settings.CHAT_STATS_CACHE_TTL)
+            except Exception as e:
+                logger.warning(f"Не удалось сохранить статистику пользователя {user.id} в кэш: {e}")
+        
+        return stats
+    
+    @classmethod
+    def invalidate(cls, user_id: int):
+        """Сбрасывает кэш статистики пользователя (все варианты фильтра по бизнесу)"""
+        key = f'{cls.VERSION_PREFIX}{user_id}'
+        try:
+            # Ключ версии без TTL, чтобы не вытеснялся раньше записей статистики
+            cache.add(key, 0, timeout=None)
+            cache.incr(key)
+        except Exception as e:
+            logger.warning(f"Не удалось сбросить кэш статистики пользователя {user_id}: {e}")
+    
+    @classmethod
+    def compute(cls, user, business_id: Optional[str] = None) -> Dict:
+        """
+        Расчет статистики
+        
+        Returns:
+            Словарь в формате ответа GET /api/chat/stats/
+        """
+        conversations = Conversation.objects.filter(user=user)
+        
+        if business_id:
+            conversations = conversations.filter(business_id=business_id)
+        
+        # Диалоги: счетчики по статусам и категориям одним запросом
+        status_counts = {
+            f'status_{value}': Count('id', filter=Q(status=value))
+            for value in Conversation.Status.values
+        }
+        category_counts = {
+            f'category_{value}': Count('id', filter=Q(category=value))
+            for value in Conversation.Category.values
+        }
+        conversation_totals = conversations.aggregate(
+            total=Count('id'),
+            last_activity=Max('last_message_at'),
+            **status_counts,
+            **category_counts
+        )
+        
+        # Сообщения: агрегаты по дням плюс еще не агрегированный хвост (см. UsageRollupService)
+        usage = UsageRollupService.totals(user, business_id)
+        
+        stats = {
+            'total_conversations': conversation_totals['total'],
+            'active_conversations': conversation_totals[f'status_{Conversation.Status.ACTIVE}'],
+            'archived_conversations': conversation_totals[f'status_{Conversation.Status.ARCHIVED}'],
+            'completed_conversations': conversation_totals[f'status_{Conversation.Status.COMPLETED}'],
+            'total_messages': usage['messages_count'],
+            'user_messages': usage['user_messages'],
+            'assistant_messages': usage['assistant_messages'],
+            'total_tokens_used': usage['tokens_used'],
+            'avg_response_time': usage['avg_response_time'],
+            'last_activity': conversation_totals['last_activity'],
+            'by_category': {}
+        }
+        
+        # Статистика по категориям
+        for category in Conversation.Category:
+            count = conversation_totals[f'category_{category.value}']
+            if count > 0:
+                stats['by_category'][category.value] = {
+                    'name': category.label,
+                    'count': count
+                }
+        
+        # Если запрашивается статистика по бизнесу, добавляем информацию о бизнесе
+        if business_id:
+            business = Business.objects.filter(id=business_id, owner=user).only('id', 'name').first()
+            if business:
+                stats['business'] = {
+                    'id': business.id,
+                    'name': business.name
+                }
+        
+        return stats
@@ -0,0 +1,140 @@
+"""
+Скользящее краткое содержание длинных диалогов
+
+Старые сообщения диалога постепенно сжимаются в краткое содержание,
+которое хранится в Conversation.metadata['summary'] и подставляется
+PromptBuilder вместо сырых старых сообщений. Размер промпта остается
+ограниченным независимо от длины диалога.
+
+Формат metadata['summary']:
+    text             - текст краткого содержания
+    until_message_id - ID последнего сообщения, вошедшего в содержание
+    until_created_at - его время создания (ISO): граница - пара (created_at, id)
+    messages_count   - сколько сообщений сжато
+    updated_at       - время обновления (ISO)
+"""
+import logging
+from typing import List, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from chat.models import Conversation, Message
+from .llm_service import LLMService
+from .prompt_builder import PromptBuilder
+from .tokens import MESSAGE_OVERHEAD, count_tokens
+
+logger = logging.getLogger(__name__)
+
+
+class ConversationSummarizer:
+    """
+    Инкрементальное обновление краткого содержания диалога
+    
+    Как только после уже сжатой части накапливается больше
+    LLM_SUMMARY_TRIGGER_MESSAGES сообщений, все, кроме последних
+    LLM_SUMMARY_KEEP_RECENT, добавляются в краткое содержание одним запросом
+    к LLM (предыдущее содержание + новые сообщения). Запрос ограничен
+    LLM_SUMMARY_MAX_INPUT_TOKENS: сначала сжимаются самые старые сообщения,
+    а следующий запуск продолжает с новой границы.
+    """
+    
+    LOCK_KEY_PREFIX = 'chat:summary:lock:'
+    LOCK_TIMEOUT = 300
+    # Максимум токенов одного сообщения в запросе
+    MESSAGE_TOKENS = 500
+    
+    def __init__(self, llm_service=None):
+        self.llm_service = llm_service
+        self.enabled = settings.LLM_SUMMARY_ENABLED
+        self.trigger = settings.LLM_SUMMARY_TRIGGER_MESSAGES
+        self.keep_recent = settings.LLM_SUMMARY_KEEP_RECENT
+        self.max_input_tokens = settings.LLM_SUMMARY_MAX_INPUT_TOKENS
+    
+    @staticmethod
+    def get_summary(conversation: Conversation) -> Optional[dict]:
+        """Текущее краткое содержание диалога"""
+        return (conversation.metadata or {}).get('summary')
+    
+    def _pending_messages(self, conversation: Conversation):
+        """Сообщения после уже сжатой части (без системных)"""
+        messages = conversation.messages.exclude(role=Message.Role.SYSTEM)
+        summary = self.get_summary(conversation)
+        if summary:
+            messages = PromptBuilder.after_summary(messages, summary)
+        return messages
+    
+    def _within_budget(self, messages) -> List[Message]:
+        """Самые старые сообщения, помещающиеся в LLM_SUMMARY_MAX_INPUT_TOKENS (хотя бы одно)"""
+        selected = []
+        remaining = self.max_input_tokens
+        for message in messages.iterator():
+            cost = min(count_tokens(message.content), self.MESSAGE_TOKENS) + MESSAGE_OVERHEAD
+            if selected and cost > remaining:
+                break
+            selected.append(message)
+            remaining -= cost
+        return selected
+    
+    def needs_update(self, conversation: Conversation) -> bool:
+        """Накопилось ли достаточно новых сообщений для обновления содержания"""
+        if not self.enabled:
+            return False
+        return self._pending_messages(conversation).count() > self.trigger
+    
+    def update(self, conversation_id: int) -> bool:
+        """
+        Обновляет краткое содержание диалога
+        
+        Returns:
+            True если содержание обновлено
+        """
+        lock_key = f'{self.LOCK_KEY_PREFIX}{conversation_id}'
+        if not cache.add(lock_key, 1, timeout=self.LOCK_TIMEOUT):
+            # Содержание уже обновляется другой задачей
+            return False
+        
+        try:
+            conversation = Conversation.objects.get(id=conversation_id)
+            pending = self._pending_messages(conversation).order_by('created_at', 'id')
+            pending_count = pending.count()
+            if pending_count <= self.trigger:
+                return False
+            
+            to_summarize = self._within_budget(
+                pending[:pending_count - self.keep_recent].only('id', 'role', 'content', 'created_at')
+            )
+            summary = self.get_summary(conversation) or {}
+            
+            request = PromptBuilder.build_summary_request(
+                summary.get('text', ''), to_summarize, message_tokens=self.MESSAGE_TOKENS
+            )
+            if self.llm_service is None:
+                self.llm_service = LLMService()
+            response = self.llm_service.complete(request, max_tokens=settings.LLM_SUMMARY_MAX_TOKENS)
+            
+            if not response or not response['content']:
+                logger.warning(f"✗ Не удалось обновить краткое содержание диалога {conversation_id}")
+                return False
+            
+            # Metadata перечитывается, чтобы не затереть ключи, записанные за время запроса
+            conversation.refresh_from_db(fields=['metadata'])
+            metadata = conversation.metadata or {}
+            metadata['summary'] = {
+                'text': response['content'].strip(),
+                'until_message_id': to_summarize[-1].id,
+                'until_created_at': to_summarize[-1].created_at.isoformat(),
+                'messages_count': summary.get('messages_count', 0) + len(to_summarize),
+                'updated_at': timezone.now().isoformat(),
+            }
+            conversation.metadata = metadata
+            conversation.save(update_fields=['metadata'])
+            
+            logger.info(
+                f"✓ Краткое содержание диалога {conversation_id} обновлено: "
+                f"+{len(to_summarize)} сообщений, модель {response['model']}"
+            )
+            return True
+        finally:
+            cache.delete(lock_key)
@@ -0,0 +1,58 @@
+"""
+Быстрая локальная оценка количества токенов
+
+Точные токенизаторы моделей OpenRouter разные и требуют загрузки словарей,
+поэтому для бюджета контекста используется оценка по словам: BPE токенизаторы
+кодируют латиницу примерно по 4 символа на токен, кириллицу и прочие
+алфавиты - примерно по 2.5 символа, знаки препинания - отдельными токенами.
+Оценка слегка завышена, чтобы промпт гарантированно помещался в бюджет.
+"""
+import math
+import re
+
+# Слово (буквы/цифры) или одиночный непробельный символ
+TOKEN_RE = re.compile(r'\w+|[^\w\s]')
+
+# Служебные токены на каждое сообщение (роль, разделители)
+MESSAGE_OVERHEAD = 4
+
+
+def _piece_tokens(piece: str) -> int:
+    return math.ceil(len(piece) / (4 if piece.isascii() else 2.5))
+
+
+def count_tokens(text: str) -> int:
+    """Оценка количества токенов в тексте"""
+    if not text:
+        return 0
+    return sum(_piece_tokens(piece) for piece in TOKEN_RE.findall(text))
+
+
+def count_message_tokens(message: dict) -> int:
+    """Оценка количества токенов сообщения в формате OpenAI"""
+    return count_tokens(message['content']) + MESSAGE_OVERHEAD
+
+
+def truncate_to_tokens(text: str, max_tokens: int, marker: str = '…') -> str:
+    """
+    Обрезает текст до max_tokens (по оценке count_tokens)
+    
+    Текст обрезается по границе слова с конца, в конец добавляется marker.
+    """
+    if count_tokens(text) <= max_tokens:
+        return text
+    
+    budget = max_tokens - count_tokens(marker)
+    if budget <= 0:
+        return ''
+    
+    used = 0
+    end = 0
+    for match in TOKEN_RE.finditer(text):
+        cost = _piece_tokens(match.group())
+        if used + cost > budget:
+            break
+        used += cost
+        end = match.end()
+    
+    return text[:end].rstrip() + marker
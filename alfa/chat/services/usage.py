@@ -0,0 +1,223 @@
+"""
+Агрегаты использования AI (сообщения, токены, время ответа)
+
+Периодическая задача rollup_usage переносит сообщения в таблицу UsageRollup
+(пользователь, бизнес, день), продвигая отметку RollupCheckpoint. При
+чтении к агрегатам добавляется "живой хвост" - сообщения после отметки,
+которых обычно немного, поэтому статистика не сканирует всю таблицу
+сообщений и при этом не отстает от реальных данных.
+"""
+import logging
+from datetime import timedelta
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Count, F, Q, Subquery, Sum
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+from chat.models import Message, RollupCheckpoint, UsageRollup
+
+logger = logging.getLogger(__name__)
+
+# Поля агрегатов UsageRollup
+USAGE_FIELDS = (
+    'messages_count',
+    'user_messages',
+    'assistant_messages',
+    'tokens_used',
+    'response_time_sum',
+    'responses_count',
+)
+
+
+def _message_aggregates() -> Dict:
+    """Агрегаты сообщений в терминах полей UsageRollup (с префиксом usage_)"""
+    return {
+        'usage_messages_count': Count('id'),
+        'usage_user_messages': Count('id', filter=Q(role=Message.Role.USER)),
+        'usage_assistant_messages': Count('id', filter=Q(role=Message.Role.ASSISTANT)),
+        'usage_tokens_used': Sum('tokens_used'),
+        'usage_response_time_sum': Sum('response_time'),
+        'usage_responses_count': Count('response_time'),
+    }
+
+
+def _rollup_aggregates() -> Dict:
+    """Суммы полей UsageRollup (с префиксом usage_)"""
+    return {f'usage_{field}': Sum(field) for field in USAGE_FIELDS}
+
+
+def _usage(row: Dict) -> Dict:
+    """Значения полей из строки агрегата (None -> 0)"""
+    return {field: row.get(f'usage_{field}') or 0 for field in USAGE_FIELDS}
+
+
+def _combine(*rows: Dict) -> Dict:
+    """Сумма агрегатов и среднее время ответа"""
+    total = {field: 0 for field in USAGE_FIELDS}
+    for row in rows:
+        for field in USAGE_FIELDS:
+            total[field] += row[field]
+    total['avg_response_time'] = (
+        round(total['response_time_sum'] / total['responses_count'], 3)
+        if total['responses_count'] else None
+    )
+    return total
+
+
+class UsageRollupService:
+    """
+    Инкрементальная агрегация сообщений и чтение агрегатов
+    """
+    
+    def __init__(self, batch_size: Optional[int] = None, lag: Optional[int] = None):
+        self.batch_size = batch_size or settings.CHAT_USAGE_ROLLUP_BATCH_SIZE
+        # Самые свежие по времени записи (inserted_at) сообщения не агрегируются:
+        # транзакция с меньшим ID может еще не быть зафиксирована, и отметка
+        # перескочила бы ее. Транзакции с сообщениями короткие (импорт идет
+        # пачками), поэтому lag больше времени от записи до фиксации.
+        # created_at не подходит: при импорте его задает клиент
+        self.lag = settings.CHAT_USAGE_ROLLUP_LAG if lag is None else lag
+    
+    def run(self) -> int:
+        """
+        Агрегирует все накопившиеся сообщения пачками по batch_size
+        
+        Returns:
+            Количество учтенных сообщений
+        """
+        total = 0
+        while True:
+            processed = self._process_batch()
+            total += processed
+            if processed < self.batch_size:
+                return total
+    
+    def _process_batch(self) -> int:
+        cutoff = timezone.now() - timedelta(seconds=self.lag)
+        
+        with transaction.atomic():
+            # Блокировка отметки: параллельные запуски задачи выполняются по очереди
+            checkpoint, _ = RollupCheckpoint.objects.select_for_update().get_or_create(
+                name=RollupCheckpoint.USAGE
+            )
+            start_id = checkpoint.last_message_id
+            
+            candidates = Message.objects.filter(
+                id__gt=start_id
+            ).order_by('id').values_list('id', 'inserted_at')[:self.batch_size]
+            
+            # Отметка двигается только по непрерывному префиксу достаточно давно записанных сообщений
+            last_id = None
+            processed = 0
+            for message_id, inserted_at in candidates:
+                if inserted_at >= cutoff:
+                    break
+                last_id = message_id
+                processed += 1
+            
+            if last_id is None:
+                return 0
+            
+            groups = (
+                Message.objects.filter(id__gt=start_id, id__lte=last_id)
+                .annotate(day=TruncDate('created_at'))
+                .values('conversation__user_id', 'conversation__business_id', 'day')
+                .annotate(**_message_aggregates())
+                .order_by()
+            )
+            for group in groups:
+                self._add(
+                    group['conversation__user_id'],
+                    group['conversation__business_id'],
+                    group['day'],
+                    _usage(group)
+                )
+            
+            checkpoint.last_message_id = last_id
+            checkpoint.save(update_fields=['last_message_id', 'updated_at'])
+        
+        logger.info(f"✓ Агрегаты использования: учтено {processed} сообщений (до ID {last_id})")
+        return processed
+    
+    @staticmethod
+    def _add(user_id: int, business_id: Optional[int], day, usage: Dict):
+        """Добавляет агрегат сообщений к строке (пользователь, бизнес, день)"""
+        updated = UsageRollup.objects.filter(
+            user_id=user_id, business_id=business_id, date=day
+        ).update(
+            updated_at=timezone.now(),
+            **{field: F(field) + usage[field] for field in USAGE_FIELDS}
+        )
+        if not updated:
+            UsageRollup.objects.create(user_id=user_id, business_id=business_id, date=day, **usage)
+    
+    # Чтение
+    
+    @staticmethod
+    def _querysets(user, business_id=None):
+        """Агрегаты и сообщения после отметки (живой хвост) пользователя"""
+        checkpoint = RollupCheckpoint.objects.filter(
+            name=RollupCheckpoint.USAGE
+        ).values('last_message_id')[:1]
+        
+        rollups = UsageRollup.objects.filter(user=user)
+        tail = Message.objects.filter(
+            conversation__user=user,
+            id__gt=Coalesce(Subquery(checkpoint), 0, output_field=models.BigIntegerField())
+        )
+        
+        if business_id:
+            rollups = rollups.filter(business_id=business_id)
+            tail = tail.filter(conversation__business_id=business_id)
+        
+        return rollups, tail
+    
+    @classmethod
+    def totals(cls, user, business_id=None) -> Dict:
+        """
+        Итоги использования пользователя (или его бизнеса)
+        
+        Returns:
+            {messages_count, user_messages, assistant_messages, tokens_used,
+             response_time_sum, responses_count, avg_response_time}
+        """
+        rollups, tail = cls._querysets(user, business_id)
+        
+        # Агрегаты читаются раньше хвоста: если задача зафиксирует пачку между
+        # запросами, эти сообщения на время пропадут из итогов, но не будут
+        # учтены дважды
+        rolled = _usage(rollups.aggregate(**_rollup_aggregates()))
+        live = _usage(tail.aggregate(**_message_aggregates()))
+        
+        return _combine(rolled, live)
+    
+    @classmethod
+    def daily(cls, user, business_id=None, days: int = 30) -> List[Dict]:
+        """
+        Использование по дням за последние days дней (только дни с сообщениями)
+        
+        Returns:
+            Список итогов (как в totals) с ключом date, от старых дней к новым
+        """
+        since = timezone.now().date() - timedelta(days=days - 1)
+        rollups, tail = cls._querysets(user, business_id)
+        
+        by_day = {}
+        rolled = rollups.filter(date__gte=since).values('date').annotate(**_rollup_aggregates()).order_by()
+        for row in rolled:
+            by_day.setdefault(row['date'], []).append(_usage(row))
+        
+        live = (
+            tail.filter(created_at__date__gte=since)
+            .annotate(day=TruncDate('created_at'))
+            .values('day')
+            .annotate(**_message_aggregates())
+            .order_by()
+        )
+        for row in live:
+            by_day.setdefault(row['day'], []).append(_usage(row))
+        
+        return [{'date': day, **_combine(*rows)} for day, rows in sorted(by_day.items())]
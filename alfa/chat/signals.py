@@ -0,0 +1,41 @@
+"""
+Сигналы приложения chat
+"""
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from chat.models import Conversation, Message
+from chat.services.stats import ConversationStats
+from users.models import Business
+
+
+@receiver([post_save, post_delete], sender=Business)
+def invalidate_business_stats(sender, instance, **kwargs):
+    """Сбрасываем кэш статистики (название бизнеса) при изменении бизнеса"""
+    ConversationStats.invalidate(instance.owner_id)
+
+
+@receiver(post_save, sender=Conversation)
+def invalidate_conversation_stats(sender, instance, **kwargs):
+    """Сбрасываем кэш статистики пользователя при изменении диалога"""
+    ConversationStats.invalidate(instance.user_id)
+
+
+@receiver(post_delete, sender=Conversation)
+def invalidate_deleted_conversation_stats(sender, instance, **kwargs):
+    """
+    Сбрасываем кэш статистики после удаления диалога
+    
+    Один раз на диалог, после коммита (вместе с диалогом удалены его
+    сообщения). На удаление Message сигналов нет: иначе Django не может
+    удалить сообщения одним DELETE и загружает каждое ради сигнала.
+    """
+    user_id = instance.user_id
+    transaction.on_commit(lambda: ConversationStats.invalidate(user_id))
+
+
+@receiver(post_save, sender=Message)
+def invalidate_message_stats(sender, instance, **kwargs):
+    """Сбрасываем кэш статистики пользователя при изменении сообщения"""
+    ConversationStats.invalidate(instance.conversation.user_id)
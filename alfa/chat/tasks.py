@@ -3,54 +3,132 @@ Celery задачи для асинхронной обработки сообщ
 """
 import logging
 from celery import shared_task
+from celery.signals import worker_process_init
+from django.conf import settings
 from django.utils import timezone
 
-from chat.models import Message
-from chat.services import LLMService
+from chat.models import Conversation, Message
+from chat.serializers import MessageSerializer
+from chat.services import LLMService, ChatEvents, DeltaPublisher, publish_event
+from chat.services.generation import GenerationError, GenerationPipeline
+from chat.services.locks import ConversationLock, UserGenerationSlots
+from chat.services.messages import claim_coalesced_batch, coalesced_batch, set_batch_status
+from chat.services.openrouter import reset_clients
+from chat.services.reaper import StaleMessageReaper
+from chat.services.summaries import ConversationSummarizer
+from chat.services.usage import UsageRollupService
 
 logger = logging.getLogger(__name__)
 
 
+@worker_process_init.connect
+def reset_llm_clients(**kwargs):
+    """Дочерний процесс prefork пула создает собственный пул соединений OpenRouter"""
+    reset_clients()
+
+
 @shared_task(bind=True, max_retries=3)
-def generate_ai_response(self, message_id):
+def generate_ai_response(self, message_id, lock_waits=0):
     """
     Асинхронная генерация ответа от AI для сообщения пользователя
     
+    Одним ответом обрабатываются и присоединенные к сообщению уточнения
+    (см. submit_user_message). Если сообщение уже обработано, задача
+    завершается без запроса к LLM.
+    
+    Генерация идет по стадиям GenerationPipeline с чекпоинтами, поэтому
+    повтор после сбоя не запрашивает модель второй раз. Повторяются только
+    retryable ошибки: до повтора пачка остается в статусе "ожидает", а
+    клиенты получают message.retrying. Статус "ошибка" ставится, когда
+    ошибка не retryable или попытки исчерпаны. При временной недоступности
+    всех моделей задача повторяется CHAT_GENERATION_MODEL_RETRIES раз,
+    затем сохраняется ответ с извинением.
+    
+    Генерация выполняется под блокировкой диалога (ConversationLock) и
+    в одном из слотов пользователя (UserGenerationSlots): если диалог занят
+    или у пользователя уже CHAT_USER_MAX_INFLIGHT генераций, задача
+    повторяется через CHAT_GENERATION_LOCK_RETRY_DELAY секунд. Перед
+    стадиями генерации блокировки продлеваются.
+    
     Args:
         message_id: ID сообщения пользователя
+        lock_waits: Сколько раз задача уже откладывалась (диалог или лимит пользователя)
     
     Returns:
         ID созданного сообщения ассистента
     """
     try:
-        # Получаем сообщение пользователя
-        user_message = Message.objects.select_related('conversation').get(id=message_id)
+        conversation_id, user_id = Message.objects.values_list(
+            'conversation_id', 'conversation__user_id'
+        ).get(id=message_id)
+    except Message.DoesNotExist:
+        logger.error(f'Message {message_id} not found')
+        raise
+    
+    # Генерации одного диалога идут по очереди, а одновременных генераций
+    # пользователя не больше CHAT_USER_MAX_INFLIGHT: пока условие не выполнено,
+    # задача откладывается (без ошибки и без статуса "ошибка")
+    lock = ConversationLock(conversation_id)
+    slots = UserGenerationSlots(user_id)
+    if not lock.acquire() or not slots.acquire():
+        lock.release()
+        logger.info(f'Conversation {conversation_id} or user {user_id} is busy, postponing message {message_id}')
+        raise self.retry(
+            kwargs={'lock_waits': lock_waits + 1},
+            countdown=settings.CHAT_GENERATION_LOCK_RETRY_DELAY,
+            max_retries=None
+        )
+    
+    try:
+        # Захватываем сообщение вместе с присоединенными к нему уточнениями
+        # (склейка сообщений, отправленных подряд)
+        batch = claim_coalesced_batch(message_id)
+        if not batch:
+            logger.info(f'Message {message_id} is already being processed, skipping')
+            return None
         
-        # Обновляем статус на "обрабатывается"
-        user_message.processing_status = Message.ProcessingStatus.PROCESSING
-        user_message.save(update_fields=['processing_status'])
+        for message in batch:
+            _publish_status(message)
         
-        logger.info(f'Starting AI response generation for message {message_id}')
+        # Диалог с бизнесом и профилем загружен вместе с первым сообщением
+        # (все нужно для системного промпта), отвечаем на последнее
+        conversation = batch[0].conversation
+        user_message = batch[-1]
         
-        # Генерируем ответ
-        llm_service = LLMService()
-        response_data = llm_service.generate_response(
-            conversation=user_message.conversation,
-            user_message=user_message
-        )
+        logger.info(f'Starting AI response generation for messages {[message.id for message in batch]}')
         
-        # Создаем сообщение ассистента
-        assistant_message = LLMService.create_assistant_message(
-            conversation=user_message.conversation,
-            response_data=response_data
+        # Генерируем ответ, передавая фрагменты подписчикам диалога по мере генерации.
+        # Все сообщения пачки уже в истории диалога. Повтор задачи продолжает
+        # с упавшей стадии (чекпоинт в metadata первого сообщения)
+        llm_service = LLMService()
+        pipeline = GenerationPipeline(
+            batch, llm_service, on_delta=DeltaPublisher(conversation.id, user_message.id),
+            keepalive=lambda: (lock.extend(), slots.extend())
         )
+        try:
+            assistant_message = pipeline.run()
+        except GenerationError as exc:
+            if exc.fallback is None or self.request.retries - lock_waits < settings.CHAT_GENERATION_MODEL_RETRIES:
+                raise
+            # Модели так и не ответили: сохраняем ответ с извинением
+            logger.warning(f'Giving up on model for message {message_id} ({exc.error_type}), saving fallback')
+            assistant_message = pipeline.persist(exc.fallback)
         
-        # Обновляем статус на "завершено"
-        user_message.processing_status = Message.ProcessingStatus.COMPLETED
-        user_message.save(update_fields=['processing_status'])
+        # Статус "завершено" сохранен вместе с ответом
+        assistant_data = MessageSerializer(assistant_message).data
+        for message in batch:
+            _publish_status(message)
+            publish_event(conversation.id, ChatEvents.MESSAGE_COMPLETED, {
+                'message_id': message.id,
+                'assistant_message': assistant_data,
+            })
         
         logger.info(f'AI response generated successfully for message {message_id}')
         
+        # Старые сообщения сжимаем в краткое содержание в фоне
+        if ConversationSummarizer(llm_service).needs_update(conversation):
+            update_conversation_summary.delay(conversation.id)
+        
         return assistant_message.id
         
     except Message.DoesNotExist:
@@ -60,14 +138,99 @@ def generate_ai_response(self, message_id):
     except Exception as exc:
         logger.error(f'Error generating AI response for message {message_id}: {exc}')
         
-        # Обновляем статус на "ошибка"
-        try:
-            user_message = Message.objects.get(id=message_id)
-            user_message.processing_status = Message.ProcessingStatus.FAILED
-            user_message.save(update_fields=['processing_status'])
-        except:
-            pass
+        if isinstance(exc, GenerationError):
+            pipeline.record_error(exc)
         
-        # Повторяем попытку с экспоненциальной задержкой
-        raise self.retry(exc=exc, countdown=60 * (2 ** self.request.retries))
+        # Повторяем попытку с экспоненциальной задержкой. Откладывания задачи
+        # тоже считаются повторами Celery, но в лимит попыток не входят
+        attempt = self.request.retries - lock_waits
+        retryable = not isinstance(exc, GenerationError) or exc.retryable
+        if not retryable or attempt >= self.max_retries:
+            # Статус "ошибка" окончательный: клиенты перестают ждать ответа
+            _set_batch_status(conversation_id, message_id, Message.ProcessingStatus.FAILED)
+            raise
+        
+        # До повтора пачка снова ожидает генерации, клиенты получают
+        # message.retrying (частичный ответ сбрасывается)
+        countdown = 60 * (2 ** attempt)
+        batch = _set_batch_status(conversation_id, message_id, Message.ProcessingStatus.PENDING)
+        for message in batch:
+            publish_event(conversation_id, ChatEvents.MESSAGE_RETRYING, {
+                'message_id': message.id,
+                'attempt': attempt + 1,
+                'retry_in': countdown,
+            })
+        raise self.retry(
+            exc=exc,
+            countdown=countdown,
+            max_retries=self.max_retries + lock_waits
+        )
+        
+    finally:
+        slots.release()
+        lock.release()
+
+
+@shared_task(ignore_result=True)
+def update_conversation_summary(conversation_id):
+    """
+    Обновление краткого содержания диалога (старые сообщения, выпавшие из окна истории)
+    
+    Args:
+        conversation_id: ID диалога
+    """
+    summarizer = ConversationSummarizer()
+    if not summarizer.update(conversation_id):
+        return
+    
+    # Длинная история сжимается за несколько запусков (LLM_SUMMARY_MAX_INPUT_TOKENS)
+    conversation = Conversation.objects.only('id', 'metadata').get(id=conversation_id)
+    if summarizer.needs_update(conversation):
+        update_conversation_summary.delay(conversation_id)
+
+
+@shared_task(ignore_result=True)
+def rollup_usage():
+    """
+    Периодическая агрегация новых сообщений в UsageRollup (Celery beat)
+    
+    Returns:
+        Количество учтенных сообщений
+    """
+    return UsageRollupService().run()
+
+
+@shared_task(ignore_result=True)
+def reap_stale_messages():
+    """
+    Периодическая обработка зависших сообщений (Celery beat)
+    
+    Returns:
+        {'requeued': int, 'failed': int}
+    """
+    return StaleMessageReaper().run()
+
+
+def _set_batch_status(conversation_id, message_id, status):
+    """Статус необработанных сообщений пачки (с уведомлением подписчиков)"""
+    try:
+        batch = list(coalesced_batch(conversation_id, message_id).exclude(
+            processing_status=Message.ProcessingStatus.COMPLETED
+        ))
+        set_batch_status(batch, status)
+    except Exception as e:
+        logger.error(f'Failed to update status for message {message_id}: {e}')
+        return []
+    
+    for message in batch:
+        _publish_status(message)
+    return batch
+
 
+def _publish_status(message):
+    """Уведомляет подписчиков диалога об изменении статуса обработки сообщения"""
+    publish_event(message.conversation_id, ChatEvents.MESSAGE_STATUS, {
+        'message_id': message.id,
+        'processing_status': message.processing_status,
+        'processing_status_display': message.get_processing_status_display(),
+    })
@@ -4,3 +4,14 @@
 from .models import *
 from .api import *
 from .llm_service import *
+from .consumers import *
+from .model_health import *
+from .response_cache import *
+from .prompt_builder import *
+from .summaries import *
+from .usage import *
+from .imports import *
+from .tasks import *
+from .reaper import *
+from .rate_limits import *
+from .fake_openrouter import *
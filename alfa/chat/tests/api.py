@@ -1,7 +1,11 @@
 """
 API тесты для чата с AI ассистентом
 """
+from unittest import skipUnless
 from unittest.mock import patch, MagicMock
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from rest_framework.test import APITestCase
 from rest_framework import status
@@ -9,6 +13,8 @@ from rest_framework_simplejwt.tokens import RefreshToken
 
 from users.models import User, Business
 from chat.models import Conversation, Message
+from chat.services.messages import submit_user_message
+from chat.views import ConversationListCreateView, MessageCreateView
 
 
 class ConversationCreateAPITest(APITestCase):
@@ -166,6 +172,63 @@ class ConversationListAPITest(APITestCase):
         self.assertTrue(response.data['success'])
         self.assertEqual(len(response.data['data']), 3)  # Только диалоги user1
     
+    def test_list_conversations_single_query(self):
+        """Тест что список строится одним запросом независимо от числа сообщений"""
+        for conversation in (self.conv1, self.conv2):
+            for i in range(5):
+                Message.objects.create(conversation=conversation, role='user', content=f'Вопрос {i}')
+        
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.access_token}')
+        
+        # Аутентификация по JWT (пользователь) + список диалогов
+        with self.assertNumQueries(2):
+            response = self.client.get(self.list_url)
+        
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        conv1_data = next(c for c in response.data['data'] if c['id'] == self.conv1.id)
+        self.assertEqual(conv1_data['messages_count'], 5)
+        self.assertEqual(conv1_data['last_message']['content'], 'Вопрос 4')
+        self.assertEqual(conv1_data['business_name'], 'Бизнес 1')
+    
+    def test_list_conversations_keyset_pages(self):
+        """Тест постраничного обхода списка по курсору after"""
+        Message.objects.create(conversation=self.conv2, role='user', content='Старый вопрос')
+        Message.objects.create(conversation=self.conv1, role='user', content='Новый вопрос')
+        
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.access_token}')
+        
+        response = self.client.get(f'{self.list_url}?limit=2')
+        
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([c['id'] for c in response.data['data']], [self.conv1.id, self.conv2.id])
+        pagination = response.data['pagination']
+        self.assertEqual(pagination['limit'], 2)
+        self.assertTrue(pagination['has_more_after'])
+        self.assertFalse(pagination['has_more_before'])
+        
+        # Диалоги без сообщений (last_message_at = NULL) идут в конце
+        response = self.client.get(f"{self.list_url}?limit=2&after={pagination['after']}")
+        
+        self.assertEqual([c['id'] for c in response.data['data']], [self.conv3.id])
+        self.assertFalse(response.data['pagination']['has_more_after'])
+        self.assertTrue(response.data['pagination']['has_more_before'])
+        
+        # Возврат на предыдущую страницу
+        response = self.client.get(f"{self.list_url}?limit=2&before={response.data['pagination']['before']}")
+        
+        self.assertEqual([c['id'] for c in response.data['data']], [self.conv1.id, self.conv2.id])
+        self.assertFalse(response.data['pagination']['has_more_before'])
+    
+    def test_list_conversations_invalid_cursor(self):
+        """Тест некорректного курсора"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.access_token}')
+        
+        response = self.client.get(f'{self.list_url}?after=not-a-cursor')
+        
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(response.data['success'])
+        self.assertIn('after', response.data['errors'])
+    
     def test_list_conversations_filter_by_status(self):
         """Тест фильтрации по статусу"""
         self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.access_token}')
@@ -210,6 +273,91 @@ class ConversationListAPITest(APITestCase):
             self.assertIsNone(conversation['business'])
 
 
+class KeysetPaginationIndexTest(APITestCase):
+    """
+    Тесты что сортировка keyset пагинации совпадает с индексами
+    """
+    
+    def setUp(self):
+        """Подготовка данных для тестов"""
+        self.user = User.objects.create_user(
+            email='owner@example.com',
+            password='TestPassword123!'
+        )
+        self.conversation = Conversation.objects.create(user=self.user, category='general')
+        for i in range(3):
+            Message.objects.create(conversation=self.conversation, role='user', content=f'Вопрос {i}')
+        Conversation.objects.create(user=self.user, category='legal')
+        
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user).access_token}')
+    
+    def _page_queries(self, url, table):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [q['sql'] for q in context.captured_queries if f'FROM "{table}"' in q['sql']], response
+    
+    def test_conversation_order_by_matches_index(self):
+        """Тест что список диалогов сортируется как индекс (user, last_message_at DESC NULLS LAST, id DESC)"""
+        url = reverse('chat:conversation_list_create')
+        queries, response = self._page_queries(f'{url}?limit=1', 'chat_conversation')
+        
+        self.assertIn(
+            'ORDER BY "chat_conversation"."last_message_at" DESC NULLS LAST, "chat_conversation"."id" DESC',
+            queries[0]
+        )
+        
+        # Курсор со значением - один диапазон без OR по IS NULL, хвост NULL - отдельным запросом
+        queries, _ = self._page_queries(
+            f"{url}?limit=1&after={response.data['pagination']['after']}", 'chat_conversation'
+        )
+        self.assertEqual(len(queries), 2)
+        self.assertNotIn('IS NULL', queries[0])
+        self.assertIn('IS NULL', queries[1])
+    
+    def test_message_order_by_without_nulls(self):
+        """Тест что сообщения сортируются как индекс (conversation, inserted_at, id) без NULLS FIRST/LAST"""
+        url = reverse('chat:messages', kwargs={'conversation_id': self.conversation.id})
+        queries, response = self._page_queries(f'{url}?limit=2', 'chat_message')
+        
+        self.assertIn('ORDER BY "chat_message"."inserted_at" DESC, "chat_message"."id" DESC', queries[0])
+        self.assertNotIn('NULL', queries[0])
+        
+        queries, _ = self._page_queries(f"{url}?limit=2&before={response.data['pagination']['before']}", 'chat_message')
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('NULL', queries[0])
+    
+    @skipUnless(connection.vendor == 'postgresql', 'План запроса проверяется только в PostgreSQL')
+    def test_explain_uses_index_without_sort(self):
+        """Тест что страницы читаются индексом без сортировки (EXPLAIN)"""
+        conversation_pagination = ConversationListCreateView.keyset_pagination
+        message_pagination = MessageCreateView.keyset_pagination
+        conversation_cursor = (self.conversation.last_message_at, self.conversation.id)
+        last_message = Message.objects.filter(conversation=self.conversation).last()
+        message_cursor = (last_message.inserted_at, last_message.id)
+        plans = [
+            (
+                Conversation.objects.filter(user=self.user)
+                .filter(conversation_pagination._segments(conversation_cursor, True, True)[0])
+                .order_by(*conversation_pagination._ordering(True, True)),
+                'chat_conv_user_keyset_idx'
+            ),
+            (
+                Message.objects.filter(conversation=self.conversation)
+                .filter(message_pagination._segments(message_cursor, False, False)[0])
+                .order_by(*message_pagination._ordering(False, False)),
+                Message._meta.indexes[0].name
+            ),
+        ]
+        
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        for queryset, index_name in plans:
+            plan = queryset[:20].explain()
+            self.assertIn(index_name, plan)
+            self.assertNotIn('Sort', plan)
+
+
 class ConversationDetailAPITest(APITestCase):
     """
     Тесты для работы с конкретным диалогом
@@ -258,7 +406,7 @@ class ConversationDetailAPITest(APITestCase):
         self.other_detail_url = reverse('chat:conversation_detail', kwargs={'pk': self.other_conversation.id})
     
     def test_get_conversation_detail_success(self):
-        """Тест получения детальной информации о диалоге"""
+        """Тест получения детальной информации о диалоге (без сообщений)"""
         self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.access_token}')
         
         response = self.client.get(self.detail_url)
@@ -266,8 +414,9 @@ class ConversationDetailAPITest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertTrue(response.data['success'])
         self.assertEqual(response.data['data']['title'], self.conversation.title)
-        self.assertIn('messages', response.data['data'])
-        self.assertEqual(len(response.data['data']['messages']), 2)
+        self.assertEqual(response.data['data']['messages_count'], 2)
+        # Сообщения отдаются постранично отдельным endpoint
+        self.assertNotIn('messages', response.data['data'])
     
     def test_get_other_user_conversation(self):
         """Тест попытки получить чужой диалог"""
@@ -385,6 +534,88 @@ class MessageAPITest(APITestCase):
         # Проверяем, что LLM был вызван
         mock_instance.generate_response.assert_called_once()
     
+    @patch('chat.tasks.generate_ai_response.apply_async')
+    def test_send_message_idempotency_key_replay(self, mock_apply_async):
+        """Тест что повтор с тем же Idempotency-Key возвращает исходное сообщение и задачу"""
+        cache.clear()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.access_token}')
+        
+        first = self.client.post(
+            self.messages_url, {'content': 'Вопрос'}, format='json', HTTP_IDEMPOTENCY_KEY='retry-1'
+        )
+        second = self.client.post(
+            self.messages_url, {'content': 'Вопрос'}, format='json', HTTP_IDEMPOTENCY_KEY='retry-1'
+        )
+        
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertFalse(first.data['data']['replayed'])
+        self.assertTrue(second.data['data']['replayed'])
+        self.assertEqual(first.data['data']['user_message']['id'], second.data['data']['user_message']['id'])
+        self.assertEqual(first.data['data']['task_id'], second.data['data']['task_id'])
+        self.assertEqual(self.conversation.messages.count(), 2)  # 1 начальное + 1 новое
+        mock_apply_async.assert_called_once()
+        self.assertEqual(mock_apply_async.call_args.kwargs['task_id'], first.data['data']['task_id'])
+    
+    @patch('chat.tasks.generate_ai_response.apply_async')
+    def test_send_message_rejects_non_object_body(self, mock_apply_async):
+        """Тест что тело-список с Idempotency-Key - ошибка валидации, а не 500"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.access_token}')
+        
+        response = self.client.post(
+            self.messages_url, [{'content': 'Вопрос'}], format='json', HTTP_IDEMPOTENCY_KEY='retry-1'
+        )
+        
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        mock_apply_async.assert_not_called()
+    
+    @patch('chat.tasks.generate_ai_response.apply_async')
+    def test_send_message_long_idempotency_key_rejected(self, mock_apply_async):
+        """Тест что заголовок Idempotency-Key проверяется как поле client_message_id"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.access_token}')
+        
+        response = self.client.post(
+            self.messages_url, {'content': 'Вопрос'}, format='json', HTTP_IDEMPOTENCY_KEY='k' * 65
+        )
+        
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        mock_apply_async.assert_not_called()
+    
+    @patch('chat.tasks.generate_ai_response.apply_async')
+    def test_send_message_client_message_id_without_cache(self, mock_apply_async):
+        """Тест повтора по полю client_message_id, когда ключа уже нет в Redis"""
+        cache.clear()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.access_token}')
+        
+        first = self.client.post(self.messages_url, {'content': 'Вопрос', 'client_message_id': 'm-1'}, format='json')
+        cache.clear()
+        second = self.client.post(self.messages_url, {'content': 'Вопрос', 'client_message_id': 'm-1'}, format='json')
+        
+        self.assertTrue(second.data['data']['replayed'])
+        self.assertEqual(first.data['data']['task_id'], second.data['data']['task_id'])
+        self.assertEqual(second.data['data']['user_message']['client_message_id'], 'm-1')
+        mock_apply_async.assert_called_once()
+    
+    @patch('chat.tasks.generate_ai_response.apply_async')
+    def test_send_message_concurrent_retry(self, mock_apply_async):
+        """Тест гонки повторов: дубликат отсекается уникальным ограничением"""
+        existing = Message.objects.create(
+            conversation=self.conversation,
+            role='user',
+            content='Вопрос',
+            client_message_id='race-1',
+            metadata={'task_id': 'task-race'}
+        )
+        
+        # Оба запроса не нашли ключ до вставки
+        with patch('chat.services.messages._find_submitted', return_value=None):
+            user_message, task_id, created = submit_user_message(self.conversation, 'Вопрос', 'race-1')
+        
+        self.assertFalse(created)
+        self.assertEqual(user_message.id, existing.id)
+        self.assertEqual(task_id, 'task-race')
+        mock_apply_async.assert_not_called()
+    
     def test_send_empty_message(self):
         """Тест отправки пустого сообщения"""
         self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.access_token}')
@@ -420,7 +651,26 @@ class MessageAPITest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertTrue(response.data['success'])
         self.assertEqual(len(response.data['data']), 1)
-
+    
+    def test_list_messages_tail_and_before(self):
+        """Тест что по умолчанию возвращаются последние сообщения, а before листает назад"""
+        for i in range(4):
+            Message.objects.create(conversation=self.conversation, role='assistant', content=f'Ответ {i}')
+        
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.access_token}')
+        
+        response = self.client.get(f'{self.messages_url}?limit=3')
+        
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([m['content'] for m in response.data['data']], ['Ответ 1', 'Ответ 2', 'Ответ 3'])
+        self.assertTrue(response.data['pagination']['has_more_before'])
+        self.assertFalse(response.data['pagination']['has_more_after'])
+        
+        response = self.client.get(f"{self.messages_url}?limit=3&before={response.data['pagination']['before']}")
+        
+        self.assertEqual([m['content'] for m in response.data['data']], ['Первое сообщение', 'Ответ 0'])
+        self.assertFalse(response.data['pagination']['has_more_before'])
+        self.assertTrue(response.data['pagination']['has_more_after'])
 
 class ConversationStatsAPITest(APITestCase):
     """
@@ -429,6 +679,8 @@ class ConversationStatsAPITest(APITestCase):
     
     def setUp(self):
         """Подготовка данных для тестов"""
+        cache.clear()
+        
         self.user = User.objects.create_user(
             email='owner@example.com',
             password='TestPassword123!'
@@ -516,4 +768,37 @@ class ConversationStatsAPITest(APITestCase):
         self.assertEqual(stats['business']['id'], self.business.id)
         self.assertEqual(stats['business']['name'], self.business.name)
         self.assertEqual(stats['by_category']['marketing']['count'], 2)
-
+    
+    def test_get_stats_query_count(self):
+        """Тест что статистика считается без сканирования сообщений и затем берется из кэша"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.access_token}')
+        
+        # Аутентификация по JWT + агрегат по диалогам + агрегаты использования и живой хвост
+        with self.assertNumQueries(4):
+            first = self.client.get(self.stats_url)
+        
+        # Повторный запрос - только аутентификация
+        with self.assertNumQueries(1):
+            second = self.client.get(self.stats_url)
+        
+        self.assertEqual(first.data['data'], second.data['data'])
+        self.assertEqual(first.data['data']['by_category']['marketing']['count'], 2)
+        self.assertEqual(first.data['data']['completed_conversations'], 0)
+        self.assertIsNotNone(first.data['data']['last_activity'])
+    
+    def test_get_stats_invalidated_on_write(self):
+        """Тест сброса кэша статистики при новом сообщении"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.access_token}')
+        
+        response = self.client.get(self.stats_url)
+        self.assertEqual(response.data['data']['total_messages'], 1)
+        
+        conversation = Conversation.objects.filter(user=self.user, category='legal').first()
+        Message.objects.create(conversation=conversation, role='assistant', content='Ответ', tokens_used=42)
+        
+        response = self.client.get(self.stats_url)
+        
+        stats = response.data['data']
+        self.assertEqual(stats['total_messages'], 2)
+        self.assertEqual(stats['assistant_messages'], 1)
+        self.assertEqual(stats['total_tokens_used'], 42)
@@ -0,0 +1,273 @@
+"""
+Тесты WebSocket consumer, SSE и потоковой передачи ответа
+"""
+from unittest.mock import patch
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.cache import cache
+from django.test import TransactionTestCase, override_settings
+from django.urls import reverse
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from alfa.routing import websocket_urlpatterns
+from chat.middleware import JWTAuthMiddleware
+from chat.models import Conversation, Message
+from chat.services import ChatEvents, DeltaPublisher
+from users.models import User
+
+
+IN_MEMORY_CHANNEL_LAYERS = {
+    'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}
+}
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ChatConsumerTest(TransactionTestCase):
+    """
+    Тесты ChatConsumer
+    """
+
+    def setUp(self):
+        """Подготовка данных для тестов"""
+        cache.clear()
+        self.user = User.objects.create_user(
+            email='owner@example.com',
+            password='TestPassword123!'
+        )
+        self.conversation = Conversation.objects.create(
+            user=self.user,
+            category='marketing'
+        )
+        self.access_token = str(RefreshToken.for_user(self.user).access_token)
+        self.application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+
+    def _communicator(self, token=None, conversation_id=None):
+        conversation_id = conversation_id or self.conversation.id
+        path = f'/ws/chat/{conversation_id}/'
+        if token:
+            path += f'?token={token}'
+        return WebsocketCommunicator(self.application, path)
+
+    async def test_connect_without_token_rejected(self):
+        """Тест что соединение без токена отклоняется"""
+        communicator = self._communicator()
+        connected, code = await communicator.connect()
+
+        self.assertFalse(connected)
+        self.assertEqual(code, 4401)
+
+    async def test_connect_to_other_user_conversation_rejected(self):
+        """Тест что нельзя подключиться к чужому диалогу"""
+        communicator = self._communicator(self.access_token, conversation_id=999999)
+        connected, code = await communicator.connect()
+
+        self.assertFalse(connected)
+        self.assertEqual(code, 4404)
+
+    async def test_receives_group_events(self):
+        """Тест пересылки событий диалога клиенту"""
+        communicator = self._communicator(self.access_token)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        await get_channel_layer().group_send(f'chat_{self.conversation.id}', {
+            'type': 'chat.event',
+            'event': ChatEvents.MESSAGE_DELTA,
+            'data': {'message_id': 1, 'index': 0, 'delta': 'Привет'},
+        })
+
+        response = await communicator.receive_json_from()
+        self.assertEqual(response['event'], 'message.delta')
+        self.assertEqual(response['data']['delta'], 'Привет')
+
+        await communicator.disconnect()
+
+    @patch('chat.tasks.generate_ai_response.apply_async')
+    async def test_send_message_creates_pending_message(self, mock_delay):
+        """Тест отправки сообщения через WebSocket"""
+
+        communicator = self._communicator(self.access_token)
+        await communicator.connect()
+
+        await communicator.send_json_to({'type': 'message', 'content': 'Как поднять продажи?'})
+
+        response = await communicator.receive_json_from()
+        self.assertEqual(response['event'], 'message.created')
+        self.assertEqual(response['data']['user_message']['content'], 'Как поднять продажи?')
+        self.assertEqual(response['data']['user_message']['processing_status'], 'pending')
+        mock_delay.assert_called_once()
+
+        await communicator.disconnect()
+
+    @patch('chat.tasks.generate_ai_response.apply_async')
+    async def test_send_message_replay_returns_original(self, mock_apply_async):
+        """Тест повторной отправки с тем же client_message_id через WebSocket"""
+        communicator = self._communicator(self.access_token)
+        await communicator.connect()
+
+        payload = {'type': 'message', 'content': 'Как поднять продажи?', 'client_message_id': 'ws-1'}
+        await communicator.send_json_to(payload)
+        first = await communicator.receive_json_from()
+
+        await communicator.send_json_to(payload)
+        second = await communicator.receive_json_from()
+
+        self.assertEqual(second['event'], 'message.created')
+        self.assertTrue(second['data']['replayed'])
+        self.assertEqual(second['data']['user_message']['id'], first['data']['user_message']['id'])
+        mock_apply_async.assert_called_once()
+
+        await communicator.disconnect()
+
+    async def test_send_empty_message_returns_error(self):
+        """Тест валидации сообщения"""
+        communicator = self._communicator(self.access_token)
+        await communicator.connect()
+
+        await communicator.send_json_to({'type': 'message', 'content': '   '})
+
+        response = await communicator.receive_json_from()
+        self.assertEqual(response['event'], 'error')
+        self.assertIn('content', response['data']['errors'])
+
+        await communicator.disconnect()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class DeltaPublisherTest(TransactionTestCase):
+    """
+    Тесты буферизации фрагментов ответа
+    """
+
+    def _receive(self, channel_layer, channel_name):
+        return async_to_sync(channel_layer.receive)(channel_name)
+
+    def test_flush_publishes_joined_delta(self):
+        """Тест что накопленные фрагменты отправляются одним событием"""
+        channel_layer = get_channel_layer()
+        channel_name = async_to_sync(channel_layer.new_channel)()
+        async_to_sync(channel_layer.group_add)('chat_1', channel_name)
+
+        publisher = DeltaPublisher(conversation_id=1, message_id=5, flush_interval=60)
+        publisher('При')
+        publisher('вет')
+        publisher.flush()
+
+        event = self._receive(channel_layer, channel_name)
+        self.assertEqual(event['event'], 'message.delta')
+        self.assertEqual(event['data']['delta'], 'Привет')
+        self.assertEqual(event['data']['message_id'], 5)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CHAT_SSE_KEEPALIVE_INTERVAL=1)
+class MessageEventsViewTest(TransactionTestCase):
+    """
+    Тесты SSE потока статуса сообщения
+    """
+
+    def setUp(self):
+        """Подготовка данных для тестов"""
+        self.user = User.objects.create_user(
+            email='owner@example.com',
+            password='TestPassword123!'
+        )
+        self.conversation = Conversation.objects.create(
+            user=self.user,
+            category='marketing'
+        )
+        self.access_token = str(RefreshToken.for_user(self.user).access_token)
+
+    def _url(self, message):
+        return reverse('chat:message_events', kwargs={
+            'conversation_id': self.conversation.id,
+            'message_id': message.id
+        })
+
+    async def _read_events(self, response):
+        events = []
+        async for chunk in response.streaming_content:
+            text = chunk.decode() if isinstance(chunk, bytes) else chunk
+            if text.startswith('event:'):
+                events.append(text.split('\n')[0].split(': ', 1)[1])
+        return events
+
+    async def test_requires_token(self):
+        """Тест что поток требует аутентификации"""
+        message = await Message.objects.acreate(
+            conversation=self.conversation,
+            role='user',
+            content='Test'
+        )
+
+        response = await self.async_client.get(self._url(message))
+
+        self.assertEqual(response.status_code, 401)
+
+    async def test_completed_message_returns_final_state(self):
+        """Тест что для обработанного сообщения поток сразу отдает ответ и закрывается"""
+        message = await Message.objects.acreate(
+            conversation=self.conversation,
+            role='user',
+            content='Вопрос'
+        )
+        await Message.objects.acreate(
+            conversation=self.conversation,
+            role='assistant',
+            content='Ответ'
+        )
+
+        response = await self.async_client.get(f'{self._url(message)}?token={self.access_token}')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = await self._read_events(response)
+        self.assertEqual(events, ['message.status', 'message.completed'])
+
+    async def test_pending_message_streams_until_completed(self):
+        """Тест что поток пересылает события сообщения до завершения"""
+        message = await Message.objects.acreate(
+            conversation=self.conversation,
+            role='user',
+            content='Вопрос',
+            processing_status=Message.ProcessingStatus.PENDING
+        )
+
+        response = await self.async_client.get(
+            self._url(message),
+            headers={'Authorization': f'Bearer {self.access_token}'}
+        )
+        stream = response.streaming_content
+
+        first = await anext(stream)
+        self.assertIn('message.status', first.decode() if isinstance(first, bytes) else first)
+
+        channel_layer = get_channel_layer()
+        group = f'chat_{self.conversation.id}'
+        # Событие другого сообщения должно быть отфильтровано
+        await channel_layer.group_send(group, {
+            'type': 'chat.event',
+            'event': ChatEvents.MESSAGE_DELTA,
+            'data': {'message_id': message.id + 100, 'index': 0, 'delta': 'чужое'},
+        })
+        await channel_layer.group_send(group, {
+            'type': 'chat.event',
+            'event': ChatEvents.MESSAGE_DELTA,
+            'data': {'message_id': message.id, 'index': 0, 'delta': 'Отв'},
+        })
+        await channel_layer.group_send(group, {
+            'type': 'chat.event',
+            'event': ChatEvents.MESSAGE_COMPLETED,
+            'data': {'message_id': message.id, 'assistant_message': {'content': 'Ответ'}},
+        })
+
+        rest = []
+        async for chunk in stream:
+            rest.append(chunk.decode() if isinstance(chunk, bytes) else chunk)
+        body = ''.join(rest)
+
+        self.assertIn('Отв', body)
+        self.assertNotIn('чужое', body)
+        self.assertTrue(body.rstrip().split('\n\n')[-1].startswith('event: message.completed'))
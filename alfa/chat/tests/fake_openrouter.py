@@ -0,0 +1,120 @@
+"""
+Тесты локальной замены OpenRouter API
+"""
+import threading
+
+from django.core.cache import cache, caches
+from django.test import TestCase, override_settings
+from openai import NotFoundError, OpenAI, RateLimitError
+
+from users.models import User
+from chat.models import Conversation, Message
+from chat.services import LLMService
+from chat.services.fake_openrouter import FakeOpenRouterServer
+from chat.services.openrouter import get_client, reset_clients
+
+FAKE_CONFIG = {
+    'default': {'latency': 0, 'token_delay': 0, 'completion_tokens': 5},
+    'models': {
+        'fake/limited': {'rate_limit': 1.0, 'retry_after': 30},
+        'fake/missing': {'not_found': True},
+        'fake/long': {'completion_tokens': 500},
+    },
+}
+
+
+class FakeOpenRouterServerTest(TestCase):
+    """
+    Тесты OpenAI-совместимого сервера через настоящий клиент OpenAI
+    """
+    
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = FakeOpenRouterServer(('127.0.0.1', 0), FAKE_CONFIG, seed=1)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+    
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+    
+    def setUp(self):
+        """Подготовка данных для тестов"""
+        cache.clear()
+        caches['llm'].clear()
+        self.client = OpenAI(base_url=self.server.base_url, api_key='test', max_retries=0)
+        self.messages = [{'role': 'user', 'content': 'Как открыть ИП?'}]
+    
+    def test_completion_with_usage(self):
+        """Тест обычного ответа с usage"""
+        completion = self.client.chat.completions.create(model='fake/model', messages=self.messages)
+        
+        self.assertEqual(completion.model, 'fake/model')
+        self.assertEqual(len(completion.choices[0].message.content.split()), 5)
+        self.assertEqual(completion.choices[0].finish_reason, 'stop')
+        self.assertEqual(completion.usage.completion_tokens, 5)
+        self.assertEqual(
+            completion.usage.total_tokens,
+            completion.usage.prompt_tokens + completion.usage.completion_tokens
+        )
+    
+    def test_max_tokens_truncates_answer(self):
+        """Тест что ответ обрезается по max_tokens"""
+        completion = self.client.chat.completions.create(
+            model='fake/long', messages=self.messages, max_tokens=10
+        )
+        
+        self.assertEqual(completion.usage.completion_tokens, 10)
+        self.assertEqual(completion.choices[0].finish_reason, 'length')
+    
+    def test_streaming_with_usage(self):
+        """Тест потокового ответа: фрагменты и usage последним чанком"""
+        stream = self.client.chat.completions.create(
+            model='fake/model', messages=self.messages, stream=True,
+            stream_options={'include_usage': True}
+        )
+        chunks = list(stream)
+        
+        content = ''.join(chunk.choices[0].delta.content or '' for chunk in chunks if chunk.choices)
+        self.assertEqual(len(content.split()), 5)
+        self.assertEqual(chunks[-1].choices, [])
+        self.assertEqual(chunks[-1].usage.completion_tokens, 5)
+    
+    def test_injected_errors(self):
+        """Тест ошибок 429 с Retry-After и 404 по моделям"""
+        with self.assertRaises(RateLimitError) as context:
+            self.client.chat.completions.create(model='fake/limited', messages=self.messages)
+        self.assertEqual(context.exception.response.headers['retry-after'], '30')
+        
+        with self.assertRaises(NotFoundError):
+            self.client.chat.completions.create(model='fake/missing', messages=self.messages)
+    
+    def test_llm_service_fallback_chain(self):
+        """Тест цепочки fallback LLMService против локального сервера"""
+        user = User.objects.create_user(email='test@example.com', password='TestPassword123!')
+        conversation = Conversation.objects.create(user=user, category='legal')
+        user_message = Message.objects.create(conversation=conversation, role='user', content='Как открыть ИП?')
+        
+        with override_settings(
+            OPENROUTER_BASE_URL=self.server.base_url,
+            OPENROUTER_MODEL='fake/limited',
+            OPENROUTER_MODELS=['fake/limited', 'fake/model'],
+            LLM_HEDGING_ENABLED=False
+        ):
+            reset_clients()
+            try:
+                # 429 сразу уходит в fallback, без повторов внутри SDK
+                self.assertEqual(get_client().max_retries, 0)
+                result = LLMService().generate_response(
+                    conversation=conversation,
+                    user_message=user_message,
+                    on_delta=lambda text: None
+                )
+            finally:
+                reset_clients()
+        
+        self.assertEqual(result['model'], 'fake/model')
+        self.assertTrue(result['metadata']['fallback_used'])
+        self.assertGreater(result['tokens_used'], 5)
@@ -0,0 +1,216 @@
+"""
+Тесты импорта истории сообщений из JSONL
+"""
+import json
+import tempfile
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
+
+from django.core.management import call_command
+from django.db import DatabaseError
+from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from chat.models import Conversation, Message
+from chat.services.imports import MessageImporter
+from users.models import User
+
+
+def _jsonl(*messages):
+    return '\n'.join(json.dumps(message, ensure_ascii=False) for message in messages) + '\n'
+
+
+HISTORY = [
+    {'role': 'user', 'content': 'Как открыть ИП?', 'created_at': '2025-01-10T09:00:00Z'},
+    {'role': 'assistant', 'content': 'Нужно подать заявление', 'created_at': '2025-01-10T09:00:05Z',
+     'model': 'gpt-4o', 'tokens_used': 120, 'response_time': 1.5},
+    {'role': 'user', 'content': 'А сколько это стоит?', 'created_at': '2025-01-10T09:01:00Z'},
+]
+
+
+class MessageImporterTest(TestCase):
+    """
+    Тесты MessageImporter
+    """
+    
+    def setUp(self):
+        """Подготовка данных для тестов"""
+        self.user = User.objects.create_user(
+            email='test@example.com',
+            password='TestPassword123!'
+        )
+        self.conversation = Conversation.objects.create(user=self.user, category='legal')
+    
+    def test_import_preserves_history_and_refreshes_conversation(self):
+        """Тест импорта пачками с сохранением времени и пересчетом диалога"""
+        result = MessageImporter(self.conversation, batch_size=2).run(_jsonl(*HISTORY).splitlines())
+        
+        self.assertEqual(result, {'imported': 3, 'skipped': 0, 'errors': []})
+        
+        messages = list(self.conversation.messages.order_by('created_at'))
+        self.assertEqual([m.content for m in messages], [m['content'] for m in HISTORY])
+        self.assertEqual(messages[0].created_at.isoformat(), '2025-01-10T09:00:00+00:00')
+        self.assertEqual(messages[1].tokens_used, 120)
+        self.assertTrue(all(m.processing_status == Message.ProcessingStatus.COMPLETED for m in messages))
+        
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.messages_count, 3)
+        self.assertEqual(self.conversation.last_message_at, messages[-1].created_at)
+        self.assertEqual(self.conversation.last_message_role, 'user')
+        self.assertEqual(self.conversation.last_message_preview, 'А сколько это стоит?')
+        self.assertEqual(self.conversation.title, 'Как открыть ИП?')
+    
+    def test_invalid_lines_are_skipped(self):
+        """Тест пропуска некорректных строк с номерами ошибок"""
+        lines = [
+            '{не json',
+            json.dumps({'role': 'system', 'content': 'Ты консультант'}),
+            '',
+            json.dumps({'role': 'user', 'content': 'Из будущего', 'created_at': '2999-01-01T00:00:00Z'}),
+            json.dumps(HISTORY[0]),
+        ]
+        
+        result = MessageImporter(self.conversation).run(lines)
+        
+        self.assertEqual(result['imported'], 1)
+        self.assertEqual(result['skipped'], 3)
+        self.assertEqual([error['line'] for error in result['errors']], [1, 2, 4])
+        self.assertIn('role', result['errors'][1]['errors'])
+    
+    def test_import_limit(self):
+        """Тест ограничения количества сообщений за импорт"""
+        result = MessageImporter(self.conversation, max_messages=2).run(_jsonl(*HISTORY).splitlines())
+        
+        self.assertEqual(result['imported'], 2)
+        self.assertEqual(result['skipped'], 1)
+        self.assertEqual(self.conversation.messages.count(), 2)
+    
+    def test_batches_are_committed_separately(self):
+        """Тест что сбой пачки не откатывает уже записанные пачки и их счетчики"""
+        bulk_create = Message.objects.bulk_create
+        calls = []
+        
+        def failing_bulk_create(batch):
+            calls.append(len(batch))
+            if len(calls) == 2:
+                raise DatabaseError('connection lost')
+            return bulk_create(batch)
+        
+        with patch.object(Message.objects, 'bulk_create', side_effect=failing_bulk_create):
+            with self.assertRaises(DatabaseError):
+                MessageImporter(self.conversation, batch_size=2).run(_jsonl(*HISTORY).splitlines())
+        
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.messages.count(), 2)
+        self.assertEqual(self.conversation.messages_count, 2)
+        self.assertEqual(self.conversation.last_message_role, 'assistant')
+    
+    def test_imported_history_keeps_server_insert_time(self):
+        """Тест что прошлое время сообщения не попадает во время записи"""
+        MessageImporter(self.conversation).run(_jsonl(*HISTORY).splitlines())
+        
+        message = self.conversation.messages.order_by('created_at').first()
+        self.assertEqual(message.created_at.isoformat(), '2025-01-10T09:00:00+00:00')
+        self.assertGreater(message.inserted_at, timezone.now() - timedelta(minutes=1))
+    
+    def test_import_keeps_existing_title(self):
+        """Тест что импорт не меняет уже заданный заголовок"""
+        self.conversation.title = 'Регистрация'
+        self.conversation.save()
+        
+        MessageImporter(self.conversation).run(_jsonl(*HISTORY).splitlines())
+        
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.title, 'Регистрация')
+    
+    def test_import_into_summarized_part_resets_summary(self):
+        """Тест что импорт старше границы краткого содержания сбрасывает его"""
+        summary = {
+            'text': 'Содержание',
+            'until_message_id': 1,
+            'until_created_at': '2025-01-10T09:00:30+00:00',
+            'messages_count': 6,
+        }
+        self.conversation.metadata = {'summary': summary, 'source': 'web'}
+        self.conversation.save()
+        
+        MessageImporter(self.conversation).run(_jsonl(*HISTORY[2:]).splitlines())
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.metadata['summary'], summary)
+        
+        MessageImporter(self.conversation).run(_jsonl(*HISTORY[:2]).splitlines())
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.metadata, {'source': 'web'})
+    
+    def test_import_command(self):
+        """Тест команды import_messages"""
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl', encoding='utf-8') as history:
+            history.write(_jsonl(*HISTORY))
+            history.flush()
+            
+            out = StringIO()
+            call_command('import_messages', self.conversation.id, history.name, batch_size=1, stdout=out)
+        
+        self.assertEqual(self.conversation.messages.count(), 3)
+        self.assertIn('Импортировано сообщений: 3', out.getvalue())
+
+
+class MessageImportAPITest(APITestCase):
+    """
+    Тесты API импорта сообщений
+    """
+    
+    def setUp(self):
+        """Подготовка данных для тестов"""
+        self.user = User.objects.create_user(
+            email='owner@example.com',
+            password='TestPassword123!'
+        )
+        self.conversation = Conversation.objects.create(user=self.user, category='legal')
+        
+        self.access_token = str(RefreshToken.for_user(self.user).access_token)
+        self.import_url = reverse('chat:messages_import', kwargs={'conversation_id': self.conversation.id})
+    
+    def test_import_success(self):
+        """Тест импорта JSONL через API"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.access_token}')
+        
+        response = self.client.post(
+            self.import_url,
+            data=_jsonl(*HISTORY).encode('utf-8'),
+            content_type='application/x-ndjson'
+        )
+        
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(response.data['success'])
+        self.assertEqual(response.data['data']['imported'], 3)
+        self.assertEqual(self.conversation.messages.count(), 3)
+    
+    def test_import_nothing_valid(self):
+        """Тест импорта без корректных строк"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.access_token}')
+        
+        response = self.client.post(self.import_url, data=b'{broken\n', content_type='application/x-ndjson')
+        
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(response.data['success'])
+        self.assertFalse(self.conversation.messages.exists())
+    
+    def test_import_other_user_conversation(self):
+        """Тест импорта в чужой диалог"""
+        other = User.objects.create_user(email='other@example.com', password='TestPassword123!')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(other).access_token}')
+        
+        response = self.client.post(
+            self.import_url,
+            data=_jsonl(*HISTORY).encode('utf-8'),
+            content_type='application/x-ndjson'
+        )
+        
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertFalse(self.conversation.messages.exists())
@@ -4,10 +4,12 @@ Unit тесты для LLM сервиса и интеграции с OpenRouter
 from unittest.mock import Mock, patch, MagicMock
 from django.test import TestCase, override_settings
 from django.conf import settings
+from django.core.cache import cache, caches
 
 from users.models import User
 from chat.models import Conversation, Message
 from chat.services import LLMService
+from chat.services.openrouter import get_async_client, get_client, reset_clients
 
 
 class LLMServiceInitTest(TestCase):
@@ -33,6 +35,40 @@ class LLMServiceInitTest(TestCase):
         self.assertIn(service.primary_model, service.models + [settings.OPENROUTER_MODEL])
 
 
+class OpenRouterClientTest(TestCase):
+    """
+    Тесты общего для процесса клиента OpenRouter
+    """
+    
+    def tearDown(self):
+        reset_clients()
+    
+    def test_client_shared_between_services(self):
+        """Тест что сервисы переиспользуют один клиент и пул соединений"""
+        self.assertIs(LLMService().client, LLMService().client)
+        self.assertIs(LLMService().client, get_client())
+    
+    @override_settings(OPENROUTER_BASE_URL='http://localhost:9999/api/v1')
+    def test_reset_applies_new_settings(self):
+        """Тест что после сброса клиент создается с новыми настройками"""
+        old_client = get_client()
+        reset_clients()
+        client = get_client()
+        
+        self.assertIsNot(client, old_client)
+        self.assertEqual(str(client.base_url), 'http://localhost:9999/api/v1/')
+    
+    def test_async_client_per_event_loop(self):
+        """Тест что асинхронный клиент общий в пределах event loop"""
+        import asyncio
+        
+        async def get_twice():
+            return get_async_client(), LLMService().async_client
+        
+        first, second = asyncio.run(get_twice())
+        self.assertIs(first, second)
+
+
 class LLMServiceGenerateResponseTest(TestCase):
     """
     Тесты генерации ответов с мокированием API
@@ -40,6 +76,9 @@ class LLMServiceGenerateResponseTest(TestCase):
     
     def setUp(self):
         """Подготовка данных для тестов"""
+        # Состояние здоровья моделей хранится в кэше и не должно переходить между тестами
+        cache.clear()
+        caches['llm'].clear()
         self.user = User.objects.create_user(
             email='test@example.com',
             password='TestPassword123!'
@@ -55,6 +94,10 @@ class LLMServiceGenerateResponseTest(TestCase):
         )
         self.service = LLMService()
     
+    def tearDown(self):
+        """Сбрасываем общий клиент, т.к. тесты подменяют его методы"""
+        reset_clients()
+    
     @patch('chat.services.llm_service.PromptBuilder.build_messages_history')
     def test_successful_response_first_model(self, mock_build_history):
         """Тест успешного ответа с первой модели"""
@@ -279,6 +322,170 @@ class LLMServiceGenerateResponseTest(TestCase):
         self.assertIsNone(result['tokens_used'])
         self.assertEqual(result['content'], 'Ответ без токенов')
 
+    @patch('chat.services.llm_service.PromptBuilder.build_messages_history')
+    def test_streaming_response_calls_on_delta(self, mock_build_history):
+        """Тест потоковой генерации с передачей фрагментов в on_delta"""
+        mock_build_history.return_value = [{'role': 'user', 'content': 'Test'}]
+        
+        def chunk(content=None, finish_reason=None, usage=None):
+            choices = []
+            if content is not None or finish_reason is not None:
+                choices = [Mock(delta=Mock(content=content), finish_reason=finish_reason)]
+            return Mock(model='qwen-30b', choices=choices, usage=usage)
+        
+        self.service.client.chat.completions.create = Mock(return_value=iter([
+            chunk('Отличный '),
+            chunk('вопрос!'),
+            chunk(finish_reason='stop'),
+            chunk(usage=Mock(total_tokens=42)),
+        ]))
+        
+        deltas = []
+        result = self.service.generate_response(
+            conversation=self.conversation,
+            user_message=self.user_message,
+            on_delta=deltas.append
+        )
+        
+        self.assertEqual(deltas, ['Отличный ', 'вопрос!'])
+        self.assertEqual(result['content'], 'Отличный вопрос!')
+        self.assertEqual(result['model'], 'qwen-30b')
+        self.assertEqual(result['tokens_used'], 42)
+        self.assertEqual(result['metadata']['finish_reason'], 'stop')
+        self.assertTrue(result['metadata']['streamed'])
+        self.assertIn('first_token_time', result['metadata'])
+        
+        _, kwargs = self.service.client.chat.completions.create.call_args
+        self.assertTrue(kwargs['stream'])
+
+
+@override_settings(
+    OPENROUTER_MODELS=['slow-model', 'fast-model', 'spare-model'],
+    OPENROUTER_MODEL='slow-model',
+    LLM_HEDGE_AFTER=0.1,
+    LLM_HEDGE_MAX=1
+)
+class LLMServiceHedgingTest(TestCase):
+    """
+    Тесты hedged запросов
+    """
+    
+    def setUp(self):
+        """Подготовка данных для тестов"""
+        cache.clear()
+        caches['llm'].clear()
+        self.user = User.objects.create_user(
+            email='test@example.com',
+            password='TestPassword123!'
+        )
+        self.conversation = Conversation.objects.create(user=self.user, category='general')
+        self.user_message = Message.objects.create(
+            conversation=self.conversation,
+            role='user',
+            content='Test'
+        )
+        self.service = LLMService()
+    
+    def tearDown(self):
+        reset_clients()
+    
+    @staticmethod
+    def _stream(model, text, delay=0.0, closed=None):
+        import time
+        
+        def generator():
+            try:
+                time.sleep(delay)
+                yield Mock(model=model, usage=None, choices=[
+                    Mock(delta=Mock(content=text), finish_reason=None)
+                ])
+                yield Mock(model=model, usage=None, choices=[
+                    Mock(delta=Mock(content=None), finish_reason='stop')
+                ])
+            finally:
+                if closed is not None:
+                    closed.append(model)
+        
+        return generator()
+    
+    @patch('chat.services.llm_service.PromptBuilder.build_messages_history')
+    def test_hedge_wins_when_primary_slow(self, mock_build_history):
+        """Тест что при медленном первом токене побеждает hedge запрос"""
+        mock_build_history.return_value = [{'role': 'user', 'content': 'Test'}]
+        
+        def create(**kwargs):
+            if kwargs['model'] == 'slow-model':
+                return self._stream('slow-model', 'Медленный ответ', delay=1.0)
+            return self._stream('fast-model', 'Быстрый ответ')
+        
+        self.service.client.chat.completions.create = Mock(side_effect=create)
+        
+        deltas = []
+        result = self.service.generate_response(
+            conversation=self.conversation,
+            user_message=self.user_message,
+            on_delta=deltas.append,
+            hedge=True
+        )
+        
+        self.assertEqual(result['content'], 'Быстрый ответ')
+        self.assertEqual(deltas, ['Быстрый ответ'])
+        self.assertTrue(result['metadata']['hedged'])
+        self.assertEqual(result['metadata']['hedges_issued'], 1)
+        self.assertEqual(result['metadata']['winner_model'], 'fast-model')
+        self.assertEqual(result['metadata']['attempted_models'], 2)
+        # Третья модель не запускалась: лимит hedge запросов
+        self.assertEqual(self.service.client.chat.completions.create.call_count, 2)
+    
+    @patch('chat.services.llm_service.PromptBuilder.build_messages_history')
+    def test_no_hedge_when_primary_fast(self, mock_build_history):
+        """Тест что быстрая основная модель не порождает hedge запросов"""
+        mock_build_history.return_value = [{'role': 'user', 'content': 'Test'}]
+        
+        self.service.client.chat.completions.create = Mock(
+            side_effect=lambda **kwargs: self._stream(kwargs['model'], 'Ответ')
+        )
+        
+        result = self.service.generate_response(
+            conversation=self.conversation,
+            user_message=self.user_message,
+            hedge=True
+        )
+        
+        self.assertEqual(result['metadata']['winner_model'], 'slow-model')
+        self.assertEqual(result['metadata']['hedges_issued'], 0)
+        self.assertFalse(result['metadata']['fallback_used'])
+        self.assertEqual(self.service.client.chat.completions.create.call_count, 1)
+    
+    @patch('chat.services.llm_service.PromptBuilder.build_messages_history')
+    def test_error_falls_back_sequentially(self, mock_build_history):
+        """Тест что ошибка основной модели ведет к обычному fallback"""
+        from openai import RateLimitError
+        
+        mock_build_history.return_value = [{'role': 'user', 'content': 'Test'}]
+        
+        mock_response = Mock()
+        mock_response.status_code = 429
+        rate_limit_error = RateLimitError('Rate limit', response=mock_response, body=None)
+        
+        def create(**kwargs):
+            if kwargs['model'] == 'slow-model':
+                raise rate_limit_error
+            return self._stream(kwargs['model'], 'Ответ')
+        
+        self.service.client.chat.completions.create = Mock(side_effect=create)
+        
+        result = self.service.generate_response(
+            conversation=self.conversation,
+            user_message=self.user_message,
+            hedge=True
+        )
+        
+        self.assertEqual(result['content'], 'Ответ')
+        self.assertEqual(result['metadata']['winner_model'], 'fast-model')
+        self.assertEqual(result['metadata']['hedges_issued'], 0)
+        self.assertTrue(result['metadata']['fallback_used'])
+
 
 class LLMServiceCreateMessageTest(TestCase):
     """
@@ -410,6 +617,14 @@ class LLMServiceConfigurationTest(TestCase):
     Тесты конфигурации моделей
     """
     
+    def setUp(self):
+        cache.clear()
+        caches['llm'].clear()
+    
+    def tearDown(self):
+        """Сбрасываем общий клиент, т.к. тесты подменяют его методы"""
+        reset_clients()
+    
     def test_uses_custom_models_list(self):
         """Тест использования кастомного списка моделей"""
         service = LLMService()
@@ -460,3 +675,33 @@ class LLMServiceConfigurationTest(TestCase):
         self.assertEqual(service.client.chat.completions.create.call_count, 3)
         self.assertEqual(result['model'], 'error-fallback')
 
+
+    
+    @patch('chat.services.llm_service.PromptBuilder.build_messages_history')
+    def test_open_circuit_model_skipped(self, mock_build_history):
+        """Тест что модель с открытым circuit не вызывается"""
+        mock_build_history.return_value = [{'role': 'user', 'content': 'Test'}]
+        
+        service = LLMService()
+        for _ in range(settings.LLM_CIRCUIT_FAILURE_THRESHOLD):
+            service.health.record_failure('model1', 'rate_limit', 0.5)
+        
+        user = User.objects.create_user(
+            email='test@example.com',
+            password='TestPassword123!'
+        )
+        conversation = Conversation.objects.create(user=user, category='general')
+        message = Message.objects.create(conversation=conversation, role='user', content='Test')
+        
+        mock_completion = Mock()
+        mock_completion.choices = [Mock(message=Mock(content='Ответ'), finish_reason='stop')]
+        mock_completion.model = 'model2'
+        mock_completion.usage = Mock(total_tokens=10)
+        service.client.chat.completions.create = Mock(return_value=mock_completion)
+        
+        result = service.generate_response(conversation=conversation, user_message=message)
+        
+        _, kwargs = service.client.chat.completions.create.call_args
+        self.assertEqual(kwargs['model'], 'model2')
+        self.assertEqual(service.client.chat.completions.create.call_count, 1)
+        self.assertEqual(result['metadata']['skipped_models'], 1)
@@ -0,0 +1,124 @@
+"""
+Unit тесты circuit breaker и упорядочивания моделей
+"""
+import time
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from chat.services.model_health import ModelHealth
+
+
+@override_settings(
+    LLM_CIRCUIT_FAILURE_THRESHOLD=2,
+    LLM_CIRCUIT_COOLDOWN=60,
+    LLM_HEALTH_WINDOW=10
+)
+class ModelHealthTest(TestCase):
+    """
+    Тесты ModelHealth
+    """
+    
+    def setUp(self):
+        """Подготовка данных для тестов"""
+        cache.clear()
+        self.health = ModelHealth()
+    
+    def test_fresh_models_keep_configured_order(self):
+        """Тест что без статистики порядок цепочки не меняется"""
+        ordered, skipped = self.health.order_models(['a', 'b', 'c'])
+        
+        self.assertEqual(ordered, ['a', 'b', 'c'])
+        self.assertEqual(skipped, [])
+    
+    def test_circuit_opens_after_threshold(self):
+        """Тест открытия circuit после N ошибок подряд"""
+        self.health.record_failure('a', 'rate_limit', 0.3)
+        self.assertFalse(self.health.is_open('a'))
+        
+        self.health.record_failure('a', 'rate_limit', 0.3)
+        self.assertTrue(self.health.is_open('a'))
+        
+        ordered, skipped = self.health.order_models(['a', 'b'])
+        self.assertEqual(ordered, ['b'])
+        self.assertEqual(skipped, ['a'])
+    
+    def test_success_closes_circuit(self):
+        """Тест что успешный ответ сбрасывает счетчик ошибок"""
+        self.health.record_failure('a', 'timeout', 30)
+        self.health.record_success('a', 1.2)
+        self.health.record_failure('a', 'timeout', 30)
+        
+        self.assertFalse(self.health.is_open('a'))
+    
+    def test_explicit_cooldown_opens_immediately(self):
+        """Тест блокировки модели по Retry-After с первой ошибки"""
+        self.health.record_failure('a', 'rate_limit', 0.1, cooldown=5)
+        
+        state = self.health.get_state('a')
+        self.assertTrue(self.health.is_open('a'))
+        self.assertLessEqual(state['opened_until'], time.time() + 5)
+    
+    def test_orders_by_success_rate_then_latency(self):
+        """Тест упорядочивания по успешности и p50 задержки"""
+        # a: половина запросов с ошибкой
+        self.health.record_success('a', 1.0)
+        self.health.record_failure('a', 'rate_limit', 0.1)
+        self.health.record_success('a', 1.0)
+        self.health.record_failure('a', 'rate_limit', 0.1)
+        # b: все успешны, но медленнее c
+        self.health.record_success('b', 5.0)
+        self.health.record_success('c', 2.0)
+        
+        ordered, _ = self.health.order_models(['a', 'b', 'c', 'd'])
+        
+        self.assertEqual(ordered, ['c', 'b', 'd', 'a'])
+    
+    @override_settings(LLM_HEALTH_PROBE_EVERY=3)
+    def test_demoted_model_is_probed_periodically(self):
+        """Тест что пониженная модель периодически пробуется первой"""
+        health = ModelHealth()
+        health.record_success('a', 1.0)
+        health.record_failure('a', 'timeout', 30)
+        health.record_success('b', 1.0)
+        
+        orders = [health.order_models(['a', 'b', 'c'])[0] for _ in range(6)]
+        
+        self.assertEqual(orders[0], ['b', 'c', 'a'])
+        self.assertEqual(orders[1], ['b', 'c', 'a'])
+        self.assertEqual(orders[2], ['a', 'b', 'c'])
+        self.assertEqual(orders[5], ['a', 'b', 'c'])
+    
+    @override_settings(LLM_HEALTH_PROBE_EVERY=1)
+    def test_no_probe_without_demoted_models(self):
+        """Тест что счетчик проб не трогается, пока порядок цепочки не нарушен"""
+        health = ModelHealth()
+        health.record_success('a', 1.0)
+        
+        self.assertEqual(health.order_models(['a', 'b'])[0], ['a', 'b'])
+        self.assertIsNone(cache.get(ModelHealth.PROBE_COUNTER_KEY))
+    
+    def test_half_open_allows_single_probe(self):
+        """Тест что после cooldown модель получает только один воркер"""
+        self.health.record_failure('a', 'rate_limit', 0.1, cooldown=60)
+        state = self.health.get_state('a')
+        state['opened_until'] = time.time() - 1
+        self.health._save_state('a', state)
+        
+        self.assertIn('a', self.health.order_models(['a', 'b'])[0])
+        self.assertEqual(ModelHealth().order_models(['a', 'b']), (['b'], ['a']))
+        
+        self.health.record_success('a', 1.0)
+        self.assertIn('a', ModelHealth().order_models(['a', 'b'])[0])
+        self.assertIn('a', ModelHealth().order_models(['a', 'b'])[0])
+    
+    def test_all_open_probes_one_model(self):
+        """Тест пробной попытки, когда все circuit открыты"""
+        for model in ['a', 'b']:
+            self.health.record_failure(model, 'rate_limit', 0.1)
+            self.health.record_failure(model, 'rate_limit', 0.1)
+        
+        ordered, skipped = self.health.order_models(['a', 'b'])
+        
+        self.assertEqual(len(ordered), 1)
+        self.assertEqual(len(skipped), 1)
@@ -1,10 +1,23 @@
 """
 Unit тесты для моделей чата
 """
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import Mock, patch
+
+from django.contrib import admin
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
 from users.models import User
+from chat.admin import ConversationAdmin
 from chat.models import Conversation, Message
+from chat.serializers import ConversationUpdateSerializer
+from chat.services.messages import set_batch_status
+from chat.services.stats import ConversationStats
 
 
 class ConversationModelTest(TestCase):
@@ -121,4 +134,165 @@ class MessageModelTest(TestCase):
         self.conversation.refresh_from_db()
         self.assertEqual(len(self.conversation.title), 53)  # 50 + '...'
         self.assertTrue(self.conversation.title.endswith('...'))
+    
+    def test_message_updates_conversation_snapshot(self):
+        """Тест обновления счетчика и последнего сообщения диалога"""
+        Message.objects.create(
+            conversation=self.conversation,
+            role='user',
+            content='Вопрос'
+        )
+        Message.objects.create(
+            conversation=self.conversation,
+            role='assistant',
+            content='б' * 150
+        )
+        
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.messages_count, 2)
+        self.assertEqual(self.conversation.last_message_role, 'assistant')
+        self.assertEqual(self.conversation.last_message_preview, 'б' * 100 + '...')
+    
+    def test_message_update_does_not_change_counter(self):
+        """Тест что изменение существующего сообщения не увеличивает счетчик"""
+        message = Message.objects.create(
+            conversation=self.conversation,
+            role='user',
+            content='Вопрос'
+        )
+        message.processing_status = Message.ProcessingStatus.COMPLETED
+        message.save(update_fields=['processing_status'])
+        
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.messages_count, 1)
+    
+    def test_message_insert_updates_conversation_once(self):
+        """Тест что создание сообщения обновляет диалог одним UPDATE"""
+        with CaptureQueriesContext(connection) as context:
+            Message.objects.create(
+                conversation=self.conversation,
+                role='user',
+                content='Вопрос'
+            )
+        
+        updates = [q['sql'] for q in context.captured_queries if q['sql'].startswith('UPDATE "chat_conversation"')]
+        self.assertEqual(len(updates), 1)
+        
+        # Загруженный объект диалога тоже актуален
+        self.assertEqual(self.conversation.messages_count, 1)
+        self.assertEqual(self.conversation.title, 'Вопрос')
+    
+    def test_status_change_does_not_touch_conversation(self):
+        """Тест что смена статуса - один UPDATE сообщения без записи диалога"""
+        message = Message.objects.create(
+            conversation=self.conversation,
+            role='user',
+            content='Вопрос',
+            processing_status=Message.ProcessingStatus.PENDING
+        )
+        self.conversation.refresh_from_db()
+        last_message_at = self.conversation.last_message_at
+        updated_at = self.conversation.updated_at
+        
+        with self.assertNumQueries(1):
+            set_batch_status([message], Message.ProcessingStatus.PROCESSING)
+        message.save(update_fields=['processing_status'])
+        
+        message.refresh_from_db()
+        self.assertEqual(message.processing_status, Message.ProcessingStatus.PROCESSING)
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.last_message_at, last_message_at)
+        self.assertEqual(self.conversation.updated_at, updated_at)
+    
+    def test_message_does_not_move_last_message_at_back(self):
+        """Тест что более раннее сообщение не откатывает время и превью последнего"""
+        Message.objects.create(
+            conversation=self.conversation,
+            role='assistant',
+            content='Поздний ответ'
+        )
+        future = timezone.now() + timedelta(hours=1)
+        Conversation.objects.filter(pk=self.conversation.pk).update(last_message_at=future)
+        
+        Message.objects.create(
+            conversation=Conversation.objects.get(pk=self.conversation.pk),
+            role='user',
+            content='Ранний вопрос'
+        )
+        
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.last_message_at, future)
+        self.assertEqual(self.conversation.last_message_role, 'assistant')
+        self.assertEqual(self.conversation.last_message_preview, 'Поздний ответ')
+        self.assertEqual(self.conversation.messages_count, 2)
+    
+    def test_stale_conversation_save_keeps_counters(self):
+        """Тест что сохранение устаревшего объекта диалога не затирает счетчики сообщений"""
+        stale = Conversation.objects.get(pk=self.conversation.pk)
+        Message.objects.create(conversation=self.conversation, role='user', content='Вопрос')
+        
+        serializer = ConversationUpdateSerializer(stale, data={'title': 'Новое название'}, partial=True)
+        self.assertTrue(serializer.is_valid())
+        serializer.save()
+        
+        form = Mock(changed_data=['status'])
+        stale.status = Conversation.Status.ARCHIVED
+        ConversationAdmin(Conversation, admin.site).save_model(None, stale, form, change=True)
+        
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.title, 'Новое название')
+        self.assertEqual(self.conversation.status, Conversation.Status.ARCHIVED)
+        self.assertEqual(self.conversation.messages_count, 1)
+        self.assertEqual(self.conversation.last_message_role, 'user')
+        self.assertEqual(self.conversation.last_message_preview, 'Вопрос')
+    
+    def test_conversation_delete_removes_messages_in_one_query(self):
+        """Тест что сообщения удаляются одним DELETE, а кэш статистики сбрасывается после коммита"""
+        for index in range(5):
+            Message.objects.create(conversation=self.conversation, role='user', content=f'Вопрос {index}')
+        
+        with patch.object(ConversationStats, 'invalidate') as mock_invalidate:
+            with self.captureOnCommitCallbacks(execute=True):
+                with CaptureQueriesContext(connection) as queries:
+                    self.conversation.delete()
+                mock_invalidate.assert_not_called()
+        
+        mock_invalidate.assert_called_once_with(self.user.id)
+        message_queries = [q['sql'] for q in queries.captured_queries if 'chat_message' in q['sql']]
+        self.assertEqual(len(message_queries), 1)
+        self.assertTrue(message_queries[0].startswith('DELETE'))
+        self.assertFalse(Message.objects.exists())
 
+
+class BackfillConversationStatsCommandTest(TestCase):
+    """
+    Тесты команды backfill_conversation_stats
+    """
+    
+    def setUp(self):
+        """Подготовка данных для тестов"""
+        self.user = User.objects.create_user(
+            email='test@example.com',
+            password='TestPassword123!'
+        )
+    
+    def test_backfill_recalculates_fields(self):
+        """Тест пересчета денормализованных полей по сообщениям"""
+        conversation = Conversation.objects.create(user=self.user, category='general')
+        Message.objects.create(conversation=conversation, role='user', content='Первый')
+        Message.objects.create(conversation=conversation, role='assistant', content='Ответ')
+        empty = Conversation.objects.create(user=self.user, category='general')
+        
+        # Имитируем данные до появления денормализованных полей
+        Conversation.objects.update(messages_count=0, last_message_role='', last_message_preview='')
+        
+        out = StringIO()
+        call_command('backfill_conversation_stats', batch_size=1, stdout=out)
+        
+        conversation.refresh_from_db()
+        empty.refresh_from_db()
+        self.assertEqual(conversation.messages_count, 2)
+        self.assertEqual(conversation.last_message_role, 'assistant')
+        self.assertEqual(conversation.last_message_preview, 'Ответ')
+        self.assertEqual(empty.messages_count, 0)
+        self.assertIn('Обновлено диалогов: 1', out.getvalue())
@@ -0,0 +1,161 @@
+"""
+Unit тесты построения промптов
+"""
+from django.test import TestCase, override_settings
+
+from chat.models import Conversation, Message
+from chat.services import PromptBuilder
+from chat.services.tokens import count_tokens, truncate_to_tokens
+from users.models import Business, BusinessProfile, User
+
+
+class TokenCounterTest(TestCase):
+    """
+    Тесты оценки количества токенов
+    """
+    
+    def test_cyrillic_costs_more_than_latin(self):
+        """Тест что кириллица оценивается дороже латиницы той же длины"""
+        self.assertGreater(count_tokens('маркетинг'), count_tokens('marketing'))
+        self.assertEqual(count_tokens(''), 0)
+    
+    def test_truncate_fits_budget(self):
+        """Тест обрезки текста по границе слова"""
+        text = ' '.join(['продажи'] * 100)
+        
+        truncated = truncate_to_tokens(text, 20, marker='…')
+        
+        self.assertLessEqual(count_tokens(truncated), 20)
+        self.assertTrue(truncated.startswith('продажи продажи'))
+        self.assertTrue(truncated.endswith('продажи…'))
+
+
+@override_settings(LLM_CONTEXT_BUDGET=300, LLM_CONTEXT_BUDGETS={}, LLM_HISTORY_MIN_TRUNCATED_TOKENS=50)
+class MessagesHistoryWindowTest(TestCase):
+    """
+    Тесты окна истории по бюджету токенов
+    """
+    
+    def setUp(self):
+        """Подготовка данных для тестов"""
+        self.user = User.objects.create_user(
+            email='test@example.com',
+            password='TestPassword123!'
+        )
+        self.conversation = Conversation.objects.create(user=self.user, category='general')
+    
+    def _add(self, role, content):
+        return Message.objects.create(conversation=self.conversation, role=role, content=content)
+    
+    def test_short_history_fully_included(self):
+        """Тест что короткий диалог передается целиком по порядку"""
+        self._add('user', 'Привет')
+        self._add('assistant', 'Здравствуйте!')
+        self._add('system', 'Служебное')
+        self._add('user', 'Как поднять продажи?')
+        
+        messages = PromptBuilder.build_messages_history(self.conversation)
+        
+        self.assertEqual(messages[0]['role'], 'system')
+        self.assertEqual(
+            [(m['role'], m['content']) for m in messages[1:]],
+            [('user', 'Привет'), ('assistant', 'Здравствуйте!'), ('user', 'Как поднять продажи?')]
+        )
+    
+    def test_old_long_messages_dropped_newest_kept(self):
+        """Тест что старые длинные сообщения отбрасываются, новые сохраняются"""
+        self._add('user', 'слово ' * 1000)
+        self._add('assistant', 'ответ ' * 1000)
+        self._add('user', 'Короткий вопрос')
+        
+        messages = PromptBuilder.build_messages_history(self.conversation)
+        
+        self.assertEqual(messages[-1]['content'], 'Короткий вопрос')
+        total = sum(count_tokens(m['content']) + 4 for m in messages)
+        self.assertLessEqual(total, 300)
+    
+    def test_oversize_last_message_truncated(self):
+        """Тест что слишком длинное последнее сообщение обрезается"""
+        self._add('user', 'Очень длинный вопрос ' * 500)
+        
+        messages = PromptBuilder.build_messages_history(self.conversation)
+        
+        self.assertEqual(len(messages), 2)
+        self.assertTrue(messages[1]['content'].endswith(PromptBuilder.TRUNCATED_MARKER))
+        total = sum(count_tokens(m['content']) + 4 for m in messages)
+        self.assertLessEqual(total, 300)
+    
+    def test_model_budget_override(self):
+        """Тест бюджета отдельной модели"""
+        for i in range(20):
+            self._add('user', f'Сообщение номер {i} про продажи')
+        
+        with override_settings(LLM_CONTEXT_BUDGETS={'small-model': 150}):
+            small = PromptBuilder.build_messages_history(self.conversation, model='small-model')
+        default = PromptBuilder.build_messages_history(self.conversation, model='other-model')
+        
+        self.assertLess(len(small), len(default))
+        self.assertEqual(small[-1]['content'], 'Сообщение номер 19 про продажи')
+
+
+class SystemPromptContextTest(TestCase):
+    """
+    Тесты системного промпта с контекстом бизнеса
+    """
+    
+    def setUp(self):
+        """Подготовка данных для тестов"""
+        self.user = User.objects.create_user(
+            email='owner@example.com',
+            password='TestPassword123!'
+        )
+        self.business = Business.objects.create(
+            owner=self.user,
+            name='Кофейня Арома',
+            business_type='cafe',
+            city='Душанбе'
+        )
+        self.profile = BusinessProfile.objects.create(
+            business=self.business,
+            employees_count=5,
+            business_context='Работаем с 8 утра'
+        )
+        self.conversation = Conversation.objects.create(
+            user=self.user,
+            business=self.business,
+            category='marketing'
+        )
+    
+    def _load_conversation(self):
+        return Conversation.objects.select_related('business__profile').get(id=self.conversation.id)
+    
+    def test_prompt_built_without_queries(self):
+        """Тест что промпт для загруженного с select_related диалога не делает запросов к БД"""
+        conversation = self._load_conversation()
+        
+        with self.assertNumQueries(0):
+            prompt = PromptBuilder.build_system_prompt(conversation)
+        
+        self.assertIn('Кофейня Арома', prompt)
+        self.assertIn('Работаем с 8 утра', prompt)
+        self.assertEqual(prompt, PromptBuilder.build_system_prompt(self._load_conversation()))
+    
+    def test_profile_update_changes_prompt(self):
+        """Тест что изменение профиля сразу меняет промпт"""
+        PromptBuilder.build_system_prompt(self._load_conversation())
+        
+        self.profile.business_context = 'Открыли летнюю веранду'
+        self.profile.save()
+        
+        prompt = PromptBuilder.build_system_prompt(self._load_conversation())
+        self.assertIn('Открыли летнюю веранду', prompt)
+        self.assertNotIn('Работаем с 8 утра', prompt)
+    
+    def test_business_without_profile(self):
+        """Тест промпта для бизнеса без профиля"""
+        self.profile.delete()
+        
+        prompt = PromptBuilder.build_system_prompt(self._load_conversation())
+        
+        self.assertIn('Кофейня Арома', prompt)
+        self.assertNotIn('Количество сотрудников', prompt)
@@ -0,0 +1,191 @@
+"""
+Unit тесты лимитов запросов к моделям (RPM/TPM, AIMD, Retry-After)
+"""
+import time
+from unittest.mock import Mock, patch
+
+from django.core.cache import cache, caches
+from django.test import TestCase, override_settings
+from openai import RateLimitError
+
+from users.models import User
+from chat.models import Conversation, Message
+from chat.services import LLMService
+from chat.services.openrouter import reset_clients
+from chat.services.rate_limits import ModelRateLimiter
+
+
+def _rate_limit_error(headers=None):
+    """RateLimitError с заголовками ответа"""
+    response = Mock(status_code=429, headers=headers or {})
+    return RateLimitError('Rate limit exceeded', response=response, body={'error': 'rate limit'})
+
+
+@override_settings(
+    LLM_RATE_LIMITS={'limited': {'rpm': 2, 'tpm': 100}},
+    LLM_DEFAULT_RPM=0,
+    LLM_DEFAULT_TPM=0,
+    LLM_AIMD_MIN_CONCURRENCY=1,
+    LLM_AIMD_MAX_CONCURRENCY=4,
+    LLM_RETRY_AFTER_MAX=120
+)
+class ModelRateLimiterTest(TestCase):
+    """
+    Тесты ModelRateLimiter
+    """
+    
+    def setUp(self):
+        """Подготовка данных для тестов"""
+        cache.clear()
+        self.limiter = ModelRateLimiter()
+    
+    def test_requests_per_minute_budget(self):
+        """Тест что сверх RPM разрешение не выдается"""
+        first = self.limiter.acquire('limited', max_wait=0)
+        second = self.limiter.acquire('limited', max_wait=0)
+        first.release()
+        second.release()
+        
+        self.assertIsNotNone(first)
+        self.assertIsNotNone(second)
+        self.assertIsNone(self.limiter.acquire('limited', max_wait=0))
+        # Модели без лимитов не затронуты
+        self.assertIsNotNone(self.limiter.acquire('other', max_wait=0))
+    
+    def test_tokens_per_minute_budget(self):
+        """Тест бюджета токенов с поправкой на фактический расход"""
+        permit = self.limiter.acquire('limited', tokens=60, max_wait=0)
+        permit.release(tokens_used=90)
+        
+        self.assertIsNone(self.limiter.acquire('limited', tokens=20, max_wait=0))
+        self.assertIsNotNone(self.limiter.acquire('limited', tokens=10, max_wait=0))
+    
+    def test_oversized_request_allowed_in_empty_window(self):
+        """Тест что запрос крупнее всего бюджета не блокируется навсегда"""
+        self.assertIsNotNone(self.limiter.acquire('limited', tokens=500, max_wait=0))
+    
+    def test_concurrency_slots(self):
+        """Тест что одновременных запросов не больше лимита конкурентности"""
+        permits = [self.limiter.acquire('other', max_wait=0) for _ in range(4)]
+        
+        self.assertTrue(all(permits))
+        self.assertIsNone(self.limiter.acquire('other', max_wait=0))
+        
+        permits[0].release()
+        permits[0].release()
+        self.assertIsNotNone(self.limiter.acquire('other', max_wait=0))
+        self.assertIsNone(self.limiter.acquire('other', max_wait=0))
+    
+    def test_aimd_concurrency(self):
+        """Тест мультипликативного снижения и аддитивного роста лимита"""
+        self.limiter.record_rate_limit('other')
+        self.assertEqual(self.limiter.concurrency('other'), 2)
+        
+        self.limiter.record_rate_limit('other')
+        self.limiter.record_rate_limit('other')
+        self.assertEqual(self.limiter.concurrency('other'), 1)
+        
+        self.limiter.record_success('other')
+        self.limiter.record_success('other')
+        self.assertEqual(self.limiter.concurrency('other'), 2.5)
+        
+        for _ in range(20):
+            self.limiter.record_success('other')
+        self.assertEqual(self.limiter.concurrency('other'), 4)
+    
+    def test_retry_after_headers(self):
+        """Тест разбора Retry-After и X-RateLimit-Reset"""
+        self.assertEqual(self.limiter.retry_after(_rate_limit_error({'retry-after': '30'})), 30)
+        self.assertEqual(self.limiter.retry_after(_rate_limit_error({'retry-after-ms': '1500'})), 1.5)
+        self.assertEqual(self.limiter.retry_after(_rate_limit_error({'retry-after': '9999'})), 120)
+        self.assertIsNone(self.limiter.retry_after(_rate_limit_error()))
+        
+        reset_ms = str(int((time.time() + 10) * 1000))
+        seconds = self.limiter.retry_after(_rate_limit_error({'x-ratelimit-reset': reset_ms}))
+        self.assertAlmostEqual(seconds, 10, delta=1)
+    
+    def test_cache_unavailable_does_not_block(self):
+        """Тест что без кэша запросы идут без ограничений"""
+        broken_cache = Mock()
+        broken_cache.add.side_effect = ConnectionError('redis down')
+        limiter = ModelRateLimiter(cache_backend=broken_cache)
+        
+        permit = limiter.acquire('limited', max_wait=0)
+        
+        self.assertIsNotNone(permit)
+        permit.release(tokens_used=10)
+
+
+@override_settings(
+    OPENROUTER_MODEL='model-a',
+    OPENROUTER_MODELS=['model-a', 'model-b'],
+    LLM_HEDGING_ENABLED=False,
+    LLM_RATE_LIMITS={'model-a': {'rpm': 1}},
+    LLM_RATE_LIMIT_MAX_WAIT=0,
+    LLM_AIMD_MAX_CONCURRENCY=4
+)
+class LLMServiceRateLimitTest(TestCase):
+    """
+    Тесты лимитов моделей в LLMService
+    """
+    
+    def setUp(self):
+        """Подготовка данных для тестов"""
+        cache.clear()
+        caches['llm'].clear()
+        self.user = User.objects.create_user(
+            email='test@example.com',
+            password='TestPassword123!'
+        )
+        self.conversation = Conversation.objects.create(user=self.user, category='marketing')
+        self.user_message = Message.objects.create(
+            conversation=self.conversation,
+            role='user',
+            content='Помоги с маркетингом'
+        )
+        self.service = LLMService()
+        
+        self.completion = Mock()
+        self.completion.choices = [Mock(message=Mock(content='Ответ'), finish_reason='stop')]
+        self.completion.model = 'model-b'
+        self.completion.usage = Mock(total_tokens=50)
+    
+    def tearDown(self):
+        """Сбрасываем общий клиент, т.к. тесты подменяют его методы"""
+        reset_clients()
+    
+    @patch('chat.services.llm_service.PromptBuilder.build_messages_history')
+    def test_model_without_permit_is_skipped(self, mock_build_history):
+        """Тест что модель с исчерпанным бюджетом пропускается без ошибки в здоровье"""
+        mock_build_history.return_value = [{'role': 'user', 'content': 'Test'}]
+        self.service.rate_limiter.acquire('model-a').release()
+        self.service.client.chat.completions.create = Mock(return_value=self.completion)
+        
+        result = self.service.generate_response(
+            conversation=self.conversation,
+            user_message=self.user_message
+        )
+        
+        self.assertEqual(result['content'], 'Ответ')
+        call_kwargs = self.service.client.chat.completions.create.call_args.kwargs
+        self.assertEqual(call_kwargs['model'], 'model-b')
+        self.assertEqual(self.service.health.get_state('model-a')['failures'], 0)
+    
+    @patch('chat.services.llm_service.PromptBuilder.build_messages_history')
+    def test_retry_after_opens_circuit(self, mock_build_history):
+        """Тест что Retry-After ответа 429 открывает circuit и снижает конкурентность"""
+        mock_build_history.return_value = [{'role': 'user', 'content': 'Test'}]
+        self.service.client.chat.completions.create = Mock(
+            side_effect=[_rate_limit_error({'retry-after': '30'}), self.completion]
+        )
+        
+        result = self.service.generate_response(
+            conversation=self.conversation,
+            user_message=self.user_message
+        )
+        
+        self.assertEqual(result['content'], 'Ответ')
+        state = self.service.health.get_state('model-a')
+        self.assertAlmostEqual(state['opened_until'] - time.time(), 30, delta=2)
+        self.assertEqual(self.service.rate_limiter.concurrency('model-a'), 2)
+        self.assertEqual(self.service.rate_limiter.concurrency('model-b'), 4)
@@ -0,0 +1,133 @@
+"""
+Тесты обработки зависших сообщений
+"""
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.core.cache import cache
+from django.test import TestCase
+from django.utils import timezone
+
+from chat.models import Conversation, Message
+from chat.services.locks import ConversationLock
+from chat.services.messages import claim_coalesced_batch
+from chat.services.reaper import StaleMessageReaper
+from users.models import User
+
+
+class StaleMessageReaperTest(TestCase):
+    """
+    Тесты StaleMessageReaper
+    """
+    
+    def setUp(self):
+        """Подготовка данных для тестов"""
+        cache.clear()
+        self.user = User.objects.create_user(
+            email='test@example.com',
+            password='TestPassword123!'
+        )
+        self.conversation = Conversation.objects.create(user=self.user, category='legal')
+        self.reaper = StaleMessageReaper(pending_after=600, processing_after=900, max_requeues=1)
+    
+    def _message(self, status, age, coalesced_into=None, **metadata):
+        """Сообщение пользователя, статус status которого не меняется age секунд"""
+        message = Message.objects.create(
+            conversation=self.conversation,
+            role=Message.Role.USER,
+            content='Вопрос',
+            processing_status=status,
+            coalesced_into=coalesced_into,
+            metadata={'task_id': f'task-{age}', **metadata}
+        )
+        Message.objects.filter(pk=message.pk).update(status_changed_at=timezone.now() - timedelta(seconds=age))
+        return message
+    
+    @patch('chat.tasks.generate_ai_response.apply_async')
+    def test_stuck_processing_is_requeued(self, mock_apply_async):
+        """Тест повторной постановки сообщения, зависшего в обработке"""
+        message = self._message(Message.ProcessingStatus.PROCESSING, age=1000)
+        
+        result = self.reaper.run()
+        
+        self.assertEqual(result, {'requeued': 1, 'failed': 0})
+        message.refresh_from_db()
+        self.assertEqual(message.processing_status, Message.ProcessingStatus.PENDING)
+        self.assertEqual(message.metadata['requeues'], 1)
+        mock_apply_async.assert_called_once_with(args=[message.id], task_id='task-1000')
+    
+    @patch('chat.tasks.generate_ai_response.apply_async')
+    def test_messages_within_deadline_untouched(self, mock_apply_async):
+        """Тест что сообщения моложе срока своего статуса не трогаются"""
+        self._message(Message.ProcessingStatus.PENDING, age=300)
+        self._message(Message.ProcessingStatus.PROCESSING, age=700)
+        self._message(Message.ProcessingStatus.COMPLETED, age=5000)
+        
+        self.assertEqual(self.reaper.run(), {'requeued': 0, 'failed': 0})
+        mock_apply_async.assert_not_called()
+    
+    @patch('chat.tasks.generate_ai_response.apply_async')
+    def test_requeue_limit_fails_message(self, mock_apply_async):
+        """Тест что после лимита повторов сообщение помечается ошибкой"""
+        message = self._message(Message.ProcessingStatus.PENDING, age=1000, requeues=1)
+        
+        result = self.reaper.run()
+        
+        self.assertEqual(result, {'requeued': 0, 'failed': 1})
+        message.refresh_from_db()
+        self.assertEqual(message.processing_status, Message.ProcessingStatus.FAILED)
+        mock_apply_async.assert_not_called()
+        self.assertEqual(StaleMessageReaper.metrics(), {'requeued': 0, 'failed': 1})
+    
+    @patch('chat.tasks.generate_ai_response.apply_async')
+    def test_coalesced_batch_requeued_once(self, mock_apply_async):
+        """Тест что пачка склеенных сообщений ставится одной задачей"""
+        leader = self._message(Message.ProcessingStatus.PENDING, age=1000)
+        follower = self._message(Message.ProcessingStatus.PENDING, age=990, coalesced_into=leader)
+        
+        result = self.reaper.run()
+        
+        self.assertEqual(result['requeued'], 2)
+        mock_apply_async.assert_called_once()
+        self.assertEqual(mock_apply_async.call_args.kwargs['args'], [leader.id])
+        follower.refresh_from_db()
+        self.assertEqual(follower.processing_status, Message.ProcessingStatus.PENDING)
+    
+    @patch('chat.tasks.generate_ai_response.apply_async')
+    def test_follower_of_failed_leader_gets_own_task(self, mock_apply_async):
+        """Тест что присоединенное к помеченному ошибкой сообщению ставится своей задачей"""
+        leader = self._message(Message.ProcessingStatus.PENDING, age=1000, requeues=1)
+        follower = self._message(Message.ProcessingStatus.PENDING, age=990, coalesced_into=leader)
+        
+        result = self.reaper.run()
+        
+        self.assertEqual(result, {'requeued': 1, 'failed': 1})
+        leader.refresh_from_db()
+        self.assertEqual(leader.processing_status, Message.ProcessingStatus.FAILED)
+        mock_apply_async.assert_called_once_with(args=[follower.id], task_id='task-990')
+    
+    @patch('chat.tasks.generate_ai_response.apply_async')
+    def test_deadline_counts_from_claim(self, mock_apply_async):
+        """Тест что срок "обрабатывается" считается от захвата пачки, а не от записи"""
+        message = self._message(Message.ProcessingStatus.PENDING, age=800)
+        Message.objects.filter(pk=message.pk).update(inserted_at=timezone.now() - timedelta(seconds=1000))
+        
+        claim_coalesced_batch(message.id)
+        
+        self.assertEqual(self.reaper.run(), {'requeued': 0, 'failed': 0})
+        mock_apply_async.assert_not_called()
+    
+    @patch('chat.tasks.generate_ai_response.apply_async')
+    def test_conversation_with_live_generation_skipped(self, mock_apply_async):
+        """Тест что диалог с занятой блокировкой (идет генерация) не трогается"""
+        message = self._message(Message.ProcessingStatus.PROCESSING, age=1000)
+        lock = ConversationLock(self.conversation.id)
+        lock.acquire()
+        
+        self.assertEqual(self.reaper.run(), {'requeued': 0, 'failed': 0})
+        message.refresh_from_db()
+        self.assertEqual(message.processing_status, Message.ProcessingStatus.PROCESSING)
+        
+        lock.release()
+        self.assertEqual(self.reaper.run(), {'requeued': 1, 'failed': 0})
+        mock_apply_async.assert_called_once_with(args=[message.id], task_id='task-1000')
@@ -0,0 +1,304 @@
+"""
+Unit тесты точного и семантического кэша ответов LLM
+"""
+from unittest.mock import Mock, patch
+
+from django.core.cache import cache, caches
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from chat.models import Conversation, Message
+from chat.services import LLMService
+from chat.services.openrouter import reset_clients
+from chat.services.response_cache import ResponseCache
+from chat.services.semantic_cache import HashingVectorizer, SemanticCache
+from users.models import Business, User
+
+
+class ResponseCacheKeyTest(TestCase):
+    """
+    Тесты ключа кэша ответов
+    """
+    
+    def setUp(self):
+        """Подготовка данных для тестов"""
+        self.response_cache = ResponseCache()
+        self.messages = [
+            {'role': 'system', 'content': 'Ты бизнес-консультант. Бизнес: кафе'},
+            {'role': 'user', 'content': 'Как привлечь клиентов?'}
+        ]
+    
+    def test_key_ignores_whitespace_and_case_of_user_message(self):
+        """Тест что пробелы и регистр вопроса не влияют на ключ"""
+        variant = [
+            self.messages[0],
+            {'role': 'user', 'content': '  как   привлечь клиентов? '}
+        ]
+        
+        self.assertEqual(
+            self.response_cache.make_key(self.messages, 'model-a', 0.7),
+            self.response_cache.make_key(variant, 'model-a', 0.7)
+        )
+    
+    def test_key_depends_on_context_model_and_temperature(self):
+        """Тест что другой контекст бизнеса, модель или temperature дают другой ключ"""
+        key = self.response_cache.make_key(self.messages, 'model-a', 0.7)
+        other_business = [
+            {'role': 'system', 'content': 'Ты бизнес-консультант. Бизнес: салон'},
+            self.messages[1]
+        ]
+        
+        self.assertNotEqual(key, self.response_cache.make_key(other_business, 'model-a', 0.7))
+        self.assertNotEqual(key, self.response_cache.make_key(self.messages, 'model-b', 0.7))
+        self.assertNotEqual(key, self.response_cache.make_key(self.messages, 'model-a', 0.2))
+
+
+@override_settings(LLM_RESPONSE_CACHE_ENABLED=True)
+class LLMServiceResponseCacheTest(TestCase):
+    """
+    Тесты ответов из кэша в LLMService
+    """
+    
+    def setUp(self):
+        """Подготовка данных для тестов"""
+        cache.clear()
+        caches['llm'].clear()
+        self.user = User.objects.create_user(
+            email='test@example.com',
+            password='TestPassword123!'
+        )
+        self.conversation = Conversation.objects.create(user=self.user, category='marketing')
+        self.user_message = Message.objects.create(
+            conversation=self.conversation,
+            role='user',
+            content='Как привлечь клиентов?'
+        )
+        self.service = LLMService()
+        
+        mock_completion = Mock()
+        mock_completion.choices = [Mock(
+            message=Mock(content='Запустите программу лояльности'),
+            finish_reason='stop'
+        )]
+        mock_completion.model = 'qwen-30b'
+        mock_completion.usage = Mock(total_tokens=120)
+        self.service.client.chat.completions.create = Mock(return_value=mock_completion)
+    
+    def tearDown(self):
+        reset_clients()
+    
+    def _generate(self, conversation=None, **kwargs):
+        return self.service.generate_response(
+            conversation=conversation or self.conversation,
+            user_message=self.user_message,
+            **kwargs
+        )
+    
+    @patch('chat.services.llm_service.PromptBuilder.build_messages_history')
+    def test_repeated_prompt_served_from_cache(self, mock_build_history):
+        """Тест что повторный запрос не обращается к LLM"""
+        mock_build_history.return_value = [{'role': 'user', 'content': 'Как привлечь клиентов?'}]
+        
+        first = self._generate()
+        second = self._generate()
+        
+        self.assertNotIn('cache_hit', first['metadata'])
+        self.assertEqual(second['content'], 'Запустите программу лояльности')
+        self.assertEqual(second['model'], 'qwen-30b')
+        self.assertEqual(second['tokens_used'], 0)
+        self.assertTrue(second['metadata']['cache_hit'])
+        self.assertEqual(second['metadata']['cached_tokens_used'], 120)
+        self.assertEqual(self.service.client.chat.completions.create.call_count, 1)
+    
+    @patch('chat.services.llm_service.PromptBuilder.build_messages_history')
+    def test_cache_hit_streams_content(self, mock_build_history):
+        """Тест что ответ из кэша передается подписчикам одним фрагментом"""
+        mock_build_history.return_value = [{'role': 'user', 'content': 'Как привлечь клиентов?'}]
+        self._generate()
+        
+        deltas = []
+        result = self._generate(on_delta=deltas.append)
+        
+        self.assertTrue(result['metadata']['cache_hit'])
+        self.assertEqual(deltas, ['Запустите программу лояльности'])
+    
+    @patch('chat.services.llm_service.PromptBuilder.build_messages_history')
+    def test_conversation_opt_out(self, mock_build_history):
+        """Тест что диалог с отключенным кэшем всегда обращается к LLM"""
+        mock_build_history.return_value = [{'role': 'user', 'content': 'Как привлечь клиентов?'}]
+        self.conversation.cache_responses = False
+        
+        self._generate()
+        result = self._generate()
+        
+        self.assertNotIn('cache_hit', result['metadata'])
+        self.assertEqual(self.service.client.chat.completions.create.call_count, 2)
+    
+    @patch('chat.services.llm_service.PromptBuilder.build_messages_history')
+    def test_error_response_not_cached(self, mock_build_history):
+        """Тест что ответ-заглушка при ошибке не кэшируется"""
+        mock_build_history.return_value = [{'role': 'user', 'content': 'Как привлечь клиентов?'}]
+        completion = self.service.client.chat.completions.create.return_value
+        
+        with override_settings(OPENROUTER_MODELS=['model-a'], OPENROUTER_MODEL='model-a'):
+            service = LLMService()
+            service.client.chat.completions.create = Mock(side_effect=Exception('boom'))
+            self.assertTrue(service.generate_response(self.conversation, self.user_message)['metadata']['error'])
+            
+            service.client.chat.completions.create = Mock(return_value=completion)
+            result = service.generate_response(self.conversation, self.user_message)
+        
+        self.assertNotIn('cache_hit', result['metadata'])
+        self.assertEqual(result['content'], 'Запустите программу лояльности')
+
+
+@override_settings(
+    LLM_RESPONSE_CACHE_ENABLED=False,
+    LLM_SEMANTIC_CACHE_ENABLED=True,
+    LLM_SEMANTIC_CACHE_THRESHOLD=0.85
+)
+class SemanticCacheTest(TestCase):
+    """
+    Тесты семантического кэша первых вопросов
+    """
+    
+    def setUp(self):
+        """Подготовка данных для тестов"""
+        cache.clear()
+        caches['llm'].clear()
+        self.user = User.objects.create_user(
+            email='test@example.com',
+            password='TestPassword123!'
+        )
+        self.service = LLMService()
+        
+        mock_completion = Mock()
+        mock_completion.choices = [Mock(
+            message=Mock(content='Подайте заявление в налоговую'),
+            finish_reason='stop'
+        )]
+        mock_completion.model = 'qwen-30b'
+        mock_completion.usage = Mock(total_tokens=200)
+        self.service.client.chat.completions.create = Mock(return_value=mock_completion)
+    
+    def tearDown(self):
+        reset_clients()
+    
+    def _ask(self, question, category='legal', business=None):
+        conversation = Conversation.objects.create(user=self.user, category=category, business=business)
+        message = Message.objects.create(conversation=conversation, role='user', content=question)
+        self.conversation = conversation
+        return self.service.generate_response(conversation=conversation, user_message=message)
+    
+    def _entries(self):
+        """Записи индекса последнего диалога _ask"""
+        messages = self.service.build_prompt(self.conversation)
+        return SemanticCache()._load(SemanticCache.index_key(self.conversation, messages))
+    
+    def test_vectorizer_separates_paraphrase_and_other_question(self):
+        """Тест что перефразировка близка, а вопрос о другом - нет"""
+        vectorizer = HashingVectorizer()
+        question = vectorizer.transform('Как зарегистрировать ИП?')
+        
+        self.assertGreater(
+            vectorizer.similarity(question, vectorizer.transform('как мне зарегистрировать ип')),
+            0.85
+        )
+        self.assertLess(
+            vectorizer.similarity(question, vectorizer.transform('Как зарегистрировать ООО?')),
+            0.85
+        )
+    
+    def test_paraphrased_first_question_served_from_cache(self):
+        """Тест что перефразированный первый вопрос в той же категории берется из кэша"""
+        self._ask('Как зарегистрировать ИП?')
+        result = self._ask('как мне зарегистрировать ип')
+        
+        self.assertEqual(result['content'], 'Подайте заявление в налоговую')
+        self.assertTrue(result['metadata']['cache_hit'])
+        self.assertEqual(result['metadata']['cache_type'], 'semantic')
+        self.assertGreaterEqual(result['metadata']['similarity'], 0.85)
+        self.assertEqual(result['metadata']['cached_question'], 'Как зарегистрировать ИП?')
+        self.assertEqual(self.service.client.chat.completions.create.call_count, 1)
+    
+    def test_other_category_not_served(self):
+        """Тест что индексы категорий не пересекаются"""
+        self._ask('Как зарегистрировать ИП?')
+        result = self._ask('Как зарегистрировать ИП?', category='finance')
+        
+        self.assertNotIn('cache_hit', result['metadata'])
+        self.assertEqual(self.service.client.chat.completions.create.call_count, 2)
+    
+    def test_businesses_of_same_type_not_shared(self):
+        """Тест что ответ с контекстом одного бизнеса не достается другому того же типа"""
+        first = Business.objects.create(owner=self.user, name='Кофейня на Рудаки', business_type='cafe')
+        second = Business.objects.create(owner=self.user, name='Кофейня на Сомони', business_type='cafe')
+        
+        self._ask('Как привлечь клиентов?', business=first)
+        result = self._ask('Как привлечь клиентов?', business=second)
+        
+        self.assertNotIn('cache_hit', result['metadata'])
+        self.assertEqual(self.service.client.chat.completions.create.call_count, 2)
+        
+        result = self._ask('как мне привлечь клиентов', business=first)
+        self.assertEqual(result['metadata']['cache_type'], 'semantic')
+    
+    def test_index_keeps_only_vectors_and_is_capped(self):
+        """Тест что индекс хранит только id и векторы и обрезается до лимита"""
+        self.service.semantic_cache.max_entries = 2
+        for question in ['Как зарегистрировать ИП?', 'Как закрыть ООО?', 'Какие налоги платит ИП?']:
+            self._ask(question)
+        
+        entries = self._entries()
+        self.assertEqual(len(entries), 2)
+        entry_id, _, vector = entries[0]
+        self.assertIsInstance(vector, dict)
+        self.assertEqual(
+            caches['llm'].get(SemanticCache.ENTRY_KEY_PREFIX + entry_id)['question'],
+            'Какие налоги платит ИП?'
+        )
+    
+    def test_missing_entry_is_a_miss(self):
+        """Тест что вытесненная запись ответа считается промахом"""
+        self._ask('Как зарегистрировать ИП?')
+        entry_id = self._entries()[0][0]
+        caches['llm'].delete(SemanticCache.ENTRY_KEY_PREFIX + entry_id)
+        
+        result = self._ask('как мне зарегистрировать ип')
+        
+        self.assertNotIn('cache_hit', result['metadata'])
+        self.assertEqual(self.service.client.chat.completions.create.call_count, 2)
+    
+    def test_follow_up_question_not_served(self):
+        """Тест что кэш не используется для продолжения диалога"""
+        self._ask('Как зарегистрировать ИП?')
+        
+        conversation = Conversation.objects.create(user=self.user, category='legal')
+        Message.objects.create(conversation=conversation, role='user', content='Привет')
+        Message.objects.create(conversation=conversation, role='assistant', content='Здравствуйте!')
+        message = Message.objects.create(conversation=conversation, role='user', content='Как зарегистрировать ИП?')
+        result = self.service.generate_response(conversation=conversation, user_message=message)
+        
+        self.assertNotIn('cache_hit', result['metadata'])
+    
+    def test_stats_endpoint(self):
+        """Тест метрик попаданий (только для администратора)"""
+        self._ask('Как зарегистрировать ИП?')
+        self._ask('как мне зарегистрировать ип')
+        
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        url = reverse('chat:semantic_cache_stats')
+        self.assertEqual(client.get(url).status_code, 403)
+        
+        admin = User.objects.create_superuser(email='admin@example.com', password='TestPassword123!')
+        client.force_authenticate(user=admin)
+        response = client.get(url)
+        
+        self.assertEqual(response.status_code, 200)
+        index = response.data['data']['indexes']['legal:none']
+        self.assertEqual(index['lookups'], 2)
+        self.assertEqual(index['hits'], 1)
+        self.assertEqual(index['hit_rate'], 0.5)
+        self.assertGreaterEqual(index['avg_hit_similarity'], 0.85)
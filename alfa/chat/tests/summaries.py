@@ -0,0 +1,171 @@
+"""
+Unit тесты краткого содержания длинных диалогов
+"""
+from unittest.mock import Mock, patch
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from chat.models import Conversation, Message
+from chat.services import PromptBuilder
+from chat.services.summaries import ConversationSummarizer
+from chat.tasks import update_conversation_summary
+from users.models import User
+
+
+@override_settings(
+    LLM_SUMMARY_ENABLED=True,
+    LLM_SUMMARY_TRIGGER_MESSAGES=6,
+    LLM_SUMMARY_KEEP_RECENT=2
+)
+class ConversationSummarizerTest(TestCase):
+    """
+    Тесты ConversationSummarizer
+    """
+    
+    def setUp(self):
+        """Подготовка данных для тестов"""
+        cache.clear()
+        self.user = User.objects.create_user(
+            email='test@example.com',
+            password='TestPassword123!'
+        )
+        self.conversation = Conversation.objects.create(user=self.user, category='finance')
+        self.llm_service = Mock()
+        self.llm_service.complete.return_value = {
+            'content': ' Владелец кафе обсуждает цены. ',
+            'model': 'qwen-30b',
+            'tokens_used': 80,
+            'finish_reason': 'stop',
+        }
+        self.summarizer = ConversationSummarizer(self.llm_service)
+    
+    def _add_messages(self, count):
+        messages = []
+        for i in range(count):
+            role = 'user' if i % 2 == 0 else 'assistant'
+            messages.append(Message.objects.create(
+                conversation=self.conversation,
+                role=role,
+                content=f'Сообщение {i}'
+            ))
+        return messages
+    
+    def test_short_conversation_not_summarized(self):
+        """Тест что короткий диалог не сжимается"""
+        self._add_messages(6)
+        
+        self.assertFalse(self.summarizer.needs_update(self.conversation))
+        self.assertFalse(self.summarizer.update(self.conversation.id))
+        self.llm_service.complete.assert_not_called()
+    
+    def test_old_messages_summarized_recent_kept(self):
+        """Тест что в содержание попадают все сообщения, кроме последних"""
+        messages = self._add_messages(8)
+        
+        self.assertTrue(self.summarizer.needs_update(self.conversation))
+        self.assertTrue(self.summarizer.update(self.conversation.id))
+        
+        self.conversation.refresh_from_db()
+        summary = self.conversation.metadata['summary']
+        self.assertEqual(summary['text'], 'Владелец кафе обсуждает цены.')
+        self.assertEqual(summary['until_message_id'], messages[5].id)
+        self.assertEqual(summary['until_created_at'], messages[5].created_at.isoformat())
+        self.assertEqual(summary['messages_count'], 6)
+        self.assertFalse(self.summarizer.needs_update(self.conversation))
+        
+        # В запрос попали только сжимаемые сообщения
+        request = self.llm_service.complete.call_args[0][0]
+        self.assertIn('Сообщение 5', request[1]['content'])
+        self.assertNotIn('Сообщение 6', request[1]['content'])
+    
+    def test_summary_updated_incrementally(self):
+        """Тест что следующее обновление дополняет предыдущее содержание"""
+        self._add_messages(8)
+        self.summarizer.update(self.conversation.id)
+        messages = self._add_messages(6)
+        
+        self.llm_service.complete.return_value = dict(
+            self.llm_service.complete.return_value, content='Обновленное содержание'
+        )
+        self.assertTrue(self.summarizer.update(self.conversation.id))
+        
+        request = self.llm_service.complete.call_args[0][0]
+        self.assertIn('Владелец кафе обсуждает цены.', request[1]['content'])
+        self.conversation.refresh_from_db()
+        summary = self.conversation.metadata['summary']
+        self.assertEqual(summary['messages_count'], 12)
+        self.assertEqual(summary['until_message_id'], messages[3].id)
+    
+    @override_settings(LLM_SUMMARY_MAX_INPUT_TOKENS=20)
+    def test_summary_input_limited_by_token_budget(self):
+        """Тест что за один запуск сжимаются только старейшие сообщения в пределах бюджета"""
+        messages = self._add_messages(8)
+        self.summarizer = ConversationSummarizer(self.llm_service)
+        
+        self.assertTrue(self.summarizer.update(self.conversation.id))
+        
+        request = self.llm_service.complete.call_args[0][0]
+        self.assertIn('Сообщение 0', request[1]['content'])
+        self.assertNotIn('Сообщение 5', request[1]['content'])
+        self.conversation.refresh_from_db()
+        summary = self.conversation.metadata['summary']
+        self.assertLess(summary['messages_count'], 6)
+        self.assertEqual(summary['until_message_id'], messages[summary['messages_count'] - 1].id)
+    
+    @override_settings(LLM_SUMMARY_MAX_INPUT_TOKENS=1)
+    def test_task_continues_until_history_summarized(self):
+        """Тест что задача ставит себя заново, пока история не сжата"""
+        messages = self._add_messages(8)
+        
+        with patch('chat.services.summaries.LLMService', return_value=self.llm_service), \
+                patch.object(update_conversation_summary, 'delay') as delay:
+            update_conversation_summary(self.conversation.id)
+        
+        # Хотя бы одно сообщение сжимается даже сверх бюджета
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.metadata['summary']['until_message_id'], messages[0].id)
+        delay.assert_called_once_with(self.conversation.id)
+    
+    def test_prompt_uses_summary_instead_of_old_messages(self):
+        """Тест что PromptBuilder подставляет содержание вместо старых сообщений"""
+        self._add_messages(8)
+        self.summarizer.update(self.conversation.id)
+        self.conversation.refresh_from_db()
+        
+        messages = PromptBuilder.build_messages_history(self.conversation)
+        
+        self.assertEqual(messages[1]['role'], 'system')
+        self.assertIn('Владелец кафе обсуждает цены.', messages[1]['content'])
+        self.assertEqual([m['content'] for m in messages[2:]], ['Сообщение 6', 'Сообщение 7'])
+    
+    def test_imported_messages_do_not_hide_recent_ones(self):
+        """Тест что граница содержания сравнивается по времени, а не по id"""
+        messages = self._add_messages(8)
+        # Импортированная история: id больше, а время - перед последними сообщениями
+        imported_at = messages[5].created_at + (messages[6].created_at - messages[5].created_at) / 2
+        imported = Message.objects.create(
+            conversation=self.conversation,
+            role='assistant',
+            content='Импортированное сообщение',
+            created_at=imported_at
+        )
+        
+        self.summarizer.update(self.conversation.id)
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.metadata['summary']['until_message_id'], imported.id)
+        
+        messages = PromptBuilder.build_messages_history(self.conversation)
+        self.assertEqual([m['content'] for m in messages[2:]], ['Сообщение 6', 'Сообщение 7'])
+    
+    def test_llm_failure_keeps_previous_state(self):
+        """Тест что при недоступности LLM содержание не меняется"""
+        self._add_messages(8)
+        self.llm_service.complete.return_value = None
+        
+        self.assertFalse(self.summarizer.update(self.conversation.id))
+        
+        self.conversation.refresh_from_db()
+        self.assertNotIn('summary', self.conversation.metadata)
+        # Блокировка снята, следующая задача может повторить попытку
+        self.assertTrue(cache.add(f'{ConversationSummarizer.LOCK_KEY_PREFIX}{self.conversation.id}', 1))
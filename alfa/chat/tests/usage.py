@@ -0,0 +1,142 @@
+"""
+Unit тесты агрегатов использования AI
+"""
+from datetime import timedelta
+
+from django.test import TestCase
+from django.utils import timezone
+
+from chat.models import Conversation, Message, RollupCheckpoint, UsageRollup
+from chat.services.usage import UsageRollupService
+from users.models import User, Business
+
+
+class UsageRollupServiceTest(TestCase):
+    """
+    Тесты UsageRollupService
+    """
+    
+    def setUp(self):
+        """Подготовка данных для тестов"""
+        self.user = User.objects.create_user(
+            email='owner@example.com',
+            password='TestPassword123!'
+        )
+        self.business = Business.objects.create(
+            owner=self.user,
+            name='Кофейня',
+            business_type='cafe'
+        )
+        self.business_conversation = Conversation.objects.create(user=self.user, business=self.business)
+        self.personal_conversation = Conversation.objects.create(user=self.user)
+        
+        self._exchange(self.business_conversation, tokens=100, response_time=2.0)
+        self._exchange(self.business_conversation, tokens=50, response_time=4.0)
+        self._exchange(self.personal_conversation, tokens=30, response_time=1.0)
+    
+    def _exchange(self, conversation, tokens, response_time):
+        """Вопрос пользователя и ответ ассистента"""
+        Message.objects.create(conversation=conversation, role='user', content='Вопрос')
+        Message.objects.create(
+            conversation=conversation,
+            role='assistant',
+            content='Ответ',
+            tokens_used=tokens,
+            response_time=response_time
+        )
+    
+    def test_run_builds_rollups(self):
+        """Тест агрегации по пользователю, бизнесу и дню"""
+        processed = UsageRollupService(lag=0).run()
+        
+        self.assertEqual(processed, 6)
+        business_rollup = UsageRollup.objects.get(business=self.business)
+        self.assertEqual(business_rollup.date, timezone.now().date())
+        self.assertEqual(business_rollup.messages_count, 4)
+        self.assertEqual(business_rollup.user_messages, 2)
+        self.assertEqual(business_rollup.assistant_messages, 2)
+        self.assertEqual(business_rollup.tokens_used, 150)
+        self.assertEqual(business_rollup.responses_count, 2)
+        self.assertAlmostEqual(business_rollup.response_time_sum, 6.0)
+        
+        personal_rollup = UsageRollup.objects.get(user=self.user, business__isnull=True)
+        self.assertEqual(personal_rollup.tokens_used, 30)
+        
+        checkpoint = RollupCheckpoint.objects.get(name=RollupCheckpoint.USAGE)
+        self.assertEqual(checkpoint.last_message_id, Message.objects.latest('id').id)
+    
+    def test_run_is_incremental(self):
+        """Тест что повторный запуск учитывает только новые сообщения"""
+        service = UsageRollupService(lag=0, batch_size=4)
+        self.assertEqual(service.run(), 6)
+        self.assertEqual(service.run(), 0)
+        
+        self._exchange(self.business_conversation, tokens=10, response_time=3.0)
+        self.assertEqual(service.run(), 2)
+        
+        business_rollup = UsageRollup.objects.get(business=self.business)
+        self.assertEqual(business_rollup.messages_count, 6)
+        self.assertEqual(business_rollup.tokens_used, 160)
+        self.assertEqual(UsageRollup.objects.count(), 2)
+    
+    def test_run_skips_recent_messages(self):
+        """Тест что сообщения моложе lag остаются для следующего запуска"""
+        processed = UsageRollupService(lag=60).run()
+        
+        self.assertEqual(processed, 0)
+        self.assertFalse(UsageRollup.objects.exists())
+        
+        # Сообщение старше lag после свежих не учитывается: отметка двигается только по префиксу
+        Message.objects.filter(id=Message.objects.latest('id').id).update(
+            inserted_at=timezone.now() - timedelta(minutes=5)
+        )
+        self.assertEqual(UsageRollupService(lag=60).run(), 0)
+    
+    def test_lag_counts_from_insert_time(self):
+        """Тест что импортированное сообщение с прошлой датой ждет lag от момента записи"""
+        UsageRollupService(lag=0).run()
+        Message.objects.all().update(inserted_at=timezone.now() - timedelta(minutes=5))
+        
+        imported_at = timezone.now() - timedelta(days=30)
+        Message.objects.bulk_create([
+            Message(conversation=self.personal_conversation, role='user', content='Старый вопрос', created_at=imported_at)
+        ])
+        self.assertEqual(UsageRollupService(lag=60).run(), 0)
+        
+        Message.objects.filter(created_at=imported_at).update(inserted_at=timezone.now() - timedelta(minutes=5))
+        self.assertEqual(UsageRollupService(lag=60).run(), 1)
+        self.assertTrue(UsageRollup.objects.filter(date=imported_at.date(), business__isnull=True).exists())
+    
+    def test_totals_include_live_tail(self):
+        """Тест что итоги складываются из агрегатов и еще не учтенных сообщений"""
+        UsageRollupService(lag=0).run()
+        self._exchange(self.business_conversation, tokens=20, response_time=6.0)
+        
+        totals = UsageRollupService.totals(self.user)
+        
+        self.assertEqual(totals['messages_count'], 8)
+        self.assertEqual(totals['assistant_messages'], 4)
+        self.assertEqual(totals['tokens_used'], 200)
+        self.assertEqual(totals['avg_response_time'], 3.25)
+        
+        business_totals = UsageRollupService.totals(self.user, self.business.id)
+        self.assertEqual(business_totals['tokens_used'], 170)
+    
+    def test_totals_without_checkpoint(self):
+        """Тест итогов до первого запуска агрегации (только живой хвост)"""
+        totals = UsageRollupService.totals(self.user)
+        
+        self.assertEqual(totals['messages_count'], 6)
+        self.assertEqual(totals['tokens_used'], 180)
+    
+    def test_daily(self):
+        """Тест использования по дням"""
+        UsageRollupService(lag=0).run()
+        self._exchange(self.business_conversation, tokens=20, response_time=6.0)
+        
+        daily = UsageRollupService.daily(self.user, self.business.id, days=7)
+        
+        self.assertEqual(len(daily), 1)
+        self.assertEqual(daily[0]['date'], timezone.now().date())
+        self.assertEqual(daily[0]['messages_count'], 6)
+        self.assertEqual(daily[0]['tokens_used'], 170)
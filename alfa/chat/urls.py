@@ -7,8 +7,11 @@ from chat.views import (
     ConversationListCreateView,
     ConversationDetailView,
     MessageCreateView,
+    MessageImportView,
     MessageStatusView,
-    ConversationStatsView
+    MessageEventsView,
+    ConversationStatsView,
+    SemanticCacheStatsView
 )
 
 app_name = 'chat'
@@ -20,9 +23,12 @@ urlpatterns = [
     
     # Сообщения (GET - список, POST - отправить)
     path('conversations/<int:conversation_id>/messages/', MessageCreateView.as_view(), name='messages'),
+    path('conversations/<int:conversation_id>/messages/import/', MessageImportView.as_view(), name='messages_import'),
     path('conversations/<int:conversation_id>/messages/<int:message_id>/status/', MessageStatusView.as_view(), name='message_status'),
+    path('conversations/<int:conversation_id>/messages/<int:message_id>/events/', MessageEventsView.as_view(), name='message_events'),
     
     # Статистика
     path('stats/', ConversationStatsView.as_view(), name='stats'),
+    path('cache/semantic/stats/', SemanticCacheStatsView.as_view(), name='semantic_cache_stats'),
 ]
 
@@ -1,10 +1,17 @@
 """
 Views для Chat API
 """
+import asyncio
+import json
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
 from rest_framework import generics, permissions, status
 from rest_framework.views import APIView
+from django.conf import settings
+from django.http import JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
-from django.db import models
+from django.views import View
 
 from chat.models import Conversation, Message
 from chat.serializers import (
@@ -15,7 +22,14 @@ from chat.serializers import (
     MessageSerializer,
     MessageCreateSerializer
 )
-from chat.services import LLMService
+from chat.middleware import get_user_from_token
+from chat.pagination import KeysetPagination
+from chat.services import LLMService, ChatEvents
+from chat.services.events import conversation_group_name
+from chat.services.imports import MessageImporter
+from chat.services.messages import submit_user_message
+from chat.services.semantic_cache import SemanticCache
+from chat.services.stats import ConversationStats
 from users.utils.api_response import APIResponse, format_serializer_errors
 
 
@@ -23,16 +37,19 @@ class ConversationListCreateView(generics.ListCreateAPIView):
     """
     API endpoint для списка диалогов и создания нового
     
-    GET /api/chat/conversations/
+    GET /api/chat/conversations/?limit=20&after=<cursor>
     POST /api/chat/conversations/
     """
     permission_classes = [permissions.IsAuthenticated]
+    keyset_pagination = KeysetPagination(field='last_message_at', descending=True, default_limit=20, max_limit=100)
     
     def get_queryset(self):
         """Возвращаем только диалоги текущего пользователя"""
+        # Счетчики и последнее сообщение хранятся в самом диалоге,
+        # поэтому список строится одним запросом (индекс user, -last_message_at, -id)
         return Conversation.objects.filter(
             user=self.request.user
-        ).select_related('business', 'user').prefetch_related('messages')
+        ).select_related('business')
     
     def get_serializer_class(self):
         """Используем разные serializers для GET и POST"""
@@ -63,11 +80,14 @@ class ConversationListCreateView(generics.ListCreateAPIView):
                 # Если передан параметр business, но он пустой, показываем только диалоги без бизнеса
                 queryset = queryset.filter(business__isnull=True)
         
-        serializer = self.get_serializer(queryset, many=True)
+        # Страница по курсору (last_message_at, id), самые свежие диалоги первыми
+        conversations, pagination = self.keyset_pagination.paginate(queryset, request)
+        serializer = self.get_serializer(conversations, many=True)
         
         return APIResponse.success(
             data=serializer.data,
-            message=f"Найдено диалогов: {len(serializer.data)}"
+            message=f"Найдено диалогов: {len(serializer.data)}",
+            pagination=pagination
         )
     
     def create(self, request, *args, **kwargs):
@@ -105,7 +125,7 @@ class ConversationDetailView(generics.RetrieveUpdateDestroyAPIView):
         """Возвращаем только диалоги текущего пользователя"""
         return Conversation.objects.filter(
             user=self.request.user
-        ).select_related('business', 'user').prefetch_related('messages')
+        ).select_related('business', 'user')
     
     def get_serializer_class(self):
         """Используем разные serializers для разных методов"""
@@ -151,7 +171,7 @@ class ConversationDetailView(generics.RetrieveUpdateDestroyAPIView):
         
         # Вместо удаления - архивируем
         instance.status = Conversation.Status.ARCHIVED
-        instance.save()
+        instance.save(update_fields=['status', 'updated_at'])
         
         return APIResponse.success(
             message="Диалог успешно архивирован"
@@ -166,6 +186,9 @@ class MessageCreateView(APIView):
     POST /api/chat/conversations/{conversation_id}/messages/ - отправить сообщение
     """
     permission_classes = [permissions.IsAuthenticated]
+    keyset_pagination = KeysetPagination(
+        field='inserted_at', descending=False, default_limit=50, max_limit=200, tail_first=True
+    )
     
     def get(self, request, conversation_id):
         """GET - получить список сообщений"""
@@ -176,13 +199,20 @@ class MessageCreateView(APIView):
             user=request.user
         )
         
-        # Получаем все сообщения
-        messages = Message.objects.filter(conversation=conversation).order_by('created_at')
+        # Страница по курсору (inserted_at, id): по умолчанию последние сообщения,
+        # before - более ранние (прокрутка вверх), after - более новые. Время
+        # записи, а не created_at: импортированная история с прошлыми датами
+        # не появляется позади уже выданного курсора
+        messages, pagination = self.keyset_pagination.paginate(
+            Message.objects.filter(conversation=conversation),
+            request
+        )
         serializer = MessageSerializer(messages, many=True)
         
         return APIResponse.success(
             data=serializer.data,
-            message=f"Найдено сообщений: {len(serializer.data)}"
+            message=f"Найдено сообщений: {len(serializer.data)}",
+            pagination=pagination
         )
     
     def post(self, request, conversation_id):
@@ -194,33 +224,77 @@ class MessageCreateView(APIView):
             user=request.user
         )
         
-        # Валидация сообщения
-        serializer = MessageCreateSerializer(data=request.data)
+        # Валидация сообщения (ключ идемпотентности из заголовка имеет
+        # приоритет над полем client_message_id)
+        serializer = MessageCreateSerializer(
+            data=request.data,
+            context={'idempotency_key': request.headers.get('Idempotency-Key')}
+        )
         if not serializer.is_valid():
             return APIResponse.validation_error(
                 errors=format_serializer_errors(serializer.errors),
                 message="Ошибка валидации сообщения"
             )
         
-        # Создаем сообщение пользователя с статусом "ожидает обработки"
-        user_message = Message.objects.create(
-            conversation=conversation,
-            role=Message.Role.USER,
-            content=serializer.validated_data['content'],
-            processing_status=Message.ProcessingStatus.PENDING
+        # Создаем сообщение пользователя и запускаем асинхронную генерацию ответа
+        # (при повторе с тем же ключом - исходное сообщение и задача)
+        user_message, task_id, created = submit_user_message(
+            conversation,
+            serializer.validated_data['content'],
+            client_message_id=serializer.validated_data.get('client_message_id')
         )
         
-        # Запускаем асинхронную задачу для генерации ответа
-        from chat.tasks import generate_ai_response
-        task = generate_ai_response.delay(user_message.id)
-        
         # Возвращаем сообщение пользователя и ID задачи
         return APIResponse.success(
             data={
                 'user_message': MessageSerializer(user_message).data,
-                'task_id': task.id
+                'task_id': task_id,
+                'replayed': not created
             },
-            message="Сообщение отправлено, генерация ответа начата"
+            message="Сообщение отправлено, генерация ответа начата" if created else "Сообщение уже было отправлено"
+        )
+
+
+class MessageImportView(APIView):
+    """
+    API endpoint для импорта истории сообщений в диалог
+    
+    POST /api/chat/conversations/{conversation_id}/messages/import/
+    Content-Type: application/x-ndjson
+    
+    Тело запроса - JSONL, по одному сообщению в строке. Тело читается
+    построчно и пишется пачками, ответы AI для импортированных сообщений
+    не генерируются.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    
+    def post(self, request, conversation_id):
+        """POST - импортировать сообщения"""
+        conversation = get_object_or_404(
+            Conversation,
+            id=conversation_id,
+            user=request.user
+        )
+        
+        # request.data не используется: тело не загружается в память целиком
+        if request.stream is None:
+            return APIResponse.validation_error(
+                errors={'body': ['Тело запроса пустое']},
+                message="Нет сообщений для импорта"
+            )
+        
+        result = MessageImporter(conversation).run(request.stream)
+        
+        if not result['imported']:
+            return APIResponse.validation_error(
+                errors={'lines': result['errors']},
+                message="Не удалось импортировать ни одного сообщения"
+            )
+        
+        return APIResponse.success(
+            data=result,
+            message=f"Импортировано сообщений: {result['imported']}",
+            status_code=status.HTTP_201_CREATED
         )
 
 
@@ -249,8 +323,8 @@ class MessageStatusView(APIView):
             assistant_message = Message.objects.filter(
                 conversation_id=conversation_id,
                 role=Message.Role.ASSISTANT,
-                created_at__gt=message.created_at
-            ).order_by('created_at').first()
+                inserted_at__gt=message.inserted_at
+            ).order_by('inserted_at').first()
         
         data = {
             'message_id': message.id,
@@ -267,6 +341,129 @@ class MessageStatusView(APIView):
         )
 
 
+class MessageEventsView(View):
+    """
+    Server-Sent Events поток статуса обработки сообщения
+    
+    GET /api/chat/conversations/{conversation_id}/messages/{message_id}/events/
+    
+    Заменяет polling MessageStatusView: одно долгоживущее соединение на
+    ожидающее сообщение. Токен передается в заголовке Authorization или
+    в параметре ?token= (EventSource не поддерживает заголовки).
+    
+    События: message.status, message.delta, message.reset, message.retrying,
+    message.completed.
+    Поток закрывается после завершения обработки или по таймауту.
+    """
+    
+    TERMINAL_STATUSES = (
+        Message.ProcessingStatus.COMPLETED,
+        Message.ProcessingStatus.FAILED,
+    )
+    
+    async def get(self, request, conversation_id, message_id):
+        """Открытие SSE потока"""
+        user = await sync_to_async(get_user_from_token)(self._get_raw_token(request))
+        if not user.is_authenticated:
+            return JsonResponse({
+                'success': False,
+                'message': 'Требуется аутентификация',
+                'data': None,
+                'errors': None
+            }, status=status.HTTP_401_UNAUTHORIZED)
+        
+        message = await Message.objects.filter(
+            id=message_id,
+            conversation_id=conversation_id,
+            conversation__user=user
+        ).afirst()
+        if message is None:
+            return JsonResponse({
+                'success': False,
+                'message': 'Сообщение не найдено',
+                'data': None,
+                'errors': None
+            }, status=status.HTTP_404_NOT_FOUND)
+        
+        response = StreamingHttpResponse(
+            self._event_stream(message),
+            content_type='text/event-stream'
+        )
+        response['Cache-Control'] = 'no-cache'
+        # Отключаем буферизацию ответа в nginx
+        response['X-Accel-Buffering'] = 'no'
+        return response
+    
+    @staticmethod
+    def _get_raw_token(request):
+        """Токен из заголовка Authorization: Bearer <token> или из query string"""
+        header = request.headers.get('Authorization', '')
+        parts = header.split()
+        if len(parts) == 2 and parts[0] in settings.SIMPLE_JWT['AUTH_HEADER_TYPES']:
+            return parts[1]
+        return request.GET.get('token')
+    
+    @staticmethod
+    def _format_event(event, data):
+        return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+    
+    async def _event_stream(self, message):
+        """Генератор SSE событий для одного сообщения"""
+        channel_layer = get_channel_layer()
+        group_name = conversation_group_name(message.conversation_id)
+        channel_name = await channel_layer.new_channel()
+        
+        # Подписываемся до проверки статуса, чтобы не пропустить переход
+        await channel_layer.group_add(group_name, channel_name)
+        try:
+            await message.arefresh_from_db(fields=['processing_status'])
+            yield self._format_event(ChatEvents.MESSAGE_STATUS, {
+                'message_id': message.id,
+                'processing_status': message.processing_status,
+                'processing_status_display': message.get_processing_status_display(),
+            })
+            
+            if message.processing_status in self.TERMINAL_STATUSES:
+                if message.processing_status == Message.ProcessingStatus.COMPLETED:
+                    assistant_message = await Message.objects.filter(
+                        conversation_id=message.conversation_id,
+                        role=Message.Role.ASSISTANT,
+                        inserted_at__gt=message.inserted_at
+                    ).order_by('inserted_at').afirst()
+                    if assistant_message:
+                        yield self._format_event(ChatEvents.MESSAGE_COMPLETED, {
+                            'message_id': message.id,
+                            'assistant_message': MessageSerializer(assistant_message).data,
+                        })
+                return
+            
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + settings.CHAT_SSE_TIMEOUT
+            
+            while loop.time() < deadline:
+                timeout = min(settings.CHAT_SSE_KEEPALIVE_INTERVAL, deadline - loop.time())
+                try:
+                    event = await asyncio.wait_for(channel_layer.receive(channel_name), timeout)
+                except asyncio.TimeoutError:
+                    # Комментарий SSE держит соединение открытым через прокси
+                    yield ": keepalive\n\n"
+                    continue
+                
+                data = event.get('data', {})
+                if data.get('message_id') != message.id:
+                    continue
+                
+                yield self._format_event(event['event'], data)
+                
+                if event['event'] == ChatEvents.MESSAGE_COMPLETED:
+                    return
+                if (event['event'] == ChatEvents.MESSAGE_STATUS
+                        and data.get('processing_status') == Message.ProcessingStatus.FAILED):
+                    return
+        finally:
+            await channel_layer.group_discard(group_name, channel_name)
+
+
 class ConversationStatsView(APIView):
     """
     API endpoint для получения статистики по диалогам пользователя
@@ -278,56 +475,33 @@ class ConversationStatsView(APIView):
     
     def get(self, request):
         """Получение статистики по диалогам"""
-        user = request.user
-        business_id = request.query_params.get('business')
-        
-        # Базовый queryset
-        conversations = Conversation.objects.filter(user=user)
-        messages_query = Message.objects.filter(conversation__user=user)
-        
-        # Фильтрация по бизнесу, если указан
-        if business_id:
-            conversations = conversations.filter(business_id=business_id)
-            messages_query = messages_query.filter(conversation__business_id=business_id)
-        
-        # Последний диалог для определения последней активности
-        last_conversation = conversations.order_by('-last_message_at').first()
-        
-        stats = {
-            'total_conversations': conversations.count(),
-            'active_conversations': conversations.filter(status=Conversation.Status.ACTIVE).count(),
-            'archived_conversations': conversations.filter(status=Conversation.Status.ARCHIVED).count(),
-            'completed_conversations': conversations.filter(status=Conversation.Status.COMPLETED).count(),
-            'total_messages': messages_query.count(),
-            'user_messages': messages_query.filter(role=Message.Role.USER).count(),
-            'assistant_messages': messages_query.filter(role=Message.Role.ASSISTANT).count(),
-            'total_tokens_used': messages_query.aggregate(
-                total=models.Sum('tokens_used')
-            )['total'] or 0,
-            'last_activity': last_conversation.last_message_at if last_conversation else None,
-            'by_category': {}
-        }
-        
-        # Статистика по категориям
-        for category in Conversation.Category:
-            count = conversations.filter(category=category.value).count()
-            if count > 0:
-                stats['by_category'][category.value] = {
-                    'name': category.label,
-                    'count': count
-                }
-        
-        # Если запрашивается статистика по бизнесу, добавляем информацию о бизнесе
-        if business_id:
-            from users.models import Business
-            business = Business.objects.filter(id=business_id, owner=user).first()
-            if business:
-                stats['business'] = {
-                    'id': business.id,
-                    'name': business.name
-                }
+        # Считается двумя агрегирующими запросами и кэшируется по пользователю
+        # до следующей записи диалога или сообщения (см. ConversationStats)
+        stats = ConversationStats.get(request.user, request.query_params.get('business'))
         
         return APIResponse.success(
             data=stats,
             message="Статистика получена"
         )
+
+
+class SemanticCacheStatsView(APIView):
+    """
+    API endpoint метрик семантического кэша (только для администраторов)
+    
+    GET /api/chat/cache/semantic/stats/
+    """
+    permission_classes = [permissions.IsAdminUser]
+    
+    def get(self, request):
+        """Доля попаданий и распределение близости по индексам (категория:тип бизнеса)"""
+        semantic_cache = SemanticCache()
+        
+        return APIResponse.success(
+            data={
+                'enabled': semantic_cache.enabled,
+                'threshold': semantic_cache.threshold,
+                'indexes': semantic_cache.stats()
+            },
+            message="Метрики семантического кэша получены"
+        )
@@ -330,4 +330,6 @@ class BusinessStatsAPITest(APITestCase):
         self.assertTrue(response.data['success'])
         self.assertIn('business_id', response.data['data'])
         self.assertIn('business_name', response.data['data'])
+        self.assertEqual(response.data['data']['ai_usage']['messages_count'], 0)
+        self.assertEqual(response.data['data']['ai_usage_by_day'], [])
 
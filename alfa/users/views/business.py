@@ -14,6 +14,7 @@ from users.serializers import (
     BusinessProfileSerializer
 )
 from users.utils.api_response import APIResponse, format_serializer_errors
+from chat.services.usage import UsageRollupService
 
 
 class BusinessListCreateView(generics.ListCreateAPIView):
@@ -229,7 +230,10 @@ class BusinessStatsView(APIView):
             'business_id': business.id,
             'business_name': business.name,
             'total_metrics_records': business.metrics.count(),
-            'latest_metrics': None
+            'latest_metrics': None,
+            # Использование AI консультанта: итоги и по дням за 30 дней
+            'ai_usage': UsageRollupService.totals(request.user, business.id),
+            'ai_usage_by_day': UsageRollupService.daily(request.user, business.id, days=30)
         }
         
         if latest_metrics:
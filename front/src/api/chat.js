@@ -22,17 +22,30 @@ function extractErrors(error) {
   return { general: 'Произошла ошибка. Попробуйте снова.' };
 }
 
-// Получить список диалогов
+// Размер страницы при загрузке всего списка диалогов (максимум API)
+const CONVERSATIONS_PAGE_SIZE = 100;
+
+// Получить список диалогов (все страницы: список отдается по курсору)
 export async function fetchConversations(params = {}) {
   try {
-    const response = await apiClient.get('/chat/conversations/', { params });
-    const { success, data, errors } = response.data;
+    const conversations = [];
+    let after = null;
 
-    if (!success) {
-      throw new ApiError(errors || { general: response.data.message });
-    }
+    do {
+      const response = await apiClient.get('/chat/conversations/', {
+        params: { limit: CONVERSATIONS_PAGE_SIZE, ...params, ...(after ? { after } : {}) },
+      });
+      const { success, data, errors, pagination } = response.data;
+
+      if (!success) {
+        throw new ApiError(errors || { general: response.data.message });
+      }
 
-    return data || [];
+      conversations.push(...(data || []));
+      after = pagination?.has_more_after ? pagination.after : null;
+    } while (after);
+
+    return conversations;
   } catch (error) {
     throw extractErrors(error);
   }
@@ -54,7 +67,7 @@ export async function createConversation(payload) {
   }
 }
 
-// Получить детали диалога с сообщениями
+// Получить детали диалога (без сообщений, см. fetchMessages)
 export async function fetchConversation(conversationId) {
   try {
     const response = await apiClient.get(`/chat/conversations/${conversationId}/`);
@@ -70,6 +83,26 @@ export async function fetchConversation(conversationId) {
   }
 }
 
+// Получить страницу сообщений диалога: по умолчанию последние,
+// before - более ранние (курсор из pagination.before)
+export async function fetchMessages(conversationId, params = {}) {
+  try {
+    const response = await apiClient.get(
+      `/chat/conversations/${conversationId}/messages/`,
+      { params }
+    );
+    const { success, data, errors, pagination } = response.data;
+
+    if (!success) {
+      throw new ApiError(errors || { general: response.data.message });
+    }
+
+    return { messages: data || [], pagination };
+  } catch (error) {
+    throw extractErrors(error);
+  }
+}
+
 // Отправить сообщение в диалог
 export async function sendMessage(conversationId, content, model = null) {
   try {
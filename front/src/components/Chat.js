@@ -1,10 +1,12 @@
 import React, { useState, useEffect, useRef } from 'react';
 import ReactMarkdown from 'react-markdown';
-import { sendMessage, createConversation, fetchConversation, fetchConversations, checkMessageStatus } from '../api/chat';
+import { sendMessage, createConversation, fetchMessages, fetchConversations, checkMessageStatus } from '../api/chat';
 import './Chat.css';
 
 function Chat({ businesses, currentConversation, onConversationCreated, onMessageSent, initialBusinessId }) {
   const [messages, setMessages] = useState([]);
+  // Курсор более ранних сообщений (сообщения загружаются постранично с конца)
+  const [earlierCursor, setEarlierCursor] = useState(null);
   const [inputValue, setInputValue] = useState('');
   const [isLoading, setIsLoading] = useState(false);
   const [selectedBusiness, setSelectedBusiness] = useState(initialBusinessId ? String(initialBusinessId) : '');
@@ -17,6 +19,7 @@ function Chat({ businesses, currentConversation, onConversationCreated, onMessag
   const messagesEndRef = useRef(null);
   const textareaRef = useRef(null);
   const isFirstRender = useRef(true);
+  const skipNextScroll = useRef(false);
 
   // Обновляем выбранный бизнес если изменился initialBusinessId
   useEffect(() => {
@@ -55,6 +58,11 @@ function Chat({ businesses, currentConversation, onConversationCreated, onMessag
 
   // Прокручиваем только когда добавляется новое сообщение, а не при загрузке
   useEffect(() => {
+    // Ранние сообщения добавляются сверху - прокрутка вниз не нужна
+    if (skipNextScroll.current) {
+      skipNextScroll.current = false;
+      return;
+    }
     // Используем requestAnimationFrame для отложенной прокрутки после рендера
     if (messages.length > 0) {
       const timeoutId = setTimeout(() => {
@@ -83,6 +91,7 @@ function Chat({ businesses, currentConversation, onConversationCreated, onMessag
     if (!isFirstRender.current) {
       setSelectedConversation('');
       setMessages([]);
+      setEarlierCursor(null);
     } else {
       isFirstRender.current = false;
     }
@@ -117,6 +126,7 @@ function Chat({ businesses, currentConversation, onConversationCreated, onMessag
       }
     } else {
       setMessages([]);
+      setEarlierCursor(null);
       if (onConversationCreated) {
         onConversationCreated(null);
       }
@@ -125,13 +135,29 @@ function Chat({ businesses, currentConversation, onConversationCreated, onMessag
 
   const loadConversation = async (conversationId) => {
     try {
-      const data = await fetchConversation(conversationId);
-      setMessages(data.messages || []);
+      // Последняя страница сообщений, более ранние - по кнопке
+      const { messages: page, pagination } = await fetchMessages(conversationId);
+      setMessages(page);
+      setEarlierCursor(pagination?.has_more_before ? pagination.before : null);
     } catch (error) {
       console.error('Error loading conversation:', error);
     }
   };
 
+  const loadEarlierMessages = async () => {
+    if (!selectedConversation || !earlierCursor) {
+      return;
+    }
+    try {
+      const { messages: page, pagination } = await fetchMessages(selectedConversation, { before: earlierCursor });
+      skipNextScroll.current = true;
+      setMessages((prev) => [...page, ...prev]);
+      setEarlierCursor(pagination?.has_more_before ? pagination.before : null);
+    } catch (error) {
+      console.error('Error loading earlier messages:', error);
+    }
+  };
+
   const pollMessageStatus = async (conversationId, messageId) => {
     const maxAttempts = 120; // 120 попыток = 10 минут (каждые 5 секунд)
     let attempts = 0;
@@ -289,6 +315,11 @@ function Chat({ businesses, currentConversation, onConversationCreated, onMessag
       </div>
 
       <div className="chat-messages">
+        {earlierCursor && (
+          <button type="button" className="chat-load-earlier" onClick={loadEarlierMessages}>
+            Показать более ранние сообщения
+          </button>
+        )}
         {messages.length === 0 ? (
           <div className="chat-empty">
             <p className="chat-empty-title">Здравствуйте! 👋</p>